@@ -1,14 +1,32 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
 from dotenv import load_dotenv
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
 import os
 from supabase import create_client, Client
-from datetime import datetime
+from datetime import datetime, timedelta
 from functools import wraps
+from itertools import groupby
 import jwt
 import random
 from threading import Thread
 import time
+import uuid
+import base64
+import json
+import numpy as np
+from order_book import BookOrder, MatchingEngine
+from intake import IntakeClosed, IntakeGate
+from cache import TTLCache, MarketSnapshot, MarketState
+from leaderboard import Leaderboard
+import price_engine
+from stream import Hub
+from shards import ShardPool, parse_shard_map
+from instrumentation import DbMetrics, InstrumentedClient, shard_pool_prometheus
+from journal import Journal
+from money import from_cents, to_cents
+from portfolio import Portfolios
 
 load_dotenv()
 
@@ -24,6 +42,18 @@ CORS(app, resources={
     }
 })
 
+# Database round trips per route and table, served on /api/metrics
+db_metrics = DbMetrics()
+
+# Also report each request's round trips in X-DB-* response headers
+# (always on when Flask runs in debug mode)
+DB_METRICS_HEADERS = os.getenv('DB_METRICS_HEADERS', 'false').lower() == 'true'
+
+@app.before_request
+def start_db_metrics():
+    rule = request.url_rule.rule if request.url_rule else 'unmatched'
+    db_metrics.begin(f'{request.method} {rule}')
+
 # Add CORS headers to all responses
 @app.after_request
 def after_request(response):
@@ -31,63 +61,139 @@ def after_request(response):
     response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization')
     response.headers.add('Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE,OPTIONS')
     response.headers.add('Access-Control-Allow-Credentials', 'true')
+    response.headers.add('Access-Control-Expose-Headers', 'ETag,X-Total-Count,X-Next-Cursor,X-DB-Queries,X-DB-Time-Ms,X-DB-Tables')
+
+    request_metrics = db_metrics.end()
+    if request_metrics and (DB_METRICS_HEADERS or app.debug):
+        add_db_metrics_headers(response, request_metrics)
     return response
 
+def add_db_metrics_headers(response, request_metrics):
+    response.headers['X-DB-Queries'] = str(request_metrics.queries)
+    response.headers['X-DB-Time-Ms'] = f'{request_metrics.seconds * 1000:.2f}'
+    response.headers['X-DB-Tables'] = ','.join(
+        f'{table}={count}' for table, count in sorted(request_metrics.tables.items())
+    )
+
 # Supabase Configuration
-supabase: Client = create_client(
+supabase: Client = InstrumentedClient(create_client(
     os.getenv('SUPABASE_URL'),
     os.getenv('SUPABASE_KEY')
-)
+), db_metrics)
+
+# The engines' rpc functions (settlement, halts, price writes, loading the
+# books) are SECURITY DEFINER with EXECUTE revoked from the anon and
+# authenticated roles, so they are called with the service-role key. Only
+# the processes that run the engines need it.
+SUPABASE_SERVICE_KEY = os.getenv('SUPABASE_SERVICE_KEY')
+service_supabase: Client = InstrumentedClient(create_client(
+    os.getenv('SUPABASE_URL'),
+    SUPABASE_SERVICE_KEY
+), db_metrics) if SUPABASE_SERVICE_KEY else None
 
 # JWT Configuration
 JWT_SECRET = os.getenv('JWT_SECRET', 'your-secret-key')
 
+class RequestError(Exception):
+    """
+    A request refused with status and {'error': message}. Raised by the
+    request helpers that the Flask routes here and the async routes in
+    asgi.py share, so both check a request the same way and in the same order.
+    """
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+def get_request_token(allow_query=False):
+    return request_token(request.headers, request.args, allow_query)
+
+def request_token(headers, args, allow_query=False):
+    """
+    Get the bearer token from the Authorization header, or from the token
+    query parameter when allow_query is set (EventSource cannot send headers)
+    """
+    if 'Authorization' in headers:
+        return headers['Authorization'].split(' ')[1]
+    if allow_query:
+        return args.get('token')
+    return None
+
+def token_user_id(token):
+    """The user_id in a request's JWT; raises RequestError (401) if it is missing or invalid"""
+    if not token:
+        raise RequestError('Token is missing', 401)
+    try:
+        return jwt.decode(token, JWT_SECRET, algorithms=['HS256'])['user_id']
+    except Exception as e:
+        raise RequestError(str(e), 401)
+
+def request_user(user_id, profile):
+    """The current_user passed to a route, from the token's user_id and get_profile()"""
+    if not profile:
+        raise RequestError('User not found', 401)
+    # Add is_admin flag to user data
+    profile['user_id'] = user_id
+    profile['is_admin'] = profile.get('is_admin', False)
+    return profile
+
+# Profiles looked up by token_required / admin_required, keyed by user_id
+profile_cache = TTLCache(
+    maxsize=int(os.getenv('PROFILE_CACHE_SIZE', '10000')),
+    ttl=float(os.getenv('PROFILE_CACHE_TTL', '30'))
+)
+
+def get_profile(user_id):
+    """
+    Get a user's profile, served from the profile cache when possible
+    Returns a copy so callers can add their own keys, or None if not found
+    """
+    profile = profile_cache.get(user_id)
+    if profile is None:
+        user = supabase.table('profiles').select('*').eq('user_id', user_id).single().execute()
+        if not user.data:
+            return None
+        profile = user.data
+        profile_cache.set(user_id, profile)
+    return dict(profile)
+
+def update_profile_balance(user_id, new_balance):
+    """Write a user's new balance to the database and the profile cache"""
+    supabase.table('profiles').update({'balance': str(new_balance)}).eq('user_id', user_id).execute()
+    profile_cache.update(user_id, {'balance': str(new_balance)})
+
 def token_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
-        token = None
-        if 'Authorization' in request.headers:
-            token = request.headers['Authorization'].split(' ')[1]
-        
-        if not token:
-            return jsonify({'error': 'Token is missing'}), 401
-            
         try:
-            data = jwt.decode(token, JWT_SECRET, algorithms=['HS256'])
-            # Get user from database
-            user = supabase.table('profiles').select('*').eq('user_id', data['user_id']).single().execute()
-            
-            if not user.data:
-                return jsonify({'error': 'User not found'}), 401
-                
-            # Add is_admin flag to user data
-            current_user = user.data
-            current_user['user_id'] = data['user_id']
-            current_user['is_admin'] = user.data.get('is_admin', False)
-            
-            return f(current_user, *args, **kwargs)
+            user_id = token_user_id(get_request_token())
+            # Get user from cache or database
+            current_user = request_user(user_id, get_profile(user_id))
+        except RequestError as e:
+            return jsonify({'error': e.message}), e.status
         except Exception as e:
             return jsonify({'error': str(e)}), 401
-            
+
+        return f(current_user, *args, **kwargs)
+
     return decorated
 
 # Admin verification decorator
 def admin_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
-        token = None
-        if 'Authorization' in request.headers:
-            token = request.headers['Authorization'].split(' ')[1]
+        token = get_request_token()
         
         if not token:
             return jsonify({'error': 'Token is missing'}), 401
             
         try:
             data = jwt.decode(token, JWT_SECRET, algorithms=['HS256'])
-            # Get user from database
-            user = supabase.table('profiles').select('*').eq('user_id', data['user_id']).single().execute()
+            # Get user from cache or database
+            user = get_profile(data['user_id'])
             
-            if not user.data or not user.data.get('is_admin'):
+            if not user or not user.get('is_admin'):
                 return jsonify({'error': 'Admin access required'}), 403
                 
             return f(*args, **kwargs)
@@ -99,83 +205,142 @@ def admin_required(f):
 # Global variable to control price update thread
 price_update_running = True
 
+# Market data fan-out for /api/stream. Channels are 'prices' for price
+# ticks and trades, and 'user:<user_id>' for a user's order updates.
+market_data_hub = Hub(backlog=int(os.getenv('STREAM_BACKLOG', '1024')))
+
+# Pre-serialized GET /api/stocks response, with its ETag
+market_snapshot = MarketSnapshot(ttl=float(os.getenv('STOCKS_SNAPSHOT_TTL', '5')))
+
+# Cash, holdings and total value of recently active users, kept current by
+# settlements and price ticks, for the portfolio endpoints
+portfolios = Portfolios(
+    maxsize=int(os.getenv('PORTFOLIO_CACHE_SIZE', '10000')),
+    ttl=float(os.getenv('PORTFOLIO_CACHE_TTL', '300'))
+)
+
+# Where the price and matching engines run:
+#   inline - in background threads of this process (single process, python app.py)
+#   worker - in worker.py; this process only serves requests and hears about
+#            engine events over Postgres NOTIFY (needs DATABASE_URL)
+#   engine - set by worker.py itself, which starts the engines once it leads
+ENGINE_MODE = os.getenv('ENGINE_MODE', 'inline')
+ENGINE_EVENTS_CHANNEL = 'engine_events'
+
+# Market open/closed flag, pushed by the market_state_notify trigger on the
+# market_state channel and re-read from the database at most once per TTL
+MARKET_STATE_CHANNEL = 'market_state'
+market_state = MarketState(ttl=float(os.getenv('MARKET_STATE_TTL', '1')))
+
+def on_market_state_change(payload):
+    """The market_state row was written, possibly by another process"""
+    market_state.set(json.loads(payload)['is_active'])
+
+# Set by worker.py to forward engine events to the web processes
+engine_event_notifier = None
+
+def handle_engine_event(kind, data):
+    """Apply an engine event to this process's caches and market data stream"""
+    if kind == 'prices':
+        # data is a list of (stock_id, new_price, price_change)
+        market_snapshot.apply_prices(data)
+        for stock_id, new_price, _ in data:
+            leaderboard.set_price(stock_id, new_price)
+            portfolios.set_price(stock_id, new_price)
+        market_data_hub.publish('prices', 'prices', [
+            {'stock_id': stock_id, 'current_price': new_price, 'price_change': price_change}
+            for stock_id, new_price, price_change in data
+        ])
+    elif kind == 'trades':
+        market_data_hub.publish('prices', 'trades', data)
+    elif kind == 'order':
+        market_data_hub.publish(f"user:{data['user_id']}", 'order', data)
+    elif kind == 'settlement':
+        apply_settlement(data)
+    elif kind == 'settling':
+        leaderboard.settling(data)
+    elif kind == 'settled':
+        leaderboard.settled(data)
+
+def emit_engine_event(kind, data):
+    """Handle an engine event here and, from the worker, in every web process"""
+    handle_engine_event(kind, data)
+    if engine_event_notifier is not None:
+        engine_event_notifier.send(kind, data)
+
+def publish_prices(updates):
+    """Publish price changes, an iterable of (stock_id, new_price, price_change)"""
+    emit_engine_event('prices', [list(update) for update in updates])
+
+def publish_order_update(user_id, order_id, status, **details):
+    """Push an order status change to the owning user's stream"""
+    emit_engine_event('order', dict(details, user_id=user_id, order_id=order_id, status=status))
+
 # Order status constants
 ORDER_STATUS_PENDING = 'pending'
 ORDER_STATUS_COMPLETED = 'completed'
 ORDER_STATUS_CANCELLED = 'cancelled'  # Using British spelling to match database constraint
 
-def calculate_price_change(stock_id):
+# Most values put in one in_() filter: PostgREST takes filters in the
+# request URL, which servers and proxies cap at a few KB
+IN_FILTER_SIZE = int(os.getenv('IN_FILTER_SIZE', '100'))
+
+def chunked(values):
+    """values split into lists of at most IN_FILTER_SIZE, one per in_() filter"""
+    values = list(values)
+    return [values[i:i + IN_FILTER_SIZE] for i in range(0, len(values), IN_FILTER_SIZE)]
+
+def stock_prices_queries(client, stock_ids):
+    """Queries on client for the id and current_price of stock_ids, one per chunk of them"""
+    return [client.table('stocks').select('id, current_price').in_('id', chunk) for chunk in chunked(stock_ids)]
+
+def calculate_price_changes(stocks, quantities):
     """
-    Calculate price change based on market demand and supply
-    Returns the percentage change in price
+    Calculate new prices for stocks based on market demand and supply
+    quantities maps stock_id -> (pending buy quantity, pending sell quantity)
+    Returns (stock_ids, new_prices, changes) for the stocks whose price moved
     """
-    try:
-        # Get pending buy orders (demand)
-        buy_orders = supabase.table('orders')\
-            .select('quantity')\
-            .eq('stock_id', stock_id)\
-            .eq('type', 'buy')\
-            .eq('status', 'pending')\
-            .execute()
-            
-        total_demand = sum(float(order['quantity']) for order in buy_orders.data) if buy_orders.data else 0
-        
-        # Get pending sell orders (supply)
-        sell_orders = supabase.table('orders')\
-            .select('quantity')\
-            .eq('stock_id', stock_id)\
-            .eq('type', 'sell')\
-            .eq('status', 'pending')\
-            .execute()
-            
-        total_supply = sum(float(order['quantity']) for order in sell_orders.data) if sell_orders.data else 0
-        
-        if total_supply == 0:
-            return 0  # No price change if there's no supply
-            
-        # Calculate demand/supply ratio
-        ratio = total_demand / total_supply if total_supply > 0 else 1
-        
-        # Calculate price change percentage (max ±5%)
-        if ratio > 1:  # More demand than supply
-            change = min((ratio - 1) * 2, 0.05)  # Positive change
-        else:  # More supply than demand
-            change = max((ratio - 1) * 2, -0.05)  # Negative change
-            
-        return change
-        
-    except Exception as e:
-        print(f"Error calculating price change: {str(e)}")
-        return 0
+    stock_ids = [stock['id'] for stock in stocks]
+    prices = np.array([float(stock['current_price']) for stock in stocks])
+    demand = np.array([quantities.get(stock_id, (0, 0))[0] for stock_id in stock_ids])
+    supply = np.array([quantities.get(stock_id, (0, 0))[1] for stock_id in stock_ids])
+
+    changes = price_engine.calculate_price_changes(demand, supply)
+    new_prices = price_engine.apply_price_changes(prices, changes)
+
+    # Only update if there's a change
+    moved = np.nonzero(changes)[0]
+    return [stock_ids[i] for i in moved], new_prices[moved], changes[moved]
 
 def update_stock_prices():
     """
     Background thread function to update stock prices based on market demand and supply
+    Pending demand and supply are read from the order books, which hold
+    every pending order. Only stocks with resting sell orders can move, so
+    a tick with none of them costs no queries at all.
     """
     while price_update_running:
         try:
-            # Get all stocks
-            stocks = supabase.table('stocks').select('*').execute()
+            quantities = {
+                stock_id: (buy_quantity, sell_quantity)
+                for stock_id, (buy_quantity, sell_quantity) in matching_engine.pending_quantities().items()
+                if sell_quantity > 0
+            }
             
-            for stock in stocks.data:
-                stock_id = stock['id']
-                current_price = float(stock['current_price'])
-                
-                # Calculate price change based on market conditions
-                change_percentage = calculate_price_change(stock_id)
-                
-                if change_percentage != 0:  # Only update if there's a change
-                    current_price = float(stock['current_price'])
-                    new_price = round(current_price * (1 + change_percentage), 2)
-                    
-                    # Ensure price doesn't go below 1
-                    new_price = max(1.0, new_price)
-                    
-                    # Update stock price in database
-                    supabase.table('stocks').update({
-                        'current_price': str(new_price),
-                        'price_change': str(round(change_percentage * 100, 2))
-                    }).eq('id', stock['id']).execute()
+            if quantities:
+                results = run_concurrently(*(query.execute for query in stock_prices_queries(supabase, quantities)))
+                stocks = [stock for result in results for stock in result.data]
+                stock_ids, new_prices, changes = calculate_price_changes(stocks, quantities)
+
+                if stock_ids:
+                    # Update every changed price in one call
+                    service_supabase.rpc('update_stock_prices', {
+                        'stock_ids_param': stock_ids,
+                        'new_prices_param': [str(price) for price in new_prices.tolist()],
+                        'price_changes_param': [str(change) for change in np.round(changes * 100, 2).tolist()]
+                    }).execute()
+
+                    publish_prices(zip(stock_ids, new_prices.tolist(), np.round(changes * 100, 2).tolist()))
                 
         except Exception as e:
             print(f"Error updating stock prices: {str(e)}")
@@ -200,6 +365,8 @@ def update_order_status(order_id, status, error=None, executed_price=None, execu
         # Add optional fields only if they are provided
         if executed_price is not None:
             update_data['price'] = str(executed_price)  # Use 'price' instead of 'executed_price'
+        if error is not None:
+            update_data['error'] = error
         
         # Execute the update
         print(f"Updating order {order_id} with data: {update_data}")  # Debug log
@@ -213,188 +380,683 @@ def update_order_status(order_id, status, error=None, executed_price=None, execu
     except Exception as e:
         print(f"Error updating order status: {str(e)}")
 
-def process_order(order_id, current_price):
+def apply_settlement(result):
+    """Reflect a successful settlement in the in-memory caches"""
+    quantity = result['quantity']
+    total_amount = to_cents(result['total_amount'])
+    if result['type'] == 'buy':
+        quantity, total_amount = quantity, -total_amount
+    else:
+        quantity, total_amount = -quantity, total_amount
+    leaderboard.apply_fill(result['user_id'], result['stock_id'], quantity, total_amount)
+    portfolios.apply_fill(result['user_id'], result['stock_id'], quantity, total_amount)
+    profile_cache.update(result['user_id'], {'balance': str(result['new_balance'])})
+
+def settle_orders(fills):
     """
-    Process a single order
-    Returns True if order was processed successfully, False otherwise
+    Settle a batch of fills with one call to the settle_orders database
+    function. fills is a list of dicts with buy_order_id, sell_order_id,
+    price, quantity, buy_complete and sell_complete. Both sides of a fill
+    settle or neither does; a rejected side has its order cancelled and the
+    reason written to its error column by the database.
+    Returns one result dict per fill, in the same order: 'success' with
+    the 'buy' and 'sell' settlements, or 'error' and the 'rejected' order ids
     """
+    if not fills:
+        return []
+
+    def call(fills):
+        return service_supabase.rpc('settle_orders', {
+            'fills_param': [
+                {
+                    'buy_order_id': fill['buy_order_id'],
+                    'sell_order_id': fill['sell_order_id'],
+                    'price': str(fill['price']),
+                    'quantity': fill['quantity'],
+                    'buy_complete': fill['buy_complete'],
+                    'sell_complete': fill['sell_complete']
+                }
+                for fill in fills
+            ]
+        }).execute().data
+
     try:
-        # Get order details
-        order = supabase.table('orders').select('*').eq('id', order_id).single().execute()
-        if not order.data:
-            return False
-            
-        order = order.data
-        
-        # Get user's profile
-        user = supabase.table('profiles').select('*').eq('user_id', order['user_id']).single().execute()
-        if not user.data:
-            update_order_status(order_id, ORDER_STATUS_CANCELLED)
-            return False
-            
-        user = user.data
-        balance = float(user['balance'])
-        
-        if order['type'] == 'buy':
-            total_cost = current_price * order['quantity']
-            
-            # Check if user has enough balance
-            if balance < total_cost:
-                update_order_status(order_id, ORDER_STATUS_CANCELLED)
-                return False
-                
-            # Update user's balance
-            new_balance = balance - total_cost
-            supabase.table('profiles').update({'balance': str(new_balance)}).eq('user_id', order['user_id']).execute()
-            
-            # Update or create user's stock holding
-            holdings = supabase.table('user_stocks').select('*').eq('user_id', order['user_id']).eq('stock_id', order['stock_id']).execute()
-            
-            if holdings.data:
-                new_quantity = holdings.data[0]['quantity'] + order['quantity']
-                supabase.table('user_stocks').update({'quantity': new_quantity}).eq('id', holdings.data[0]['id']).execute()
-            else:
-                supabase.table('user_stocks').insert({
-                    'user_id': order['user_id'],
-                    'stock_id': order['stock_id'],
-                    'quantity': order['quantity']
-                }).execute()
-                
-        else:  # sell order
-            # Check if user has enough stocks
-            holdings = supabase.table('user_stocks').select('*').eq('user_id', order['user_id']).eq('stock_id', order['stock_id']).execute()
-            
-            if not holdings.data or holdings.data[0]['quantity'] < order['quantity']:
-                update_order_status(order_id, ORDER_STATUS_CANCELLED)
-                return False
-                
-            total_value = current_price * order['quantity']
-            
-            # Update user's balance
-            new_balance = balance + total_value
-            supabase.table('profiles').update({'balance': str(new_balance)}).eq('user_id', order['user_id']).execute()
-            
-            # Update holdings
-            new_quantity = holdings.data[0]['quantity'] - order['quantity']
-            if new_quantity > 0:
-                supabase.table('user_stocks').update({'quantity': new_quantity}).eq('id', holdings.data[0]['id']).execute()
-            else:
-                supabase.table('user_stocks').delete().eq('id', holdings.data[0]['id']).execute()
-        
-        # Mark order as completed with the current price
-        update_order_status(order_id, ORDER_STATUS_COMPLETED, executed_price=current_price)
-        
-        # Record the transaction
-        supabase.table('transactions').insert({
-            'user_id': order['user_id'],
-            'stock_id': order['stock_id'],
-            'type': order['type'],
-            'quantity': order['quantity'],
-            'price': str(current_price),
-            'total_amount': str(total_value if order['type'] == 'sell' else total_cost),
-            'order_id': order_id,
-            'created_at': datetime.now().isoformat()
-        }).execute()
-        
-        return True
-        
+        results = call(fills)
+    except Exception as e:
+        # Errors here are left to the caller, which retries the batch
+        print(f"Error settling batch of {len(fills)} fills, settling one by one: {str(e)}")
+        results = [call([fill])[0] for fill in fills]
+
+    for result in results:
+        if result['success']:
+            emit_engine_event('settlement', result['buy'])
+            emit_engine_event('settlement', result['sell'])
+    return results
+
+# In-memory order books, one per stock. Orders are matched as soon as
+# place_order receives them; the database is written behind the engine.
+matching_engine = MatchingEngine()
+
+# Closed until the books are rebuilt from the journal and the database, and
+# again while a halt clears them; new orders wait up to INTAKE_WAIT_SECONDS
+# for it, so they keep their time priority behind the orders being loaded
+intake_gate = IntakeGate()
+INTAKE_WAIT_SECONDS = float(os.getenv('INTAKE_WAIT_SECONDS', '10'))
+INTAKE_CLOSED_ERROR = 'Order books are loading, try again shortly'
+
+# Append-only journal of the orders the engine matched, its cancels and
+# which of the resulting events reached the database. Replayed on startup,
+# it rebuilds the books and writes whatever was still queued when the
+# process died. Off unless ORDER_JOURNAL_PATH is set.
+ORDER_JOURNAL_PATH = os.getenv('ORDER_JOURNAL_PATH')
+order_journal = Journal(ORDER_JOURNAL_PATH) if ORDER_JOURNAL_PATH else None
+# The engine loop compacts the journal once it holds this many bytes
+ORDER_JOURNAL_COMPACT_BYTES = int(os.getenv('ORDER_JOURNAL_COMPACT_BYTES', str(16 * 1024 * 1024)))
+
+def journal_cancel(stock_id, order_id):
+    """Cancel an order in the books, and in the journal when there is one"""
+    record = None
+    if order_journal is not None:
+        record = lambda: order_journal.append({'kind': 'cancel', 'stock_id': stock_id, 'order_id': order_id})
+    return matching_engine.cancel(stock_id, order_id, record=record)
+
+# Engine work is split across shards by stock_id: each stock belongs to one
+# shard, which handles its events in order, while different stocks are
+# handled in parallel. ENGINE_SHARD_MAP pins symbols (or stock ids) to a
+# shard, e.g. ENGINE_SHARD_MAP=AAPL=0,TSLA=1; other stocks are hashed.
+ENGINE_SHARDS = int(os.getenv('ENGINE_SHARDS', '4'))
+ENGINE_SHARD_MAP = parse_shard_map(os.getenv('ENGINE_SHARD_MAP'))
+
+def engine_shard_for(stock_id):
+    """Shard pinned to a stock by ENGINE_SHARD_MAP, or None to hash it"""
+    key = str(stock_id).upper()
+    if key in ENGINE_SHARD_MAP:
+        return ENGINE_SHARD_MAP[key]
+    stock = market_snapshot.get(stock_id)
+    return ENGINE_SHARD_MAP.get(stock['symbol'].upper()) if stock else None
+
+# Most events written to the database in one pass of a persistence shard
+PERSIST_BATCH_SIZE = int(os.getenv('PERSIST_BATCH_SIZE', '500'))
+
+def insert_orders(order_rows):
+    """
+    Insert new order rows with one multi-row insert, or one by one if that
+    fails, as the service role since they belong to many users. An order that cannot be inserted on its own is cancelled in the
+    books; if none can be, the error is raised for the caller to retry.
+    """
+    try:
+        # Replayed orders may already be in the table
+        service_supabase.table('orders').upsert(order_rows, ignore_duplicates=True).execute()
+        return
     except Exception as e:
-        error_message = str(e)
-        print(f"Error processing order: {error_message}")
-        update_order_status(order_id, ORDER_STATUS_CANCELLED)
+        if len(order_rows) == 1:
+            raise
+        print(f"Error inserting {len(order_rows)} orders, inserting one by one: {str(e)}")
+
+    failed = []
+    for order_row in order_rows:
+        try:
+            service_supabase.table('orders').upsert(order_row, ignore_duplicates=True).execute()
+        except Exception as e:
+            failed.append((order_row, str(e)))
+    if len(failed) == len(order_rows):
+        raise Exception(failed[-1][1])
+
+    for order_row, error in failed:
+        print(f"Error inserting order {order_row['id']}, cancelling it: {error}")
+        journal_cancel(order_row['stock_id'], order_row['id'])
+        publish_order_update(order_row['user_id'], order_row['id'], ORDER_STATUS_CANCELLED, error=error)
+
+def write_order_events(kind, payloads, filled=None):
+    """
+    Write a run of events of the same kind with one database call
+    filled maps order ids to the quantity the database already has settled
+    for them; fills within it are skipped, so events replayed from the
+    order journal or retried are not settled twice
+    """
+    if kind == 'order':
+        insert_orders(payloads)
+
+    elif kind == 'fill':
+        # Both sides of a fill settle together, so either one shows whether
+        # a replayed fill is already in the database
+        fills = [
+            fill for fill in payloads
+            if filled is None or (
+                filled.get(fill.buy_order.id, 0) < fill.buy_filled
+                and filled.get(fill.sell_order.id, 0) < fill.sell_filled
+            )
+        ]
+
+        # The leaderboard keeps these users' state through a load while
+        # their settlements are on the way
+        user_ids = [book_order.user_id for fill in fills for book_order in (fill.buy_order, fill.sell_order)]
+        emit_engine_event('settling', user_ids)
+        try:
+            results = settle_orders([
+                {
+                    'buy_order_id': fill.buy_order.id,
+                    'sell_order_id': fill.sell_order.id,
+                    'price': fill.price,
+                    'quantity': fill.quantity,
+                    'buy_complete': fill.buy_completed,
+                    'sell_complete': fill.sell_completed
+                }
+                for fill in fills
+            ])
+        finally:
+            emit_engine_event('settled', user_ids)
+        for fill, result in zip(fills, results):
+            sides = [('buy', fill.buy_order), ('sell', fill.sell_order)]
+            if result['success']:
+                for side, book_order in sides:
+                    status = ORDER_STATUS_COMPLETED if result[side]['completed'] else 'partially_filled'
+                    publish_order_update(book_order.user_id, book_order.id, status, price=fill.price, quantity=fill.quantity)
+                continue
+
+            # Neither side settled; the rejected orders were cancelled in the
+            # database, stop matching them. The other side's quantity goes
+            # back to it, it can still trade with someone else.
+            print(f"Fill of orders {fill.buy_order.id} and {fill.sell_order.id} not settled: {result.get('error')}")
+            rejected = set(result['rejected'])
+            for _, book_order in sides:
+                if book_order.id in rejected:
+                    journal_cancel(book_order.stock_id, book_order.id)
+                    publish_order_update(book_order.user_id, book_order.id, ORDER_STATUS_CANCELLED, error=result.get('error'))
+                else:
+                    reinstate_order(book_order, fill)
+
+    elif kind == 'price':
+        # Only the last traded price of each stock matters
+        latest = {}
+        for stock_id, new_price, price_change in payloads:
+            latest[stock_id] = (new_price, price_change)
+
+        service_supabase.rpc('update_stock_prices', {
+            'stock_ids_param': list(latest),
+            'new_prices_param': [str(new_price) for new_price, _ in latest.values()],
+            'price_changes_param': [str(price_change) for _, price_change in latest.values()]
+        }).execute()
+        publish_prices((stock_id, new_price, price_change) for stock_id, (new_price, price_change) in latest.items())
+
+# Attempts at writing a run of events before giving up on it, and the
+# pause before the second attempt (doubled for each one after)
+PERSIST_ATTEMPTS = int(os.getenv('PERSIST_ATTEMPTS', '3'))
+PERSIST_RETRY_SECONDS = float(os.getenv('PERSIST_RETRY_SECONDS', '0.5'))
+
+def filled_for_fills(fills):
+    """filled_quantities of the orders on both sides of fills"""
+    return filled_quantities(sorted({
+        book_order.id
+        for fill in fills
+        for book_order in (fill.buy_order, fill.sell_order)
+    }))
+
+def write_order_events_retrying(kind, payloads, replayed=False):
+    """
+    write_order_events, attempted up to PERSIST_ATTEMPTS times. A failed
+    call may still have settled some fills, so they are checked against
+    the transactions before another attempt, and before the first one for
+    events replayed from the order journal.
+    Returns True once the run is written, False if every attempt failed
+    """
+    filled = None
+    for attempt in range(PERSIST_ATTEMPTS):
+        try:
+            if kind == 'fill' and (attempt or replayed):
+                filled = filled_for_fills(payloads)
+            write_order_events(kind, payloads, filled)
+            return True
+        except Exception as e:
+            print(f"Error persisting {len(payloads)} {kind} events, attempt {attempt + 1} of {PERSIST_ATTEMPTS}: {str(e)}")
+            if attempt + 1 < PERSIST_ATTEMPTS:
+                time.sleep(PERSIST_RETRY_SECONDS * 2 ** attempt)
+    return False
+
+def persist_order_events(events, replayed=False):
+    """
+    Write a batch of one shard's engine events to the database
+    Consecutive events of the same kind are written together, so an order
+    row is always inserted before any of its fills are settled. A run that
+    fails every attempt is dropped, and discarded from the journal so it
+    does not hold back compaction.
+    """
+    written = []
+    discarded = []
+    for kind, run in groupby(events, key=lambda event: event[0]):
+        run = list(run)
+        event_ids = [event_id for _, _, event_id in run if event_id is not None]
+        if write_order_events_retrying(kind, [payload for _, payload, _ in run], replayed):
+            written.extend(event_ids)
+        else:
+            print(f"Dropped {len(run)} {kind} events after {PERSIST_ATTEMPTS} attempts")
+            discarded.extend(event_ids)
+    if written:
+        order_journal.acknowledge(written)
+    if discarded:
+        order_journal.discard(discarded)
+
+# Events waiting to be written to the database, in the order they happened
+# for each stock, each with its journal id ((order seq, index) or None):
+#   ('order', row, id)              - insert a new order row
+#   ('fill', Fill, id)              - settle both sides of a fill
+#   ('price', (stock_id, price, change), id) - record the last traded price
+order_persistence_shards = ShardPool(
+    ENGINE_SHARDS,
+    persist_order_events,
+    batch_size=PERSIST_BATCH_SIZE,
+    assignment=engine_shard_for,
+    name='persistence'
+)
+
+def order_events(order_row, fills, current_price, insert):
+    """
+    Events to persist for a matched order: its row when insert is True, its
+    fills, and the new last price when it traded and current_price is known
+    """
+    events = [('order', order_row)] if insert else []
+    return events + trade_events(order_row['stock_id'], fills, current_price)
+
+def trade_events(stock_id, fills, current_price):
+    """Events to persist for fills: each fill, then the new last price when current_price is known"""
+    events = [('fill', fill) for fill in fills]
+    if fills and current_price is not None:
+        last_price = fills[-1].price
+        price_change = round((last_price - current_price) / current_price * 100, 2) if current_price else 0
+        events.append(('price', (stock_id, last_price, price_change)))
+    return events
+
+def queue_order_events(stock_id, events, journaled):
+    """
+    Hand the events of a matching step to the persistence shards, once its
+    journal record (if any) is flushed
+    """
+    if journaled:
+        # Durable before anyone hears of it; concurrent orders share the flush
+        order_journal.commit()
+        order_journal.expect(journaled[0], len(events))
+
+    fills = [payload for kind, payload in events if kind == 'fill']
+    if fills:
+        emit_engine_event('trades', {
+            'stock_id': stock_id,
+            'trades': [{'price': fill.price, 'quantity': fill.quantity} for fill in fills]
+        })
+
+    for index, (kind, payload) in enumerate(events):
+        event_id = [journaled[0], index] if journaled else None
+        order_persistence_shards.submit(stock_id, (kind, payload, event_id))
+
+def submit_order(order_row, current_price, insert=True, remaining=None):
+    """
+    Match a new order in memory and queue its fills, and the order row
+    itself when insert is True, for persistence
+    remaining is the quantity left of an order reloaded after partial fills
+    Returns the list of fills
+    """
+    book_order = BookOrder(
+        order_row['id'],
+        order_row['user_id'],
+        order_row['stock_id'],
+        order_row['type'],
+        order_row['quantity'],
+        order_row['price'],
+        order_row['created_at'],
+        remaining
+    )
+
+    journaled = []
+    record = None
+    if order_journal is not None:
+        record = lambda: journaled.append(order_journal.append({
+            'kind': 'order',
+            'order': order_row,
+            'insert': insert,
+            'remaining': remaining,
+            'current_price': current_price
+        }, events=True))
+
+    fills = matching_engine.submit(book_order, record=record)
+    if fills is None:
+        # Already in the books
+        return []
+
+    queue_order_events(order_row['stock_id'], order_events(order_row, fills, current_price, insert), journaled)
+    return fills
+
+def fill_key(fill):
+    """Identifies a fill across a journal replay, which matches the same way"""
+    return [fill.buy_order.id, fill.sell_order.id, fill.buy_filled, fill.sell_filled]
+
+def reinstate_order(book_order, fill):
+    """
+    Give an order back the quantity of a fill that was rolled back because
+    the other side was rejected, and queue the fills it gets if it matches
+    again
+    """
+    stock = market_snapshot.get(book_order.stock_id)
+    current_price = stock['current_price'] if stock else None
+
+    journaled = []
+    record = None
+    if order_journal is not None:
+        record = lambda: journaled.append(order_journal.append({
+            'kind': 'reinstate',
+            'stock_id': book_order.stock_id,
+            'order_id': book_order.id,
+            'quantity': fill.quantity,
+            'fill': fill_key(fill),
+            'current_price': current_price
+        }, events=True))
+
+    fills = matching_engine.reinstate(book_order, fill.quantity, record=record)
+    queue_order_events(book_order.stock_id, trade_events(book_order.stock_id, fills, current_price), journaled)
+    publish_order_update(book_order.user_id, book_order.id, ORDER_STATUS_PENDING, reinstated=fill.quantity)
+
+def filled_quantities(order_ids):
+    """
+    Quantity settled so far for each order, from transactions: {order_id: quantity}
+    The orders are looked up IN_FILTER_SIZE at a time, concurrently, as the
+    service role so row level security does not hide other users' rows
+    """
+    filled = {}
+    results = run_concurrently(*(
+        service_supabase.table('transactions').select('order_id, quantity').in_('order_id', chunk).execute
+        for chunk in chunked(order_ids)
+    ))
+    for transactions in results:
+        for transaction in transactions.data:
+            filled[transaction['order_id']] = filled.get(transaction['order_id'], 0) + transaction['quantity']
+    return filled
+
+def load_order_books():
+    """
+    Rebuild the in-memory order books from pending orders in the database
+    Quantity already filled (recorded in transactions) is subtracted so
+    partially filled orders rest with what is left of them
+    """
+    stocks = supabase.table('stocks').select('id').execute()
+    loaded = 0
+
+    for stock in stocks.data:
+        # Use rpc call to bypass RLS
+        pending_orders = service_supabase.rpc('get_pending_orders', {
+            'stock_id_param': stock['id']
+        }).execute()
+
+        if not pending_orders.data:
+            continue
+
+        filled = filled_quantities([order['id'] for order in pending_orders.data])
+
+        # get_pending_orders returns orders oldest first, preserving time priority
+        for order in pending_orders.data:
+            remaining = order['quantity'] - filled.get(order['id'], 0)
+            if remaining <= 0:
+                continue
+
+            # Orders already in the books, e.g. from the journal, are skipped
+            submit_order(order, None, insert=False, remaining=remaining)
+            loaded += 1
+
+    print(f"Loaded {loaded} pending orders into the order books")
+
+def recover_order_journal():
+    """
+    Rebuild the order books by replaying the order journal through the
+    engine, which matches them exactly as before, then write the events
+    that had not reached the database when the process stopped and
+    compact the journal
+    Returns False if the journal was empty
+    """
+    records = order_journal.records()
+    if not records:
         return False
 
+    # Events written, or given up on, before the process stopped
+    persisted = set()
+    # Fills already rolled back, whose quantity was given back to an order
+    reinstated = set()
+    for record in records:
+        if record['kind'] in ('persisted', 'discarded'):
+            persisted.update(tuple(event_id) for event_id in record['events'])
+        elif record['kind'] == 'reinstate':
+            reinstated.add(tuple(record['fill']))
+
+    unwritten = []
+    book_orders = {}
+    for record in records:
+        kind = record['kind']
+        if kind == 'resting':
+            book_order = book_orders[record['order']['order_id']] = BookOrder(**record['order'])
+            matching_engine.submit(book_order)
+        elif kind == 'order':
+            order_row = record['order']
+            book_order = BookOrder(
+                order_row['id'],
+                order_row['user_id'],
+                order_row['stock_id'],
+                order_row['type'],
+                order_row['quantity'],
+                order_row['price'],
+                order_row['created_at'],
+                record['remaining']
+            )
+            book_orders[book_order.id] = book_order
+            fills = matching_engine.submit(book_order) or []
+            events = order_events(order_row, fills, record['current_price'], record['insert'])
+            unwritten.extend(unwritten_events(record['seq'], events, persisted, reinstated))
+        elif kind == 'reinstate':
+            book_order = book_orders.get(record['order_id'])
+            if book_order is None:
+                print(f"Order {record['order_id']} to reinstate is not in the order journal")
+                continue
+            fills = matching_engine.reinstate(book_order, record['quantity'])
+            events = trade_events(record['stock_id'], fills, record['current_price'])
+            unwritten.extend(unwritten_events(record['seq'], events, persisted, reinstated))
+        elif kind == 'cancel':
+            matching_engine.cancel(record['stock_id'], record['order_id'])
+        elif kind == 'clear':
+            matching_engine.clear()
+
+    # Outstanding until written or discarded, like the events of a live order
+    for seq, run in groupby(unwritten, key=lambda event: event[2][0]):
+        order_journal.expect(seq, len(list(run)))
+    persist_order_events(unwritten, replayed=True)
+
+    compact_order_journal()
+    print(f"Recovered the order books from {len(records)} journal records, {len(unwritten)} events were unwritten")
+    return True
+
+def unwritten_events(seq, events, persisted, reinstated):
+    """
+    The (kind, payload, event id) of the events of journal record seq that
+    are not in persisted, leaving out fills that were given back
+    """
+    return [
+        (kind, payload, [seq, index])
+        for index, (kind, payload) in enumerate(events)
+        if (seq, index) not in persisted
+        and not (kind == 'fill' and tuple(fill_key(payload)) in reinstated)
+    ]
+
+def compact_order_journal():
+    """
+    Shrink the journal to a snapshot of the resting orders, once every
+    event it covers is in the database. Records are appended under the
+    book locks, so holding them all keeps the snapshot in step with the
+    journal it replaces.
+    """
+    with matching_engine.frozen() as resting:
+        if order_journal.outstanding:
+            return
+        order_journal.compact([
+            {
+                'kind': 'resting',
+                'order': {
+                    'order_id': order.id,
+                    'user_id': order.user_id,
+                    'stock_id': order.stock_id,
+                    'side': order.side,
+                    'quantity': order.quantity,
+                    'price': order.price,
+                    'created_at': order.created_at,
+                    'remaining': order.remaining
+                }
+            }
+            for order in resting
+        ])
+
+def trim_order_journal():
+    """
+    Compact the journal while trading goes on, so it and the replay at the
+    next start stay bounded. With events still being written, intake closes
+    for the persistence shards to catch up, as for a halt, and reopens once
+    the journal is compacted.
+    """
+    if not order_journal.outstanding:
+        compact_order_journal()
+        return
+
+    intake_gate.close()
+    try:
+        order_persistence_shards.join()
+        compact_order_journal()
+    finally:
+        intake_gate.open()
+
+def accept_order(order, current_price):
+    """
+    Hand a new order to the matching engine
+    Inline, it is matched right away and the fills are returned. In worker
+    mode it is inserted as pending for the worker to pick up, and no fills
+    are returned.
+    Raises IntakeClosed if the books do not open within INTAKE_WAIT_SECONDS
+    """
+    if ENGINE_MODE == 'inline':
+        with intake_gate.admit(INTAKE_WAIT_SECONDS):
+            return submit_order(order, current_price)
+
+    supabase.table('orders').insert(order).execute()
+    return []
+
+def accept_orders(orders, prices):
+    """
+    accept_order for a batch, with current prices by stock_id; in worker
+    mode the orders are written with one multi-row insert
+    Returns (fills, error) for each order, error being None unless it
+    failed: a failed order does not keep the rest of the batch from going
+    through, so each one's outcome is reported on its own
+    Raises IntakeClosed, as accept_order, if the books are not open in time
+    """
+    if ENGINE_MODE == 'inline':
+        with intake_gate.admit(INTAKE_WAIT_SECONDS):
+            return [submit_batch_order(order, prices[order['stock_id']]) for order in orders]
+
+    try:
+        if orders:
+            supabase.table('orders').insert(orders).execute()
+    except Exception as e:
+        # One insert, nothing was written
+        print(f"Error inserting {len(orders)} orders: {str(e)}")
+        return [([], str(e)) for _ in orders]
+    return [([], None) for _ in orders]
+
+def submit_batch_order(order, current_price):
+    """submit_order for an order of a batch, returns (fills, error)"""
+    try:
+        return submit_order(order, current_price), None
+    except Exception as e:
+        print(f"Error placing order {order['id']}: {str(e)}")
+        return [], str(e)
+
+# Written to the error column of orders cancelled by a market halt
+MARKET_CLOSED_REASON = 'Market closed'
+
+def cancel_pending_orders(reason):
+    """
+    Cancel every pending order with one database update, stamping reason
+    into their error column
+    Returns the number of orders cancelled; raises if the update failed
+    """
+    cancelled = service_supabase.rpc('cancel_pending_orders', {'reason_param': reason}).execute().data
+    if cancelled:
+        print(f"Cancelled {cancelled} pending orders: {reason}")
+    return cancelled or 0
+
+def halt_order_books():
+    """
+    Empty the books and cancel every pending order, once per market halt.
+    Intake closes first and the fills already matched are written before
+    the cancel, so they settle rather than being cancelled with the rest.
+    Raises if the cancel failed; calling it again retries it.
+    """
+    intake_gate.close()
+    order_persistence_shards.join()
+    matching_engine.clear()
+    cancel_pending_orders(MARKET_CLOSED_REASON)
+    if order_journal is not None:
+        order_journal.append({'kind': 'clear'})
+        order_journal.commit()
+        compact_order_journal()
+
 def process_pending_orders():
     """
-    Background thread function to process pending orders
+    Background thread function that keeps the order books in line with the
+    market state, and the order journal compacted. Matching itself happens
+    as orders are submitted.
     """
+    # Replay the journal first, whatever the market state, so the events it
+    # holds reach the database. Inline, every order reaches the books through
+    # this process and the journal has them all; orders inserted for the
+    # worker while it was down are only in the database.
+    recovered = order_journal is not None and recover_order_journal()
+    books_loaded = recovered and ENGINE_MODE == 'inline'
+    halted = False
+
     while True:
         try:
             if not check_market_state():
-                # Cancel all pending orders if market is closed
-                pending_orders = supabase.table('orders').select('*').eq('status', ORDER_STATUS_PENDING).execute()
-                for order in pending_orders.data:
-                    update_order_status(order['id'], ORDER_STATUS_CANCELLED)
-                time.sleep(30)  # Wait longer when market is closed
+                if not halted:
+                    # The books are empty from here on, even if the cancel
+                    # fails and is retried on the next pass
+                    books_loaded = False
+                    halt_order_books()
+                    halted = True
+                market_state.wait(30)  # Wait longer when market is closed
                 continue
 
-            # Get all stocks to process orders stock by stock
-            stocks = supabase.table('stocks').select('*').execute()
-            
-            for stock in stocks.data:
-                stock_id = stock['id']
-                current_price = float(stock['current_price'])
-                
-                # Get all pending orders for this stock
-                # Use rpc call to bypass RLS
-                pending_orders = supabase.rpc('get_pending_orders', {
-                    'stock_id_param': stock_id
-                }).execute()
-                
-                if not pending_orders.data:
-                    continue
-                
-                print(f"Processing {len(pending_orders.data)} orders for stock {stock['symbol']}")
-                
-                # Wait for 2 minutes to collect orders
-                time.sleep(120)
-                
-                # Get updated list of orders after waiting
-                pending_orders = supabase.rpc('get_pending_orders', {
-                    'stock_id_param': stock_id
-                }).execute()
-                
-                if not pending_orders.data:
-                    continue
-                
-                # Process all pending orders for this stock
-                total_buy_quantity = 0
-                total_sell_quantity = 0
-                
-                # First pass: calculate total buy and sell quantities
-                for order in pending_orders.data:
-                    if order['type'] == 'buy':
-                        total_buy_quantity += order['quantity']
-                    else:
-                        total_sell_quantity += order['quantity']
-                
-                # Calculate new price based on supply and demand
-                price_change = 0
-                if total_buy_quantity > total_sell_quantity:
-                    # More demand than supply, price goes up
-                    price_change = 0.01 * (total_buy_quantity - total_sell_quantity) / 1000
-                elif total_sell_quantity > total_buy_quantity:
-                    # More supply than demand, price goes down
-                    price_change = -0.01 * (total_sell_quantity - total_buy_quantity) / 1000
-                
-                new_price = round(current_price * (1 + price_change), 2)
-                new_price = max(1.0, new_price)  # Ensure price doesn't go below 1
-                
-                # Update stock price using rpc call
-                supabase.rpc('update_stock_price', {
-                    'stock_id_param': stock_id,
-                    'new_price_param': str(new_price),
-                    'price_change_param': str(round(price_change * 100, 2))
-                }).execute()
-                
-                # Second pass: process all orders with the new price
-                for order in pending_orders.data:
-                    success = process_order(order['id'], new_price)
-                    if success:
-                        print(f"Successfully processed order {order['id']}")
-                    else:
-                        print(f"Failed to process order {order['id']}")
-                
+            halted = False
+            if not books_loaded:
+                load_order_books()
+                books_loaded = True
+            intake_gate.open()
+
+            if order_journal is not None and order_journal.size > ORDER_JOURNAL_COMPACT_BYTES:
+                trim_order_journal()
+
         except Exception as e:
             print(f"Error in order processing thread: {str(e)}")
             
-        time.sleep(5)  # Small delay before next iteration
+        market_state.wait(5)  # Small delay before next iteration, cut short by a halt
 
-# Start both price update and order processing threads
+# Price update and order processing threads
 price_update_thread = Thread(target=update_stock_prices, daemon=True)
 order_processing_thread = Thread(target=process_pending_orders, daemon=True)
-price_update_thread.start()
-order_processing_thread.start()
+
+def start_engines():
+    """Start the engine threads, in this process or in worker.py"""
+    if service_supabase is None:
+        raise Exception("SUPABASE_SERVICE_KEY environment variable not found")
+    if ENGINE_SHARD_MAP and market_snapshot.needs_refresh:
+        # Symbols are needed to put pinned stocks on their shards
+        try:
+            market_snapshot.load(supabase.table('stocks').select('*').execute().data)
+        except Exception as e:
+            print(f"Error loading stocks for shard assignment: {str(e)}")
+    price_update_thread.start()
+    order_processing_thread.start()
+    order_persistence_shards.start()
 
 # Auth Routes
 @app.route('/api/auth/register', methods=['POST'])
@@ -442,6 +1104,8 @@ def register():
         
         # Insert profile
         profile_response = supabase.table('profiles').insert(user_data).execute()
+        profile_cache.invalidate(response.user.id)
+        leaderboard.add_user(response.user.id, email, user_data['balance'])
         
         # If user is admin, add initial stock holdings
         if role == 'admin':
@@ -492,25 +1156,27 @@ def login():
 # Market Control Routes (Admin Only)
 def check_market_state():
     """
-    Check if the market is currently active
+    Check if the market is currently active, from the in-memory market state
+    when it is fresh enough
     Returns True if market is active, False otherwise
     """
-    try:
-        market_state = supabase.table('market_state').select('*').single().execute()
-        return market_state.data['is_active'] if market_state.data else False
-    except Exception as e:
-        print(f"Error checking market state: {str(e)}")
-        return False
+    if market_state.needs_refresh:
+        try:
+            result = supabase.table('market_state').select('*').single().execute()
+            market_state.set(result.data['is_active'] if result.data else False)
+        except Exception as e:
+            print(f"Error checking market state: {str(e)}")
+    return bool(market_state.is_active)
 
 @app.route('/api/market/state', methods=['GET'])
 @admin_required
 def get_market_state():
     """Get current market state"""
     try:
-        market_state = supabase.table('market_state').select('*').single().execute()
+        is_active = check_market_state()
         return jsonify({
-            'is_active': market_state.data['is_active'] if market_state.data else False,
-            'message': 'Market is currently ' + ('active' if market_state.data and market_state.data['is_active'] else 'inactive')
+            'is_active': is_active,
+            'message': 'Market is currently ' + ('active' if is_active else 'inactive')
         })
     except Exception as e:
         print(f"Error getting market state: {str(e)}")
@@ -531,7 +1197,10 @@ def control_market():
         
         if not result.data:
             return jsonify({'error': 'Failed to update market state'}), 500
-            
+
+        # Other processes hear about it from the market_state_notify trigger
+        market_state.set(new_state)
+
         return jsonify({
             'message': f'Market {"started" if new_state else "stopped"} successfully',
             'is_active': new_state
@@ -541,12 +1210,28 @@ def control_market():
         return jsonify({'error': str(e)}), 500
 
 # Stock Routes
+def stocks_body(symbols):
+    """(ETag, JSON body) of GET /api/stocks from the market snapshot, only for symbols when given"""
+    if symbols:
+        return market_snapshot.select(symbol for symbol in symbols.split(',') if symbol)
+    return market_snapshot.current()
+
 @app.route('/api/stocks', methods=['GET'])
 @token_required
 def get_stocks(current_user):
+    """
+    Get all stocks, or only ?symbols=AAPL,MSFT, from the market snapshot
+    Answers 304 Not Modified when the client's ETag is still current
+    """
     try:
-        stocks = supabase.table('stocks').select('*').execute()
-        return jsonify(stocks.data)
+        if market_snapshot.needs_refresh:
+            stocks = supabase.table('stocks').select('*').execute()
+            market_snapshot.load(stocks.data)
+
+        etag, body = stocks_body(request.args.get('symbols'))
+        response = app.response_class(body, mimetype='application/json')
+        response.set_etag(etag)
+        return response.make_conditional(request)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -567,14 +1252,14 @@ def buy_stock(current_user):
             return jsonify({'error': 'Stock not found'}), 404
             
         stock = stock.data[0]
-        total_cost = float(stock['current_price']) * quantity
+        total_cost = to_cents(stock['current_price']) * quantity
         
         # Get user's balance
         user = supabase.table('profiles').select('balance').eq('user_id', current_user['user_id']).execute()
         if not user.data:
             return jsonify({'error': 'User not found'}), 404
             
-        balance = float(user.data[0]['balance'])
+        balance = to_cents(user.data[0]['balance'])
         
         if balance < total_cost:
             return jsonify({'error': 'Insufficient balance'}), 400
@@ -591,8 +1276,8 @@ def buy_stock(current_user):
         }
         
         # Update user's balance and stock holdings
-        new_balance = balance - total_cost
-        supabase.table('profiles').update({'balance': str(new_balance)}).eq('user_id', current_user['user_id']).execute()
+        new_balance = from_cents(balance - total_cost)
+        update_profile_balance(current_user['user_id'], new_balance)
         
         # Update or create user's stock holding
         holdings = supabase.table('user_stocks').select('*').eq('user_id', current_user['user_id']).eq('stock_id', stock_id).execute()
@@ -606,6 +1291,8 @@ def buy_stock(current_user):
                 'stock_id': stock_id,
                 'quantity': quantity
             }).execute()
+        leaderboard.apply_fill(current_user['user_id'], stock_id, quantity, -total_cost)
+        portfolios.apply_fill(current_user['user_id'], stock_id, quantity, -total_cost)
             
         # Record the transaction
         supabase.table('transactions').insert(order).execute()
@@ -635,7 +1322,7 @@ def sell_stock(current_user):
             return jsonify({'error': 'Stock not found'}), 404
             
         stock = stock.data[0]
-        total_value = float(stock['current_price']) * quantity
+        total_value = to_cents(stock['current_price']) * quantity
         
         # Check if user has enough stocks
         holdings = supabase.table('user_stocks').select('*').eq('user_id', current_user['user_id']).eq('stock_id', stock_id).execute()
@@ -645,7 +1332,7 @@ def sell_stock(current_user):
             
         # Get user's current balance
         user = supabase.table('profiles').select('balance').eq('user_id', current_user['user_id']).execute()
-        current_balance = float(user.data[0]['balance'])
+        current_balance = to_cents(user.data[0]['balance'])
         
         # Create sell order
         order = {
@@ -659,8 +1346,8 @@ def sell_stock(current_user):
         }
         
         # Update user's balance and stock holdings
-        new_balance = current_balance + total_value
-        supabase.table('profiles').update({'balance': str(new_balance)}).eq('user_id', current_user['user_id']).execute()
+        new_balance = from_cents(current_balance + total_value)
+        update_profile_balance(current_user['user_id'], new_balance)
         
         # Update holdings
         new_quantity = holdings.data[0]['quantity'] - quantity
@@ -668,6 +1355,8 @@ def sell_stock(current_user):
             supabase.table('user_stocks').update({'quantity': new_quantity}).eq('id', holdings.data[0]['id']).execute()
         else:
             supabase.table('user_stocks').delete().eq('id', holdings.data[0]['id']).execute()
+        leaderboard.apply_fill(current_user['user_id'], stock_id, -quantity, total_value)
+        portfolios.apply_fill(current_user['user_id'], stock_id, -quantity, total_value)
             
         # Record the transaction
         supabase.table('transactions').insert(order).execute()
@@ -681,112 +1370,430 @@ def sell_stock(current_user):
         return jsonify({'error': str(e)}), 500
 
 # Orders Routes
+def validate_order_request(data):
+    """Check an order request body, returns an error message or None"""
+    if not data:
+        return 'No data provided'
+        
+    required_fields = ['stock_id', 'type', 'quantity']
+    if not all(field in data for field in required_fields):
+        return 'Missing required fields'
+        
+    # Validate order type
+    if data['type'] not in ['buy', 'sell']:
+        return 'Invalid order type'
+    return None
+
+def build_order(user_id, data, current_price):
+    """
+    Build a new pending order row from a validated request body
+    The optional limit price defaults to the current market price
+    Raises ValueError for an invalid price or quantity
+    """
+    try:
+        price = round(float(data.get('price', current_price)), 2)
+        quantity = int(data['quantity'])
+    except (TypeError, ValueError):
+        raise ValueError('Invalid price or quantity')
+
+    if price <= 0 or quantity <= 0:
+        raise ValueError('Invalid price or quantity')
+
+    return {
+        'id': str(uuid.uuid4()),
+        'user_id': user_id,
+        'stock_id': data['stock_id'],
+        'type': data['type'],
+        'quantity': quantity,
+        'price': price,
+        'status': ORDER_STATUS_PENDING,
+        'created_at': datetime.now().isoformat()
+    }
+
+def order_placed_response(order, fills):
+    """Response body for a newly placed order and the fills it got"""
+    filled_quantity = sum(fill.quantity for fill in fills)
+    return {
+        'message': 'Order placed successfully',
+        'order_id': order['id'],
+        'status': ORDER_STATUS_COMPLETED if filled_quantity == order['quantity'] else ORDER_STATUS_PENDING,
+        'filled_quantity': filled_quantity,
+        'fills': [{'quantity': fill.quantity, 'price': fill.price} for fill in fills]
+    }
+
+# Most orders accepted by one POST /api/orders/batch
+ORDERS_BATCH_MAX = int(os.getenv('ORDERS_BATCH_MAX', '500'))
+
+def parse_order_batch(data):
+    """The items of a batch order request body, raises RequestError if there are none or too many"""
+    items = data.get('orders') if isinstance(data, dict) else None
+    if not isinstance(items, list) or not items:
+        raise RequestError('No orders provided')
+    if len(items) > ORDERS_BATCH_MAX:
+        raise RequestError(f'Too many orders, at most {ORDERS_BATCH_MAX} per batch')
+    return items
+
+def batch_stock_id(item):
+    """The stock_id of a batch item in canonical form, or None if it is not a UUID"""
+    try:
+        return str(uuid.UUID(str(item['stock_id'])))
+    except (KeyError, TypeError, ValueError):
+        return None
+
+def batch_stock_ids(items):
+    """Distinct stock_ids referenced by the items of a batch, for one stocks query"""
+    return list({batch_stock_id(item) for item in items if isinstance(item, dict)} - {None})
+
+def price_map(stocks):
+    """Current prices by stock_id from stocks rows with id and current_price"""
+    return {stock['id']: float(stock['current_price']) for stock in stocks}
+
+def build_order_batch(user_id, items, prices):
+    """
+    Validate and build the orders of a batch, given current prices by stock_id
+    Returns one (order, None) or (None, error message) per item, in order
+    """
+    entries = []
+    for item in items:
+        error = validate_order_request(item) if isinstance(item, dict) else 'Invalid order'
+        if error:
+            entries.append((None, error))
+            continue
+        stock_id = batch_stock_id(item)
+        if stock_id not in prices:
+            entries.append((None, 'Stock not found'))
+            continue
+        try:
+            entries.append((build_order(user_id, dict(item, stock_id=stock_id), prices[stock_id]), None))
+        except ValueError as e:
+            entries.append((None, str(e)))
+    return entries
+
+def order_batch_response(entries, outcomes):
+    """
+    Response body for a batch: a result per item, with the outcome (fills,
+    error) from accept_orders of each built order in turn
+    """
+    outcomes = iter(outcomes)
+    results = []
+    for order, error in entries:
+        if order:
+            fills, error = next(outcomes)
+        results.append({'error': error} if error else order_placed_response(order, fills))
+    accepted = sum(1 for result in results if 'error' not in result)
+    return {'results': results, 'accepted': accepted, 'rejected': len(entries) - accepted}
+
+def format_order(order):
+    """Format an order row joined with stocks(symbol) for the API"""
+    return {
+        'id': order['id'],
+        'stock_symbol': order['stocks']['symbol'],
+        'type': order['type'],
+        'quantity': order['quantity'],
+        'price': float(order['price']),
+        'status': order['status'],
+        'created_at': order['created_at']
+    }
+
+MARKET_CLOSED_ERROR = 'Market is currently closed. Orders cannot be placed.'
+
+def check_order_request(data):
+    """Validate a POST /api/orders body, raises RequestError"""
+    error = validate_order_request(data)
+    if error:
+        raise RequestError(error)
+
+def require_market_open(market_active):
+    """Refuse orders while the market is closed, raises RequestError (403)"""
+    if not market_active:
+        raise RequestError(MARKET_CLOSED_ERROR, 403)
+
+def new_order(user_id, data, stock):
+    """
+    Build the order of a checked POST /api/orders body, given its stocks
+    row (with current_price) or None if there is no such stock
+    Returns (order, current_price); raises RequestError
+    """
+    if not stock:
+        raise RequestError('Stock not found', 404)
+    current_price = float(stock['current_price'])
+    try:
+        return build_order(user_id, data, current_price), current_price
+    except ValueError as e:
+        raise RequestError(str(e))
+
 @app.route('/api/orders', methods=['POST'])
 @token_required
 def place_order(current_user):
     try:
-        # Check if market is active
-        if not check_market_state():
-            return jsonify({'error': 'Market is currently closed. Orders cannot be placed.'}), 403
-
         data = request.get_json()
-        if not data:
-            return jsonify({'error': 'No data provided'}), 400
-            
-        required_fields = ['stock_id', 'type', 'quantity']
-        if not all(field in data for field in required_fields):
-            return jsonify({'error': 'Missing required fields'}), 400
-            
-        # Validate order type
-        if data['type'] not in ['buy', 'sell']:
-            return jsonify({'error': 'Invalid order type'}), 400
-            
+        check_order_request(data)
+        require_market_open(check_market_state())
+
         # Get current stock price
         stock = supabase.table('stocks').select('current_price').eq('id', data['stock_id']).single().execute()
-        if not stock.data:
-            return jsonify({'error': 'Stock not found'}), 404
-            
-        current_price = stock.data['current_price']
-            
-        # Create order
-        order = {
-            'user_id': current_user['user_id'],
-            'stock_id': data['stock_id'],
-            'type': data['type'],
-            'quantity': data['quantity'],
-            'price': current_price,  # Add current price
-            'status': ORDER_STATUS_PENDING,
-            'created_at': datetime.now().isoformat()
-        }
-        
-        result = supabase.table('orders').insert(order).execute()
-        
-        return jsonify({
-            'message': 'Order placed successfully',
-            'order_id': result.data[0]['id']
-        })
-        
+        order, current_price = new_order(current_user['user_id'], data, stock.data)
+
+        # Match against the order book; the insert and settlement are written behind
+        fills = accept_order(order, current_price)
+        return jsonify(order_placed_response(order, fills))
+
+    except RequestError as e:
+        return jsonify({'error': e.message}), e.status
+    except IntakeClosed:
+        return jsonify({'error': INTAKE_CLOSED_ERROR}), 503
     except Exception as e:
         print(f"Error placing order: {str(e)}")  # Add error logging
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/orders/batch', methods=['POST'])
+@token_required
+def place_orders(current_user):
+    """
+    Place up to ORDERS_BATCH_MAX orders at once: {"orders": [{stock_id, type,
+    quantity, price}, ...]}. The market state is checked and the prices are
+    read once for the batch. Returns a result per order, in order: the
+    placed order as from POST /api/orders, or its error.
+    """
+    try:
+        items = parse_order_batch(request.get_json())
+        require_market_open(check_market_state())
+
+        queries = stock_prices_queries(supabase, batch_stock_ids(items))
+        results = run_concurrently(*(query.execute for query in queries))
+        prices = price_map(stock for result in results for stock in result.data)
+
+        entries = build_order_batch(current_user['user_id'], items, prices)
+        orders = [order for order, _ in entries if order]
+        outcomes = accept_orders(orders, prices)
+        return jsonify(order_batch_response(entries, outcomes))
+
+    except RequestError as e:
+        return jsonify({'error': e.message}), e.status
+    except IntakeClosed:
+        return jsonify({'error': INTAKE_CLOSED_ERROR}), 503
+    except Exception as e:
+        print(f"Error placing orders: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+# Page size of GET /api/orders, and the most a client may ask for
+ORDERS_PAGE_SIZE = int(os.getenv('ORDERS_PAGE_SIZE', '50'))
+ORDERS_PAGE_MAX = int(os.getenv('ORDERS_PAGE_MAX', '200'))
+
+def encode_order_cursor(order):
+    """Opaque cursor pointing just after an order in (created_at, id) order"""
+    return base64.urlsafe_b64encode(json.dumps([order['created_at'], order['id']]).encode()).decode()
+
+def decode_order_cursor(cursor):
+    """Returns (created_at, id), raising ValueError for a malformed cursor"""
+    try:
+        created_at, order_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        uuid.UUID(order_id)
+    except Exception:
+        raise ValueError('Invalid cursor')
+    if not isinstance(created_at, str) or '"' in created_at:
+        raise ValueError('Invalid cursor')
+    return created_at, order_id
+
+def parse_order_date(value):
+    """
+    Parse a from or to param of GET /api/orders: (date, None) for a date
+    without a time, e.g. 2024-01-05 or 2024-1-5, otherwise (None, datetime)
+    for an ISO date and time, which may end in Z. Raises ValueError.
+    """
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date(), None
+    except ValueError:
+        pass
+    if value.endswith(('Z', 'z')):
+        value = value[:-1] + '+00:00'
+    return None, datetime.fromisoformat(value)
+
+def parse_order_query(args):
+    """
+    Read the filters and page of GET /api/orders from its query params:
+    status, type, stock_id, from and to (ISO dates on created_at), limit
+    and cursor. A to without a time covers that whole day: it becomes a
+    'before' bound of the next midnight. Raises ValueError for invalid values.
+    Returns (filters, limit, cursor)
+    """
+    filters = {}
+    status = args.get('status')
+    if status:
+        if status not in (ORDER_STATUS_PENDING, ORDER_STATUS_COMPLETED, ORDER_STATUS_CANCELLED):
+            raise ValueError('Invalid status')
+        filters['status'] = status
+    order_type = args.get('type')
+    if order_type:
+        if order_type not in ('buy', 'sell'):
+            raise ValueError('Invalid order type')
+        filters['type'] = order_type
+    stock_id = args.get('stock_id')
+    if stock_id:
+        try:
+            filters['stock_id'] = str(uuid.UUID(stock_id))
+        except ValueError:
+            raise ValueError('Invalid stock_id')
+    for param in ('from', 'to'):
+        value = args.get(param)
+        if value:
+            try:
+                day, moment = parse_order_date(value)
+            except ValueError:
+                raise ValueError(f'Invalid {param} date')
+            if moment is not None:
+                filters[param] = moment.isoformat()
+            elif param == 'to':
+                filters['before'] = (day + timedelta(days=1)).isoformat()
+            else:
+                filters[param] = day.isoformat()
+
+    try:
+        limit = int(args.get('limit', ORDERS_PAGE_SIZE))
+    except ValueError:
+        raise ValueError('Invalid limit')
+    limit = min(max(limit, 1), ORDERS_PAGE_MAX)
+
+    cursor = args.get('cursor')
+    return filters, limit, decode_order_cursor(cursor) if cursor else None
+
+def build_orders_query(query, user_id, filters, limit, cursor):
+    """
+    Apply a user's order filters and keyset page, newest first, to an
+    orders select. One extra row is requested to tell if there is a next page.
+    """
+    query = query.eq('user_id', user_id)
+    for column in ('status', 'type', 'stock_id'):
+        if column in filters:
+            query = query.eq(column, filters[column])
+    if 'from' in filters:
+        query = query.gte('created_at', filters['from'])
+    if 'to' in filters:
+        query = query.lte('created_at', filters['to'])
+    if 'before' in filters:
+        query = query.lt('created_at', filters['before'])
+    if cursor:
+        created_at, order_id = cursor
+        # (created_at, id) < cursor; this postgrest client has no or_() helper
+        query.params = query.params.add(
+            'or', f'(created_at.lt."{created_at}",and(created_at.eq."{created_at}",id.lt.{order_id}))'
+        )
+    # One order param, created_at.desc,id.desc: PostgREST does not combine repeated ones
+    return query.order('created_at.desc,id', desc=True).limit(limit + 1)
+
+def orders_page(rows, limit):
+    """
+    Format a page of orders fetched by build_orders_query
+    Returns (orders, cursor of the next page or None)
+    """
+    next_cursor = encode_order_cursor(rows[limit - 1]) if len(rows) > limit else None
+    return [format_order(order) for order in rows[:limit]], next_cursor
+
 @app.route('/api/orders', methods=['GET'])
 @token_required
 def get_user_orders(current_user):
+    """
+    Get the user's orders, newest first, one page at a time
+    Query params: status, type, stock_id, from, to, limit and cursor (the
+    X-Next-Cursor header of the previous page)
+    """
+    try:
+        filters, limit, cursor = parse_order_query(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
     try:
         # Get user's orders with stock information
-        response = supabase.from_('orders') \
-            .select('*, stocks(symbol)') \
-            .eq('user_id', current_user['user_id']) \
-            .execute()
-        
-        # Format the response
-        orders = []
-        for order in response.data:
-            orders.append({
-                'id': order['id'],
-                'stock_symbol': order['stocks']['symbol'],
-                'type': order['type'],
-                'quantity': order['quantity'],
-                'price': float(order['price']),
-                'status': order['status'],
-                'created_at': order['created_at']
-            })
-        
-        return jsonify(orders), 200
+        response = build_orders_query(
+            supabase.from_('orders').select('*, stocks(symbol)'),
+            current_user['user_id'], filters, limit, cursor
+        ).execute()
+
+        orders, next_cursor = orders_page(response.data, limit)
+        response = jsonify(orders)
+        if next_cursor:
+            response.headers['X-Next-Cursor'] = next_cursor
+        return response, 200
     except Exception as e:
         return jsonify({'error': str(e)}), 400
 
 # Portfolio Routes
-@app.route('/api/portfolio/profile', methods=['GET'])
-@token_required
-def get_user_profile(current_user):
-    try:
-        # Get user profile with balance
-        profile = supabase.table('profiles') \
-            .select('*') \
-            .eq('user_id', current_user['user_id']) \
-            .single() \
-            .execute()
+def portfolio_summary(profile, holdings):
+    """Balance and total portfolio value from a profile and user_stocks rows joined with stocks(*)"""
+    # Calculate total portfolio value, in cents
+    total_portfolio_value = to_cents(profile['balance'])
+    for holding in holdings:
+        total_portfolio_value += holding['quantity'] * to_cents(holding['stocks']['current_price'])
 
-        # Get user's stock holdings with current prices
-        holdings = supabase.table('user_stocks') \
-            .select('*, stocks(*)') \
-            .eq('user_id', current_user['user_id']) \
-            .execute()
+    return {
+        'balance': float(profile['balance']),
+        'total_portfolio_value': from_cents(total_portfolio_value)
+    }
 
-        # Calculate total portfolio value
-        total_portfolio_value = float(profile.data['balance'])
-        for holding in holdings.data:
-            stock_value = holding['quantity'] * float(holding['stocks']['current_price'])
-            total_portfolio_value += stock_value
+def format_holding(holding):
+    """Format a user_stocks row joined with stocks(*) for the API"""
+    stock = holding['stocks']
+    return {
+        'stock_id': stock['id'],
+        'stock_name': stock['name'],
+        'stock_symbol': stock['symbol'],
+        'quantity': holding['quantity'],
+        'current_price': float(stock['current_price']),
+        'total_value': from_cents(holding['quantity'] * to_cents(stock['current_price']))
+    }
 
-        response_data = {
-            'balance': float(profile.data['balance']),
-            'total_portfolio_value': total_portfolio_value
-        }
+# Threads running the independent queries of one request side by side
+query_pool = ThreadPoolExecutor(max_workers=int(os.getenv('QUERY_POOL_SIZE', '16')))
+
+def run_concurrently(*calls):
+    """
+    Run calls at the same time and return their results in order. The
+    first runs on this thread; each carries the request's context, so its
+    queries are still counted against the request.
+    """
+    futures = [query_pool.submit(contextvars.copy_context().run, call) for call in calls[1:]]
+    results = [contextvars.copy_context().run(calls[0])] if calls else []
+    return results + [future.result() for future in futures]
+
+def profile_query(client, user_id):
+    return client.table('profiles').select('*').eq('user_id', user_id).single()
+
+def holdings_query(client, user_id):
+    return client.table('user_stocks').select('*, stocks(*)').eq('user_id', user_id)
+
+def open_orders_query(client, user_id):
+    """The first page of a user's pending orders, as GET /api/orders?status=pending"""
+    return build_orders_query(
+        client.from_('orders').select('*, stocks(symbol)'),
+        user_id, {'status': ORDER_STATUS_PENDING}, ORDERS_PAGE_SIZE, None
+    )
+
+def load_portfolio(user_id):
+    """
+    Read a user's profile and holdings (joined with stocks) from the
+    database into the materialized portfolios
+    Returns (profile, holdings) rows
+    """
+    portfolios.begin_load(user_id)
+    profile, holdings = run_concurrently(
+        profile_query(supabase, user_id).execute,
+        holdings_query(supabase, user_id).execute
+    )
+    return store_portfolio(user_id, profile.data, holdings.data)
 
-        return jsonify(response_data), 200
+def store_portfolio(user_id, profile, holdings):
+    """Put a user's freshly read profile and holdings rows into the portfolios; returns them"""
+    portfolios.load(user_id, profile['balance'], holdings)
+    return profile, holdings
+
+@app.route('/api/portfolio/profile', methods=['GET'])
+@token_required
+def get_user_profile(current_user):
+    try:
+        summary = portfolios.summary(current_user['user_id'])
+        if summary is None:
+            summary = portfolio_summary(*load_portfolio(current_user['user_id']))
+        return jsonify(summary), 200
     except Exception as e:
         print("Error fetching portfolio:", str(e))
         return jsonify({'error': str(e)}), 400
@@ -795,30 +1802,103 @@ def get_user_profile(current_user):
 @token_required
 def get_user_holdings(current_user):
     try:
-        # Get user's stock holdings with stock information
-        holdings = supabase.table('user_stocks') \
-            .select('*, stocks(*)') \
-            .eq('user_id', current_user['user_id']) \
-            .execute()
-
-        # Format the response
-        formatted_holdings = []
-        for holding in holdings.data:
-            stock = holding['stocks']
-            formatted_holdings.append({
-                'stock_id': stock['id'],
-                'stock_name': stock['name'],
-                'stock_symbol': stock['symbol'],
-                'quantity': holding['quantity'],
-                'current_price': float(stock['current_price']),
-                'total_value': holding['quantity'] * float(stock['current_price'])
-            })
-
+        formatted_holdings = portfolios.holdings(current_user['user_id'])
+        if formatted_holdings is None:
+            _, holdings = load_portfolio(current_user['user_id'])
+            formatted_holdings = [format_holding(holding) for holding in holdings]
         return jsonify(formatted_holdings), 200
     except Exception as e:
         print("Error fetching holdings:", str(e))
         return jsonify({'error': str(e)}), 400
 
+PORTFOLIO_FIELDS = ('profile', 'holdings', 'orders')
+
+def parse_portfolio_fields(args):
+    """The fields asked for with ?fields=profile,holdings,orders (all by default)"""
+    fields = args.get('fields')
+    if not fields:
+        return set(PORTFOLIO_FIELDS)
+    fields = {field.strip() for field in fields.split(',') if field.strip()}
+    for field in fields:
+        if field not in PORTFOLIO_FIELDS:
+            raise ValueError(f'Invalid field: {field}')
+    return fields
+
+def portfolio_response(fields, view, orders):
+    """
+    Body of GET /api/portfolio from a (summary, holdings) view and a page
+    of open orders; returns (body, next cursor of the orders or None)
+    """
+    body = {}
+    if 'profile' in fields:
+        body['profile'] = view[0]
+    if 'holdings' in fields:
+        body['holdings'] = view[1]
+    next_cursor = None
+    if 'orders' in fields:
+        body['orders'], next_cursor = orders_page(orders, ORDERS_PAGE_SIZE)
+    return body, next_cursor
+
+def portfolio_view(profile, holdings):
+    """(summary, holdings) formatted from database rows, like Portfolios.view"""
+    return portfolio_summary(profile, holdings), [format_holding(holding) for holding in holdings]
+
+def portfolio_queries(client, user_id, fields):
+    """
+    The materialized view of a user's portfolio when GET /api/portfolio
+    needs it and it is there, and the queries (on client) the request
+    still has to run, all at the same time
+    Returns (view or None, queries)
+    """
+    needs_view = 'profile' in fields or 'holdings' in fields
+    view = portfolios.view(user_id) if needs_view else None
+
+    queries = []
+    if needs_view and view is None:
+        portfolios.begin_load(user_id)
+        queries += [profile_query(client, user_id), holdings_query(client, user_id)]
+    if 'orders' in fields:
+        queries.append(open_orders_query(client, user_id))
+    return view, queries
+
+def portfolio_results(user_id, fields, view, results):
+    """
+    Body of GET /api/portfolio from portfolio_queries' view and the results
+    of its queries, in order; returns (body, next cursor of the orders or None)
+    """
+    if view is None and ('profile' in fields or 'holdings' in fields):
+        view = portfolio_view(*store_portfolio(user_id, results[0].data, results[1].data))
+    orders = results[-1].data if 'orders' in fields else None
+    return portfolio_response(fields, view, orders)
+
+@app.route('/api/portfolio', methods=['GET'])
+@token_required
+def get_portfolio(current_user):
+    """
+    The Portfolio page in one request: profile (balance and total value),
+    holdings and open orders. The materialized portfolio is used when the
+    user is loaded; whatever has to come from the database is queried at
+    the same time. Query param fields selects a subset, e.g.
+    ?fields=profile,holdings
+    """
+    try:
+        fields = parse_portfolio_fields(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        view, queries = portfolio_queries(supabase, current_user['user_id'], fields)
+        results = run_concurrently(*(query.execute for query in queries))
+
+        body, next_cursor = portfolio_results(current_user['user_id'], fields, view, results)
+        response = jsonify(body)
+        if next_cursor:
+            response.headers['X-Next-Cursor'] = next_cursor
+        return response, 200
+    except Exception as e:
+        print("Error fetching portfolio:", str(e))
+        return jsonify({'error': str(e)}), 400
+
 # News Routes
 @app.route('/api/news', methods=['GET'])
 @token_required
@@ -844,38 +1924,96 @@ def create_news():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# Leaderboard kept up to date from fills and price changes, loaded on first use
+leaderboard = Leaderboard()
+LEADERBOARD_RESYNC_SECONDS = float(os.getenv('LEADERBOARD_RESYNC_SECONDS', '300'))
+
+def fetch_leaderboard_data():
+    """
+    Fetch every profile with its holdings in one query, and every stock
+    price in a second one
+    Returns (profiles, prices) where prices maps stock_id -> price
+    """
+    profiles = supabase.table('profiles').select('user_id, email, balance, user_stocks(stock_id, quantity)').execute()
+    stocks = supabase.table('stocks').select('id, current_price').execute()
+    return profiles.data, price_map(stocks.data)
+
+def compute_leaderboard(profiles, prices):
+    """Compute the full leaderboard from profile rows and stock prices"""
+    entries = []
+    price_cents = {stock_id: to_cents(price) for stock_id, price in prices.items()}
+    for user in profiles:
+        total_value = to_cents(user['balance'])  # Start with cash balance
+        for holding in user.get('user_stocks') or []:
+            total_value += price_cents.get(holding['stock_id'], 0) * holding['quantity']
+
+        entries.append({
+            'user_id': user['user_id'],
+            'email': user['email'],
+            'total_value': from_cents(total_value)
+        })
+
+    # Sort by total value descending
+    entries.sort(key=lambda x: x['total_value'], reverse=True)
+    return entries
+
+def parse_leaderboard_page(args):
+    """(offset, limit or None) of GET /api/leaderboard, raises RequestError"""
+    try:
+        offset = max(int(args.get('offset', 0)), 0)
+        limit = args.get('limit')
+        return offset, max(int(limit), 0) if limit is not None else None
+    except ValueError:
+        raise RequestError('Invalid limit or offset')
+
+def leaderboard_needs_data(live):
+    """
+    Whether GET /api/leaderboard has to fetch_leaderboard_data() first; for
+    the live leaderboard, this begins its load
+    """
+    if not live:
+        return True
+    stale = leaderboard.loaded and time.monotonic() - leaderboard.loaded_at > LEADERBOARD_RESYNC_SECONDS
+    if leaderboard.loaded and not stale:
+        return False
+    leaderboard.begin_load()
+    return True
+
+def leaderboard_page(live, offset, limit, data=None):
+    """
+    (page, total) of GET /api/leaderboard; data is (profiles, prices) as
+    from fetch_leaderboard_data() when leaderboard_needs_data() asked for it
+    """
+    if live:
+        if data is not None:
+            leaderboard.load(*data)
+        total = len(leaderboard)
+        return leaderboard.top(limit if limit is not None else total, offset), total
+
+    entries = compute_leaderboard(*data)
+    return (entries[offset:offset + limit] if limit is not None else entries[offset:]), len(entries)
+
 # Leaderboard Route (Admin Only)
 @app.route('/api/leaderboard', methods=['GET'])
 def get_leaderboard():
-    """Get user leaderboard based on portfolio value"""
+    """
+    Get user leaderboard based on portfolio value
+    Query params: limit, offset, and mode=live to read the incrementally
+    maintained ranking instead of recomputing it
+    """
     try:
-        # Get all users with their stock holdings
-        users = supabase.table('profiles').select('*').execute()
-        leaderboard = []
-        
-        for user in users.data:
-            # Get user's stock holdings
-            holdings = supabase.table('user_stocks').select('*').eq('user_id', user['user_id']).execute()
-            
-            # Get current stock prices
-            total_value = float(user['balance'])  # Start with cash balance
-            
-            for holding in holdings.data:
-                stock = supabase.table('stocks').select('current_price').eq('id', holding['stock_id']).single().execute()
-                if stock.data:
-                    stock_value = float(stock.data['current_price']) * holding['quantity']
-                    total_value += stock_value
-            
-            leaderboard.append({
-                'user_id': user['user_id'],
-                'email': user['email'],
-                'total_value': total_value
-            })
-        
-        # Sort by total value descending
-        leaderboard.sort(key=lambda x: x['total_value'], reverse=True)
-        
-        return jsonify(leaderboard)
+        offset, limit = parse_leaderboard_page(request.args)
+    except RequestError as e:
+        return jsonify({'error': e.message}), e.status
+
+    try:
+        live = request.args.get('mode') == 'live'
+        data = fetch_leaderboard_data() if leaderboard_needs_data(live) else None
+        page, total = leaderboard_page(live, offset, limit, data)
+
+        response = jsonify(page)
+        response.headers['X-Total-Count'] = str(total)
+        return response
     except Exception as e:
         print(f"Error fetching leaderboard: {str(e)}")
         return jsonify({'error': str(e)}), 500
@@ -937,6 +2075,7 @@ def ensure_admin_stocks(current_user):
             
         # Add initial stocks
         success = add_initial_admin_stocks(current_user['user_id'])
+        portfolios.invalidate(current_user['user_id'])
         
         if success:
             return jsonify({'message': 'Admin stocks verified and updated'}), 200
@@ -985,6 +2124,9 @@ def add_new_stock(current_user):
             # Rollback stock creation if portfolio update fails
             supabase.table('stocks').delete().eq('id', stock_id).execute()
             return jsonify({'error': 'Failed to add stock to admin portfolio'}), 500
+
+        market_snapshot.invalidate()
+        portfolios.invalidate(current_user['user_id'])
             
         return jsonify({
             'message': 'Stock added successfully',
@@ -995,9 +2137,70 @@ def add_new_stock(current_user):
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def stream_channels(user_id, args):
+    """Hub channels asked for with ?channels= by a user, raises RequestError if none are valid"""
+    requested = args.get('channels', 'prices,orders').split(',')
+    channels = []
+    if 'prices' in requested:
+        channels.append('prices')
+    if 'orders' in requested:
+        channels.append(f"user:{user_id}")
+    if not channels:
+        raise RequestError('No valid channels requested')
+    return channels
+
+# Market data stream
+@app.route('/api/stream', methods=['GET'])
+def stream_market_data():
+    """
+    Server-Sent Events stream of price ticks, trades and the caller's own
+    order updates. Query params: channels (comma separated, 'prices' and/or
+    'orders', default both) and token when no Authorization header is sent.
+    """
+    try:
+        channels = stream_channels(token_user_id(get_request_token(allow_query=True)), request.args)
+    except RequestError as e:
+        return jsonify({'error': e.message}), e.status
+
+    return Response(
+        stream_with_context(market_data_hub.subscribe(channels)),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+def health_status():
+    return {
+        "status": "healthy",
+        "profile_cache": profile_cache.stats(),
+        "portfolios": portfolios.stats(),
+        "stream_subscribers": market_data_hub.subscribers,
+        "persistence_shards": order_persistence_shards.metrics() if ENGINE_MODE != 'worker' else []
+    }
+
 @app.route('/api/health', methods=['GET'])
 def health_check():
-    return jsonify({"status": "healthy"}), 200
+    return jsonify(health_status()), 200
+
+@app.route('/api/metrics', methods=['GET'])
+def metrics():
+    """Database round trips per route and table, in the Prometheus text format"""
+    body = db_metrics.prometheus()
+    if ENGINE_MODE != 'worker':
+        body += shard_pool_prometheus(order_persistence_shards)
+    return Response(body, mimetype='text/plain; version=0.0.4')
+
+if ENGINE_MODE == 'inline':
+    start_engines()
+
+if ENGINE_MODE != 'engine' and os.getenv('DATABASE_URL'):
+    # Follow market state changes made by other processes and, when the
+    # engines run in worker.py, their events to keep caches and streams current
+    # (worker.py listens for itself)
+    from notifications import Listener
+    handlers = {MARKET_STATE_CHANNEL: on_market_state_change}
+    if ENGINE_MODE == 'worker':
+        handlers[ENGINE_EVENTS_CHANNEL] = lambda payload: handle_engine_event(**json.loads(payload))
+    Listener(os.getenv('DATABASE_URL'), handlers).start()
 
 if __name__ == '__main__':
     app.run(debug=True)
@@ -0,0 +1,393 @@
+"""
+ASGI serving mode for the trading API.
+
+The hot routes (stocks, orders, portfolio, leaderboard, news and the market
+data stream) run as async Quart handlers on an async PostgREST client that
+shares one pooled HTTP connection pool per process. A request waiting on
+the database no longer holds a worker, and independent queries inside one
+handler run concurrently. Every other route falls back to the Flask app in
+app.py through a WSGI adapter. The order books, caches and background
+threads are shared with it, as are the helpers that check requests and
+build responses, so both serve a request the same way.
+
+Run with:
+    uvicorn asgi:application --host 0.0.0.0 --port 10000
+"""
+import asyncio
+import os
+from functools import wraps
+
+import httpx
+from asgiref.wsgi import WsgiToAsgi
+from postgrest import AsyncPostgrestClient
+from quart import Quart, Response, jsonify, request
+from werkzeug.exceptions import HTTPException
+
+import app as core
+from instrumentation import InstrumentedClient
+
+# Connections kept open to PostgREST by each process
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '100'))
+
+quart_app = Quart(__name__)
+
+# Async PostgREST client, opened when the server starts serving
+db = None
+
+
+class PooledPostgrestClient(AsyncPostgrestClient):
+    """AsyncPostgrestClient whose HTTP session uses a sized connection pool"""
+
+    def create_session(self, base_url, headers, timeout):
+        return httpx.AsyncClient(
+            base_url=base_url,
+            headers=headers,
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=DB_POOL_SIZE, max_keepalive_connections=DB_POOL_SIZE)
+        )
+
+
+@quart_app.before_serving
+async def open_db():
+    global db
+    key = os.getenv('SUPABASE_KEY')
+    db = InstrumentedClient(PooledPostgrestClient(
+        f"{os.getenv('SUPABASE_URL')}/rest/v1",
+        headers={
+            'Accept': 'application/json',
+            'Content-Type': 'application/json',
+            'apiKey': key,
+            'Authorization': f'Bearer {key}'
+        },
+        timeout=10
+    ), core.db_metrics)
+
+
+@quart_app.after_serving
+async def close_db():
+    await db.aclose()
+
+
+@quart_app.before_request
+async def start_db_metrics():
+    rule = request.url_rule.rule if request.url_rule else 'unmatched'
+    core.db_metrics.begin(f'{request.method} {rule}')
+
+
+# Add CORS headers to all responses, as the Flask app does
+@quart_app.after_request
+async def after_request(response):
+    response.headers.add('Access-Control-Allow-Origin', 'http://localhost:3000')
+    response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization')
+    response.headers.add('Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE,OPTIONS')
+    response.headers.add('Access-Control-Allow-Credentials', 'true')
+    response.headers.add('Access-Control-Expose-Headers', 'ETag,X-Total-Count,X-Next-Cursor,X-DB-Queries,X-DB-Time-Ms,X-DB-Tables')
+
+    request_metrics = core.db_metrics.end()
+    if request_metrics and (core.DB_METRICS_HEADERS or quart_app.debug):
+        core.add_db_metrics_headers(response, request_metrics)
+    return response
+
+
+def get_request_token(allow_query=False):
+    return core.request_token(request.headers, request.args, allow_query)
+
+
+async def get_profile(user_id):
+    """Async get_profile, sharing the Flask app's profile cache"""
+    profile = core.profile_cache.get(user_id)
+    if profile is None:
+        user = await db.table('profiles').select('*').eq('user_id', user_id).single().execute()
+        if not user.data:
+            return None
+        profile = user.data
+        core.profile_cache.set(user_id, profile)
+    return dict(profile)
+
+
+def token_required(f):
+    @wraps(f)
+    async def decorated(*args, **kwargs):
+        try:
+            user_id = core.token_user_id(get_request_token())
+            current_user = core.request_user(user_id, await get_profile(user_id))
+        except core.RequestError as e:
+            return jsonify({'error': e.message}), e.status
+        except Exception as e:
+            return jsonify({'error': str(e)}), 401
+
+        return await f(current_user, *args, **kwargs)
+
+    return decorated
+
+
+async def check_market_state():
+    """Async check_market_state, sharing the Flask app's in-memory market state"""
+    if core.market_state.needs_refresh:
+        try:
+            result = await db.table('market_state').select('*').single().execute()
+            core.market_state.set(result.data['is_active'] if result.data else False)
+        except Exception as e:
+            print(f"Error checking market state: {str(e)}")
+    return bool(core.market_state.is_active)
+
+
+async def accept_order(order, current_price):
+    """
+    core.accept_order for ENGINE_MODE, matching inline on a worker thread:
+    it can wait on the intake gate and on the journal's commit, which must
+    not stall the event loop
+    """
+    if core.ENGINE_MODE == 'inline':
+        return await asyncio.to_thread(core.accept_order, order, current_price)
+    await db.table('orders').insert(order).execute()
+    return []
+
+
+async def accept_orders(orders, prices):
+    """core.accept_orders for ENGINE_MODE, see accept_order"""
+    if core.ENGINE_MODE == 'inline':
+        return await asyncio.to_thread(core.accept_orders, orders, prices)
+
+    try:
+        if orders:
+            await db.table('orders').insert(orders).execute()
+    except Exception as e:
+        print(f"Error inserting {len(orders)} orders: {str(e)}")
+        return [([], str(e)) for _ in orders]
+    return [([], None) for _ in orders]
+
+
+# Stock Routes
+@quart_app.route('/api/stocks', methods=['GET'])
+@token_required
+async def get_stocks(current_user):
+    try:
+        if core.market_snapshot.needs_refresh:
+            stocks = await db.table('stocks').select('*').execute()
+            core.market_snapshot.load(stocks.data)
+
+        etag, body = core.stocks_body(request.args.get('symbols'))
+        response = Response(body, mimetype='application/json')
+        response.set_etag(etag)
+        return await response.make_conditional(request)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+# Orders Routes
+@quart_app.route('/api/orders', methods=['POST'])
+@token_required
+async def place_order(current_user):
+    try:
+        data = await request.get_json()
+        core.check_order_request(data)
+
+        # Market state and stock price are independent, fetch them together
+        market_active, stock = await asyncio.gather(
+            check_market_state(),
+            db.table('stocks').select('current_price').eq('id', data['stock_id']).single().execute()
+        )
+        core.require_market_open(market_active)
+        order, current_price = core.new_order(current_user['user_id'], data, stock.data)
+
+        # Matching is in memory; the insert and settlement are written behind
+        fills = await accept_order(order, current_price)
+        return jsonify(core.order_placed_response(order, fills))
+
+    except core.RequestError as e:
+        return jsonify({'error': e.message}), e.status
+    except core.IntakeClosed:
+        return jsonify({'error': core.INTAKE_CLOSED_ERROR}), 503
+    except Exception as e:
+        print(f"Error placing order: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+
+@quart_app.route('/api/orders/batch', methods=['POST'])
+@token_required
+async def place_orders(current_user):
+    try:
+        items = core.parse_order_batch(await request.get_json())
+
+        # Market state and the batch's prices are independent, fetch them together
+        stock_ids = core.batch_stock_ids(items)
+        market_active, *results = await asyncio.gather(
+            check_market_state(),
+            *(query.execute() for query in core.stock_prices_queries(db, stock_ids))
+        )
+        core.require_market_open(market_active)
+        prices = core.price_map(stock for result in results for stock in result.data)
+
+        entries = core.build_order_batch(current_user['user_id'], items, prices)
+        orders = [order for order, _ in entries if order]
+        outcomes = await accept_orders(orders, prices)
+        return jsonify(core.order_batch_response(entries, outcomes))
+
+    except core.RequestError as e:
+        return jsonify({'error': e.message}), e.status
+    except core.IntakeClosed:
+        return jsonify({'error': core.INTAKE_CLOSED_ERROR}), 503
+    except Exception as e:
+        print(f"Error placing orders: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+
+@quart_app.route('/api/orders', methods=['GET'])
+@token_required
+async def get_user_orders(current_user):
+    try:
+        filters, limit, cursor = core.parse_order_query(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        response = await core.build_orders_query(
+            db.from_('orders').select('*, stocks(symbol)'),
+            current_user['user_id'], filters, limit, cursor
+        ).execute()
+
+        orders, next_cursor = core.orders_page(response.data, limit)
+        response = jsonify(orders)
+        if next_cursor:
+            response.headers['X-Next-Cursor'] = next_cursor
+        return response, 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+
+# Portfolio Routes
+async def load_portfolio(user_id):
+    """Async load_portfolio: both reads run together, into the shared portfolios"""
+    core.portfolios.begin_load(user_id)
+    profile, holdings = await asyncio.gather(
+        core.profile_query(db, user_id).execute(),
+        core.holdings_query(db, user_id).execute()
+    )
+    return core.store_portfolio(user_id, profile.data, holdings.data)
+
+
+@quart_app.route('/api/portfolio/profile', methods=['GET'])
+@token_required
+async def get_user_profile(current_user):
+    try:
+        summary = core.portfolios.summary(current_user['user_id'])
+        if summary is None:
+            summary = core.portfolio_summary(*await load_portfolio(current_user['user_id']))
+        return jsonify(summary), 200
+    except Exception as e:
+        print("Error fetching portfolio:", str(e))
+        return jsonify({'error': str(e)}), 400
+
+
+@quart_app.route('/api/portfolio/holdings', methods=['GET'])
+@token_required
+async def get_user_holdings(current_user):
+    try:
+        formatted_holdings = core.portfolios.holdings(current_user['user_id'])
+        if formatted_holdings is None:
+            _, holdings = await load_portfolio(current_user['user_id'])
+            formatted_holdings = [core.format_holding(holding) for holding in holdings]
+        return jsonify(formatted_holdings), 200
+    except Exception as e:
+        print("Error fetching holdings:", str(e))
+        return jsonify({'error': str(e)}), 400
+
+
+@quart_app.route('/api/portfolio', methods=['GET'])
+@token_required
+async def get_portfolio(current_user):
+    try:
+        fields = core.parse_portfolio_fields(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        view, queries = core.portfolio_queries(db, current_user['user_id'], fields)
+        results = await asyncio.gather(*(query.execute() for query in queries))
+
+        body, next_cursor = core.portfolio_results(current_user['user_id'], fields, view, results)
+        response = jsonify(body)
+        if next_cursor:
+            response.headers['X-Next-Cursor'] = next_cursor
+        return response, 200
+    except Exception as e:
+        print("Error fetching portfolio:", str(e))
+        return jsonify({'error': str(e)}), 400
+
+
+# News Routes
+@quart_app.route('/api/news', methods=['GET'])
+@token_required
+async def get_news(current_user):
+    try:
+        news = await db.table('news').select('*').order('created_at', desc=True).execute()
+        return jsonify(news.data)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+# Leaderboard Route
+async def fetch_leaderboard_data():
+    profiles, stocks = await asyncio.gather(
+        db.table('profiles').select('user_id, email, balance, user_stocks(stock_id, quantity)').execute(),
+        db.table('stocks').select('id, current_price').execute()
+    )
+    return profiles.data, core.price_map(stocks.data)
+
+
+@quart_app.route('/api/leaderboard', methods=['GET'])
+async def get_leaderboard():
+    try:
+        offset, limit = core.parse_leaderboard_page(request.args)
+    except core.RequestError as e:
+        return jsonify({'error': e.message}), e.status
+
+    try:
+        live = request.args.get('mode') == 'live'
+        data = await fetch_leaderboard_data() if core.leaderboard_needs_data(live) else None
+        page, total = core.leaderboard_page(live, offset, limit, data)
+
+        response = jsonify(page)
+        response.headers['X-Total-Count'] = str(total)
+        return response
+    except Exception as e:
+        print(f"Error fetching leaderboard: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+
+# Market data stream
+@quart_app.route('/api/stream', methods=['GET'])
+async def stream_market_data():
+    try:
+        channels = core.stream_channels(core.token_user_id(get_request_token(allow_query=True)), request.args)
+    except core.RequestError as e:
+        return jsonify({'error': e.message}), e.status
+
+    response = Response(
+        core.market_data_hub.subscribe_async(channels),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+    response.timeout = None  # Streams stay open until the client leaves
+    return response
+
+
+@quart_app.route('/api/health', methods=['GET'])
+async def health_check():
+    return jsonify(core.health_status()), 200
+
+
+# Routes without an async version are served by the Flask app
+wsgi_fallback = WsgiToAsgi(core.app)
+
+
+async def application(scope, receive, send):
+    """ASGI entry point: async routes go to Quart, everything else to Flask"""
+    if scope['type'] == 'http':
+        try:
+            quart_app.url_map.bind('').match(scope['path'], method=scope['method'])
+        except HTTPException:
+            await wsgi_fallback(scope, receive, send)
+            return
+    await quart_app(scope, receive, send)
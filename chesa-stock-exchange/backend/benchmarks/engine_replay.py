@@ -0,0 +1,271 @@
+"""
+Matching engine microbenchmark and deterministic replay.
+
+Replays an order stream through the order processing core, on one thread and
+with the database replaced by the in-memory fake from fake_supabase.py. By
+default that covers matching (app.submit_order) and settlement
+(app.persist_order_events, run in batches as the persistence shards would).
+With --engine-only, only MatchingEngine.submit runs, which is quick enough
+for streams of millions of orders.
+
+The stream is either synthetic (seeded, across --symbols symbols) or
+recorded: a JSONL file of order rows, as written by --record. Every user
+starts with INITIAL_BALANCE and INITIAL_SHARES of each stock they sell.
+
+Reports orders/s, per-fill matching and settlement latency and, with
+--allocations, memory allocated while replaying (tracemalloc). The stream
+is replayed --runs times from scratch, and the fills and final balances and
+holdings of every run are hashed; the script exits with status 1 if two
+runs disagree.
+
+Run with:
+    python benchmarks/engine_replay.py --orders 200000 --symbols 200
+    python benchmarks/engine_replay.py --engine-only --orders 2000000 --symbols 500
+"""
+import argparse
+from datetime import datetime, timedelta
+import hashlib
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ['SUPABASE_URL'] = 'http://localhost:54321'
+os.environ['SUPABASE_KEY'] = 'eyJhbGciOiJIUzI1NiJ9.eyJyb2xlIjoiYW5vbiJ9.benchmark'
+os.environ['SUPABASE_SERVICE_KEY'] = 'eyJhbGciOiJIUzI1NiJ9.eyJyb2xlIjoic2VydmljZV9yb2xlIn0.benchmark'
+os.environ['ENGINE_MODE'] = 'engine'
+os.environ.pop('DATABASE_URL', None)
+
+import app
+from order_book import BookOrder, MatchingEngine
+from fake_supabase import FakeDatabase, FakeSupabase
+from instrumentation import InstrumentedClient
+from load_test import percentile
+
+INITIAL_BALANCE = 1000000.0
+INITIAL_SHARES = 100000
+
+
+def synthetic_orders(seed, count, symbols, users, holdings):
+    """
+    Seeded stream of order rows: prices follow a random walk per symbol,
+    and users only sell the few symbols they hold
+    """
+    rng = random.Random(seed)
+    stock_ids = [f'00000000-0000-4000-8000-{index:012d}' for index in range(symbols)]
+    user_ids = [f'10000000-0000-4000-8000-{index:012d}' for index in range(users)]
+    held = [rng.sample(range(symbols), min(holdings, symbols)) for _ in user_ids]
+    prices = [rng.uniform(10, 500) for _ in stock_ids]
+    opened = datetime(2024, 1, 2, 9, 30)
+
+    for number in range(count):
+        user = rng.randrange(users)
+        side = 'buy' if rng.random() < 0.5 else 'sell'
+        stock = rng.choice(held[user]) if side == 'sell' else rng.randrange(symbols)
+        prices[stock] = max(1.0, prices[stock] * (1 + rng.uniform(-0.005, 0.005)))
+        yield {
+            'id': f'{number:08x}-0000-4000-8000-000000000000',
+            'user_id': user_ids[user],
+            'stock_id': stock_ids[stock],
+            'type': side,
+            'quantity': rng.randint(1, 100),
+            'price': round(prices[stock] * rng.uniform(0.99, 1.01), 2),
+            'status': app.ORDER_STATUS_PENDING,
+            'created_at': (opened + timedelta(microseconds=number)).isoformat()
+        }
+
+
+def recorded_orders(path):
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def seed_accounts(db, stream):
+    """Accounts and stocks for every user and stock in the stream"""
+    now = datetime(2024, 1, 2).isoformat()
+    for order in stream:
+        if db.get('stocks', order['stock_id']) is None:
+            db.insert('stocks', {
+                'id': order['stock_id'],
+                'name': order['stock_id'],
+                'symbol': order['stock_id'],
+                'current_price': float(order['price']),
+                'price_change': 0.0,
+                'created_at': now
+            })
+        if db.find('profiles', order['user_id']) is None:
+            db.insert('profiles', {
+                'id': order['user_id'],
+                'user_id': order['user_id'],
+                'email': f"{order['user_id']}@example.com",
+                'role': 'user',
+                'balance': INITIAL_BALANCE,
+                'created_at': now
+            })
+        if order['type'] == 'sell' and db.find('user_stocks', order['user_id'], order['stock_id']) is None:
+            db.insert('user_stocks', {
+                'id': f"{order['user_id']}:{order['stock_id']}",
+                'user_id': order['user_id'],
+                'stock_id': order['stock_id'],
+                'quantity': INITIAL_SHARES,
+                'created_at': now
+            })
+
+
+def state_hash(db):
+    """Hash of every balance and holding"""
+    digest = hashlib.sha256()
+    for profile in sorted(db.rows('profiles'), key=lambda row: row['user_id']):
+        digest.update(f"{profile['user_id']}|{float(profile['balance']):.2f}\n".encode())
+    for holding in sorted(db.rows('user_stocks'), key=lambda row: (row['user_id'], row['stock_id'])):
+        digest.update(f"{holding['user_id']}|{holding['stock_id']}|{holding['quantity']}\n".encode())
+    return digest.hexdigest()
+
+
+def summary_us(latencies):
+    values = sorted(latencies)
+    return {
+        'p50': round(percentile(values, 0.50) * 1e6, 2),
+        'p95': round(percentile(values, 0.95) * 1e6, 2),
+        'p99': round(percentile(values, 0.99) * 1e6, 2),
+        'max': round(values[-1] * 1e6, 2) if values else 0.0
+    }
+
+
+def replay(stream_factory, engine_only, batch_size):
+    """Replay one stream from a clean state; returns the run's report"""
+    db = FakeDatabase()
+    seed_accounts(db, stream_factory())
+    app.supabase = InstrumentedClient(FakeSupabase(db), app.db_metrics)
+    app.service_supabase = app.supabase
+    app.matching_engine = MatchingEngine()
+    app.profile_cache.clear()
+
+    # Persist in batches on this thread instead of on the shards, so the
+    # settlement order, and with it every balance, is reproducible
+    queued = []
+    app.order_persistence_shards.submit = lambda stock_id, event: queued.append(event)
+
+    fills_digest = hashlib.sha256()
+    match_latencies, settle_latencies = [], []
+    orders = fills = queued_fills = 0
+
+    def settle():
+        started = time.perf_counter()
+        app.persist_order_events(queued)
+        if queued_fills:
+            settle_latencies.extend([(time.perf_counter() - started) / queued_fills] * queued_fills)
+        queued.clear()
+
+    started = time.perf_counter()
+    for row in stream_factory():
+        submitted = time.perf_counter()
+        if engine_only:
+            order_fills = app.matching_engine.submit(BookOrder(
+                row['id'], row['user_id'], row['stock_id'], row['type'], row['quantity'], row['price'], row['created_at']
+            )) or []
+        else:
+            order_fills = app.submit_order(row, db.get('stocks', row['stock_id'])['current_price'])
+        elapsed = time.perf_counter() - submitted
+
+        orders += 1
+        if order_fills:
+            match_latencies.extend([elapsed / len(order_fills)] * len(order_fills))
+            fills += len(order_fills)
+            queued_fills += len(order_fills)
+            for fill in order_fills:
+                fills_digest.update(
+                    f'{fill.stock_id}|{fill.buy_order.id}|{fill.sell_order.id}|{fill.quantity}|{fill.price:.2f}\n'.encode()
+                )
+
+        if not engine_only and len(queued) >= batch_size:
+            settle()
+            queued_fills = 0
+    if not engine_only:
+        settle()
+    elapsed = time.perf_counter() - started
+
+    return {
+        'orders': orders,
+        'fills': fills,
+        'elapsed_s': round(elapsed, 3),
+        'orders_per_s': round(orders / elapsed, 1) if elapsed else 0.0,
+        'fills_per_s': round(fills / elapsed, 1) if elapsed else 0.0,
+        'match_latency_us_per_fill': summary_us(match_latencies),
+        'settle_latency_us_per_fill': summary_us(settle_latencies),
+        'round_trips': db.round_trips,
+        'rejected_orders': sum(1 for order in db.rows('orders') if order.get('error')),
+        'fills_hash': fills_digest.hexdigest(),
+        'state_hash': state_hash(db)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Matching engine microbenchmark and deterministic replay')
+    parser.add_argument('--orders', type=int, default=200000)
+    parser.add_argument('--symbols', type=int, default=200)
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--holdings', type=int, default=10, help='symbols each synthetic user sells')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--input', help='replay this JSONL file of order rows instead of a synthetic stream')
+    parser.add_argument('--record', help='write the stream to this JSONL file before replaying it')
+    parser.add_argument('--engine-only', action='store_true', help='match only, no settlement')
+    parser.add_argument('--batch-size', type=int, default=app.PERSIST_BATCH_SIZE, help='events settled per batch')
+    parser.add_argument('--runs', type=int, default=2, help='replays to compare for determinism')
+    parser.add_argument('--allocations', action='store_true', help='trace allocations (slows the replay)')
+    parser.add_argument('--output', help='also write the JSON report to this file')
+    args = parser.parse_args()
+
+    if args.input:
+        stream_factory = lambda: recorded_orders(args.input)
+    else:
+        stream_factory = lambda: synthetic_orders(args.seed, args.orders, args.symbols, args.users, args.holdings)
+
+    if args.record:
+        with open(args.record, 'w') as f:
+            for row in stream_factory():
+                f.write(json.dumps(row) + '\n')
+
+    runs = []
+    allocations = None
+    for run in range(max(args.runs, 1)):
+        tracing = args.allocations and run == 0
+        if tracing:
+            tracemalloc.start()
+        runs.append(replay(stream_factory, args.engine_only, args.batch_size))
+        if tracing:
+            current, peak = tracemalloc.get_traced_memory()
+            top = tracemalloc.take_snapshot().statistics('lineno')[:5]
+            tracemalloc.stop()
+            allocations = {
+                'retained_bytes': current,
+                'peak_bytes': peak,
+                'top_sites': [
+                    {'site': str(stat.traceback[0]), 'bytes': stat.size, 'blocks': stat.count}
+                    for stat in top
+                ]
+            }
+
+    deterministic = len({(run['fills_hash'], run['state_hash']) for run in runs}) == 1
+    report = {
+        'config': vars(args),
+        'runs': runs,
+        'deterministic': deterministic,
+        'allocations': allocations
+    }
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    sys.exit(0 if deterministic else 1)
+
+
+if __name__ == '__main__':
+    main()
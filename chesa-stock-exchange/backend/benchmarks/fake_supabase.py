@@ -0,0 +1,479 @@
+"""
+In-process stand-in for the Supabase client, for benchmarks.
+
+Implements the part of the supabase-py query builder the backend uses
+(select with embedded relations, filters, order, limit, single, insert,
+upsert, update, delete) over plain dicts, and the database functions it calls
+through rpc() with the same semantics as the SQL in migrations/. Every
+execute() counts as one database round trip and can sleep for a simulated
+network latency, so benchmarks see the round trips a change adds or saves.
+"""
+from datetime import datetime
+from threading import Lock, local
+import re
+import time
+import uuid
+
+import httpx
+
+# Embedded relations: (table, relation) -> (local column, remote column, many)
+RELATIONS = {
+    ('orders', 'stocks'): ('stock_id', 'id', False),
+    ('user_stocks', 'stocks'): ('stock_id', 'id', False),
+    ('transactions', 'stocks'): ('stock_id', 'id', False),
+    ('profiles', 'user_stocks'): ('user_id', 'user_id', True),
+}
+
+# Unique keys looked up by the database functions: table -> columns
+KEYS = {
+    'profiles': ('user_id',),
+    'user_stocks': ('user_id', 'stock_id'),
+}
+
+# The (created_at, id) keyset filter built by app.build_orders_query
+KEYSET = re.compile(r'^\(created_at\.lt\."(.+)",and\(created_at\.eq\."(.+)",id\.lt\.(.+)\)\)$')
+
+
+class FakeResponse:
+    def __init__(self, data):
+        self.data = data
+        self.count = None
+
+
+def split_columns(columns):
+    """Split a select list on the commas outside parentheses"""
+    parts, depth, current = [], 0, ''
+    for char in columns:
+        if char == ',' and depth == 0:
+            parts.append(current.strip())
+            current = ''
+            continue
+        depth += char == '('
+        depth -= char == ')'
+        current += char
+    if current.strip():
+        parts.append(current.strip())
+    return parts
+
+
+class FakeDatabase:
+    """Tables of row dicts, plus round trip accounting"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.tables = {}
+        self.indexes = {}  # table -> {id: row}
+        self.keys = {table: {} for table in KEYS}  # table -> {key: row}
+        self.settled = {}  # order id -> quantity of its transactions
+        self.lock = Lock()
+        self.round_trips = 0
+        self.round_trips_by_table = {}
+        self._request = local()
+
+    def rows(self, table):
+        return self.tables.setdefault(table, [])
+
+    def insert(self, table, row):
+        self.rows(table).append(row)
+        self.indexes.setdefault(table, {})[str(row['id'])] = row
+        if table in KEYS:
+            self.keys[table][tuple(str(row[column]) for column in KEYS[table])] = row
+        if table == 'transactions' and row.get('order_id'):
+            order_id = str(row['order_id'])
+            self.settled[order_id] = self.settled.get(order_id, 0) + row['quantity']
+
+    def remove(self, table, row):
+        self.rows(table).remove(row)
+        self.indexes.get(table, {}).pop(str(row['id']), None)
+        if table in KEYS:
+            self.keys[table].pop(tuple(str(row[column]) for column in KEYS[table]), None)
+        if table == 'transactions' and row.get('order_id'):
+            order_id = str(row['order_id'])
+            self.settled[order_id] = self.settled.get(order_id, 0) - row['quantity']
+
+    def get(self, table, row_id):
+        return self.indexes.get(table, {}).get(str(row_id))
+
+    def find(self, table, *key):
+        """Row of a table in KEYS by its unique key, or None"""
+        return self.keys[table].get(tuple(str(value) for value in key))
+
+    def begin_request(self):
+        """Start counting the round trips made by the calling thread"""
+        self._request.round_trips = 0
+
+    def end_request(self):
+        """Round trips made by the calling thread since begin_request()"""
+        round_trips = getattr(self._request, 'round_trips', 0)
+        self._request.round_trips = None
+        return round_trips
+
+    def round_trip(self, target):
+        with self.lock:
+            self.round_trips += 1
+            self.round_trips_by_table[target] = self.round_trips_by_table.get(target, 0) + 1
+        if getattr(self._request, 'round_trips', None) is not None:
+            self._request.round_trips += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def embed(self, table, row, columns, groups):
+        """
+        Project a row onto a select list, resolving embedded relations
+        groups caches related rows by key for the duration of one select
+        """
+        result = {}
+        for column in split_columns(columns):
+            if column == '*':
+                result.update(row)
+            elif '(' in column:
+                relation, inner = column[:-1].split('(', 1)
+                local_column, remote_column, many = RELATIONS[(table, relation)]
+                if (relation, remote_column) not in groups:
+                    grouped = {}
+                    for other in self.rows(relation):
+                        grouped.setdefault(other[remote_column], []).append(other)
+                    groups[(relation, remote_column)] = grouped
+                related = [
+                    self.embed(relation, other, inner, groups)
+                    for other in groups[(relation, remote_column)].get(row[local_column], [])
+                ]
+                result[relation] = related if many else (related[0] if related else None)
+            else:
+                result[column] = row.get(column)
+        return result
+
+
+class FakeQuery:
+    def __init__(self, db, table):
+        self.db = db
+        self.table = table
+        self.params = httpx.QueryParams()
+        self.columns = '*'
+        self.filters = []
+        self.ordering = []
+        self.row_limit = None
+        self.is_single = False
+        self.action = 'select'
+        self.payload = None
+
+    def select(self, columns='*', **kwargs):
+        self.columns = columns
+        return self
+
+    def insert(self, rows, **kwargs):
+        self.action, self.payload = 'insert', rows
+        return self
+
+    def upsert(self, rows, ignore_duplicates=False, **kwargs):
+        self.action, self.payload = 'upsert', rows
+        self.ignore_duplicates = ignore_duplicates
+        return self
+
+    def update(self, changes, **kwargs):
+        self.action, self.payload = 'update', changes
+        return self
+
+    def delete(self, **kwargs):
+        self.action = 'delete'
+        return self
+
+    def _filter(self, test):
+        self.filters.append(test)
+        return self
+
+    def eq(self, column, value):
+        return self._filter(lambda row: str(row.get(column)) == str(value))
+
+    def neq(self, column, value):
+        return self._filter(lambda row: str(row.get(column)) != str(value))
+
+    def in_(self, column, values):
+        values = {str(value) for value in values}
+        return self._filter(lambda row: str(row.get(column)) in values)
+
+    def gt(self, column, value):
+        return self._filter(lambda row: row.get(column) is not None and row[column] > value)
+
+    def gte(self, column, value):
+        return self._filter(lambda row: row.get(column) is not None and row[column] >= value)
+
+    def lt(self, column, value):
+        return self._filter(lambda row: row.get(column) is not None and row[column] < value)
+
+    def lte(self, column, value):
+        return self._filter(lambda row: row.get(column) is not None and row[column] <= value)
+
+    def order(self, column, desc=False, **kwargs):
+        spec = f"{column}{'.desc' if desc else ''}"
+        for part in spec.split(','):
+            name, _, direction = part.partition('.')
+            self.ordering.append((name, direction == 'desc'))
+        return self
+
+    def limit(self, count, **kwargs):
+        self.row_limit = count
+        return self
+
+    def single(self):
+        self.is_single = True
+        return self
+
+    def _matches(self, row):
+        keyset = self.params.get('or')
+        if keyset:
+            created_at, _, order_id = KEYSET.match(keyset).groups()
+            if not (row['created_at'] < created_at or (row['created_at'] == created_at and row['id'] < order_id)):
+                return False
+        return all(test(row) for test in self.filters)
+
+    def execute(self):
+        self.db.round_trip(self.table)
+        with self.db.lock:
+            return FakeResponse(getattr(self, '_' + self.action)())
+
+    def _select(self):
+        rows = [row for row in self.db.rows(self.table) if self._matches(row)]
+        for column, desc in reversed(self.ordering):
+            rows.sort(key=lambda row: row.get(column), reverse=desc)
+        if self.row_limit is not None:
+            rows = rows[:self.row_limit]
+        groups = {}
+        rows = [self.db.embed(self.table, row, self.columns, groups) for row in rows]
+        if self.is_single:
+            return rows[0] if rows else None
+        return rows
+
+    def _insert(self):
+        return self._insert_rows(self.payload if isinstance(self.payload, list) else [self.payload])
+
+    def _insert_rows(self, rows):
+        inserted = []
+        for row in rows:
+            row = dict(row)
+            row.setdefault('id', str(uuid.uuid4()))
+            row.setdefault('created_at', datetime.now().isoformat())
+            self.db.insert(self.table, row)
+            inserted.append(dict(row))
+        return inserted
+
+    def _upsert(self):
+        rows = self.payload if isinstance(self.payload, list) else [self.payload]
+        written = []
+        for row in rows:
+            existing = self.db.get(self.table, row['id']) if 'id' in row else None
+            if existing is None:
+                written.extend(self._insert_rows([row]))
+            elif not self.ignore_duplicates:
+                existing.update(row)
+                written.append(dict(existing))
+        return written
+
+    def _update(self):
+        updated = []
+        for row in self.db.rows(self.table):
+            if self._matches(row):
+                row.update(self.payload)
+                updated.append(dict(row))
+        return updated
+
+    def _delete(self):
+        deleted = [row for row in self.db.rows(self.table) if self._matches(row)]
+        for row in deleted:
+            self.db.remove(self.table, row)
+        return [dict(row) for row in deleted]
+
+
+class FakeRpc:
+    def __init__(self, db, name, params):
+        self.db = db
+        self.name = name
+        self.params = params
+
+    def execute(self):
+        self.db.round_trip(f'rpc:{self.name}')
+        with self.db.lock:
+            return FakeResponse(getattr(FakeFunctions(self.db), self.name)(self.params))
+
+
+class FakeFunctions:
+    """The database functions from migrations/, over the fake tables"""
+
+    def __init__(self, db):
+        self.db = db
+
+    def get_pending_orders(self, params):
+        orders = [
+            dict(order) for order in self.db.rows('orders')
+            if order['status'] == 'pending' and order['stock_id'] == params['stock_id_param']
+        ]
+        return sorted(orders, key=lambda order: order['created_at'])
+
+    def cancel_pending_orders(self, params):
+        cancelled = 0
+        for order in self.db.rows('orders'):
+            if order['status'] == 'pending':
+                order.update(status='cancelled', error=params['reason_param'])
+                cancelled += 1
+        return cancelled
+
+    def update_stock_prices(self, params):
+        for stock_id, new_price, price_change in zip(
+            params['stock_ids_param'], params['new_prices_param'], params['price_changes_param']
+        ):
+            stock = self.db.get('stocks', stock_id)
+            if stock:
+                stock.update(current_price=float(new_price), price_change=float(price_change))
+        return None
+
+    def settle_order(self, params):
+        order_id = params['order_id_param']
+        order = self.db.get('orders', order_id)
+        if order is None:
+            return {'order_id': order_id, 'success': False, 'error': 'Order not found'}
+        if order['status'] != 'pending':
+            return {'order_id': order_id, 'success': False, 'error': 'Order is not pending'}
+
+        price = float(params['price_param'])
+        quantity = params.get('quantity_param') or order['quantity']
+        total = round(price * quantity, 2)
+
+        def reject(error):
+            order.update(status='cancelled', error=error)
+            return {'order_id': order_id, 'success': False, 'error': error}
+
+        profile = self.db.find('profiles', order['user_id'])
+        if profile is None:
+            return reject('User not found')
+
+        holding = self.db.find('user_stocks', order['user_id'], order['stock_id'])
+        balance = float(profile['balance'])
+        if order['type'] == 'buy':
+            if balance < total:
+                return reject('Insufficient balance')
+            new_balance = balance - total
+            if holding:
+                holding['quantity'] += quantity
+            else:
+                self.db.insert('user_stocks', {
+                    'id': str(uuid.uuid4()),
+                    'user_id': order['user_id'],
+                    'stock_id': order['stock_id'],
+                    'quantity': quantity,
+                    'created_at': datetime.now().isoformat()
+                })
+        else:
+            if holding is None or holding['quantity'] < quantity:
+                return reject('Insufficient stocks')
+            new_balance = balance + total
+            holding['quantity'] -= quantity
+            if not holding['quantity']:
+                self.db.remove('user_stocks', holding)
+
+        profile['balance'] = round(new_balance, 2)
+        settled = self.db.settled.get(str(order_id), 0)
+        completed = bool(params.get('complete_param', True)) and settled + quantity >= order['quantity']
+        if completed:
+            order.update(status='completed', price=price, executed_price=price, executed_at=datetime.now().isoformat())
+
+        self.db.insert('transactions', {
+            'id': str(uuid.uuid4()),
+            'user_id': order['user_id'],
+            'stock_id': order['stock_id'],
+            'type': order['type'],
+            'quantity': quantity,
+            'price': price,
+            'total_amount': total,
+            'order_id': order_id,
+            'created_at': datetime.now().isoformat()
+        })
+        return {
+            'order_id': order_id,
+            'success': True,
+            'user_id': order['user_id'],
+            'stock_id': order['stock_id'],
+            'type': order['type'],
+            'quantity': quantity,
+            'price': price,
+            'total_amount': total,
+            'new_balance': profile['balance'],
+            'completed': completed
+        }
+
+    def settle_orders(self, params):
+        return [self.settle_fill(fill) for fill in params['fills_param']]
+
+    def settle_fill(self, fill):
+        """Both sides of a fill or neither, as settle_orders' subtransaction"""
+        saved = self.save_fill_rows(fill)
+        results = {
+            side: self.settle_order({
+                'order_id_param': fill[f'{side}_order_id'],
+                'price_param': fill['price'],
+                'quantity_param': fill['quantity'],
+                'complete_param': fill.get(f'{side}_complete', True)
+            })
+            for side in ('buy', 'sell')
+        }
+        if all(result['success'] for result in results.values()):
+            return {'success': True, 'buy': results['buy'], 'sell': results['sell']}
+
+        self.restore_fill_rows(saved)
+        rejected = []
+        for side in ('buy', 'sell'):
+            if not results[side]['success']:
+                order = self.db.get('orders', fill[f'{side}_order_id'])
+                if order is not None and order['status'] == 'pending':
+                    order.update(status='cancelled', error=results[side]['error'])
+                rejected.append(fill[f'{side}_order_id'])
+        error = next(result['error'] for result in results.values() if not result['success'])
+        return {'success': False, 'error': error, 'rejected': rejected}
+
+    def save_fill_rows(self, fill):
+        """Copies of the rows settling a fill can change, to roll it back"""
+        rows, holdings = [], []
+        for order_id in (fill['buy_order_id'], fill['sell_order_id']):
+            order = self.db.get('orders', order_id)
+            if order is None:
+                continue
+            rows.append((order, dict(order)))
+            profile = self.db.find('profiles', order['user_id'])
+            if profile is not None:
+                rows.append((profile, dict(profile)))
+            key = (order['user_id'], order['stock_id'])
+            holding = self.db.find('user_stocks', *key)
+            holdings.append((key, holding, dict(holding) if holding else None))
+        return rows, holdings, len(self.db.rows('transactions'))
+
+    def restore_fill_rows(self, saved):
+        rows, holdings, transactions = saved
+        for row, copy in rows:
+            row.clear()
+            row.update(copy)
+        for key, holding, copy in holdings:
+            current = self.db.find('user_stocks', *key)
+            if current is not None and current is not holding:
+                self.db.remove('user_stocks', current)
+            if holding is not None:
+                holding.clear()
+                holding.update(copy)
+                if current is None:
+                    self.db.insert('user_stocks', holding)
+        for transaction in self.db.rows('transactions')[transactions:]:
+            self.db.remove('transactions', transaction)
+
+
+class FakeSupabase:
+    """Drop-in for the supabase Client used by app.py"""
+
+    def __init__(self, db):
+        self.db = db
+
+    def table(self, name):
+        return FakeQuery(self.db, name)
+
+    def from_(self, name):
+        return FakeQuery(self.db, name)
+
+    def rpc(self, name, params=None):
+        return FakeRpc(self.db, name, params or {})
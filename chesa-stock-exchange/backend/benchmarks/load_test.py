@@ -0,0 +1,266 @@
+"""
+Load benchmark for the trading API.
+
+Boots app.py in-process with the Supabase client replaced by the fake in
+fake_supabase.py, seeds a synthetic market, and drives a configurable mix
+of requests against /api/orders, /api/stocks, /api/portfolio/* and
+/api/leaderboard from concurrent clients. Reports throughput, p50/p95/p99
+latency and database round trips per request, overall and per endpoint,
+as JSON so runs before and after a change can be compared.
+
+The fake database answers instantly unless --db-latency-ms is set, so by
+default the numbers measure the backend's own cost; set a latency close to
+the real one to see what round trips cost.
+
+Run with:
+    python benchmarks/load_test.py --users 500 --stocks 50 --concurrency 16 --duration 30 --output before.json
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime
+from threading import Lock, Thread
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Never reach a real project: the client is replaced before any request,
+# and the engines are only started once it has been
+os.environ['SUPABASE_URL'] = 'http://localhost:54321'
+os.environ['SUPABASE_KEY'] = 'eyJhbGciOiJIUzI1NiJ9.eyJyb2xlIjoiYW5vbiJ9.benchmark'
+os.environ['SUPABASE_SERVICE_KEY'] = 'eyJhbGciOiJIUzI1NiJ9.eyJyb2xlIjoic2VydmljZV9yb2xlIn0.benchmark'
+os.environ['ENGINE_MODE'] = 'engine'
+os.environ.pop('DATABASE_URL', None)
+
+import jwt
+
+import app
+from fake_supabase import FakeDatabase, FakeSupabase
+from instrumentation import InstrumentedClient
+
+# Request mix: endpoint -> weight
+DEFAULT_MIX = 'place_order=50,stocks=20,orders=10,portfolio_profile=8,portfolio_holdings=7,leaderboard=5'
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def latency_summary(latencies):
+    values = sorted(latencies)
+    return {
+        'p50': round(percentile(values, 0.50) * 1000, 3),
+        'p95': round(percentile(values, 0.95) * 1000, 3),
+        'p99': round(percentile(values, 0.99) * 1000, 3),
+        'max': round(values[-1] * 1000, 3) if values else 0.0,
+        'mean': round(sum(values) / len(values) * 1000, 3) if values else 0.0
+    }
+
+
+def seed_market(db, rng, users, stocks, holdings_per_user):
+    """Fill the fake database; returns (user ids, stock ids, {user: held stock ids})"""
+    now = datetime.now().isoformat()
+    db.insert('market_state', {'id': 1, 'is_active': True, 'updated_at': now})
+
+    stock_ids = []
+    for index in range(stocks):
+        stock = {
+            'id': f'00000000-0000-4000-8000-{index:012d}',
+            'name': f'Stock {index}',
+            'symbol': f'S{index:03d}',
+            'current_price': round(rng.uniform(10, 500), 2),
+            'price_change': 0.0,
+            'created_at': now
+        }
+        db.insert('stocks', stock)
+        stock_ids.append(stock['id'])
+
+    user_ids, held = [], {}
+    for index in range(users):
+        user_id = f'10000000-0000-4000-8000-{index:012d}'
+        db.insert('profiles', {
+            'id': user_id,
+            'user_id': user_id,
+            'email': f'user{index}@example.com',
+            'role': 'user',
+            'balance': 100000.0,
+            'created_at': now
+        })
+        user_ids.append(user_id)
+        held[user_id] = rng.sample(stock_ids, min(holdings_per_user, len(stock_ids)))
+        for stock_id in held[user_id]:
+            db.insert('user_stocks', {
+                'id': f'{user_id[:-4]}{stock_ids.index(stock_id):04d}',
+                'user_id': user_id,
+                'stock_id': stock_id,
+                'quantity': 1000,
+                'created_at': now
+            })
+
+    for index in range(10):
+        db.insert('news', {'id': f'20000000-0000-4000-8000-{index:012d}', 'title': f'News {index}', 'content': '...', 'created_at': now})
+
+    return user_ids, stock_ids, held
+
+
+class Scenario:
+    """Builds one request of each kind for a random user"""
+
+    def __init__(self, db, rng, user_ids, stock_ids, held):
+        self.db = db
+        self.rng = rng
+        self.user_ids = user_ids
+        self.stock_ids = stock_ids
+        self.held = held
+        self.tokens = {
+            user_id: jwt.encode({'user_id': user_id, 'role': 'user'}, app.JWT_SECRET, algorithm='HS256')
+            for user_id in user_ids
+        }
+
+    def request(self, endpoint):
+        """Returns (method, path, user token, JSON body)"""
+        user_id = self.rng.choice(self.user_ids)
+        token = self.tokens[user_id]
+        if endpoint == 'place_order':
+            side = self.rng.choice(['buy', 'sell'])
+            stock_id = self.rng.choice(self.held[user_id] if side == 'sell' else self.stock_ids)
+            price = self.db.get('stocks', stock_id)['current_price']
+            return 'POST', '/api/orders', token, {
+                'stock_id': stock_id,
+                'type': side,
+                'quantity': self.rng.randint(1, 10),
+                'price': round(price * self.rng.uniform(0.98, 1.02), 2)
+            }
+        if endpoint == 'stocks':
+            return 'GET', '/api/stocks', token, None
+        if endpoint == 'orders':
+            return 'GET', '/api/orders?limit=50', token, None
+        if endpoint == 'portfolio_profile':
+            return 'GET', '/api/portfolio/profile', token, None
+        if endpoint == 'portfolio_holdings':
+            return 'GET', '/api/portfolio/holdings', token, None
+        if endpoint == 'portfolio':
+            return 'GET', '/api/portfolio', token, None
+        if endpoint == 'leaderboard':
+            return 'GET', '/api/leaderboard?limit=20', token, None
+        raise ValueError(f'Unknown endpoint {endpoint}')
+
+
+budget_lock = Lock()
+
+
+def run_client(scenario, mix, deadline, remaining, results, seed):
+    """One client thread: send requests until the deadline or request budget is spent"""
+    client = app.app.test_client()
+    rng = random.Random(seed)
+    endpoints, weights = zip(*mix.items())
+    while time.monotonic() < deadline:
+        if remaining is not None:
+            with budget_lock:
+                if remaining[0] <= 0:
+                    break
+                remaining[0] -= 1
+
+        endpoint = rng.choices(endpoints, weights)[0]
+        method, path, token, body = scenario.request(endpoint)
+        scenario.db.begin_request()
+        started = time.perf_counter()
+        response = client.open(path, method=method, json=body, headers={'Authorization': f'Bearer {token}'})
+        elapsed = time.perf_counter() - started
+        round_trips = scenario.db.end_request()
+        results.append((endpoint, elapsed, round_trips, response.status_code >= 400))
+
+
+def run_benchmark(args):
+    rng = random.Random(args.seed)
+    db = FakeDatabase(latency=args.db_latency_ms / 1000)
+    user_ids, stock_ids, held = seed_market(db, rng, args.users, args.stocks, args.holdings)
+
+    app.supabase = InstrumentedClient(FakeSupabase(db), app.db_metrics)
+    app.service_supabase = app.supabase
+    app.ENGINE_MODE = 'inline'
+    app.start_engines()
+
+    mix = {
+        name.strip(): float(weight)
+        for name, weight in (item.split('=') for item in args.mix.split(',') if '=' in item)
+    }
+    scenario = Scenario(db, rng, user_ids, stock_ids, held)
+    results = []
+    remaining = [args.requests] if args.requests else None
+
+    started = time.monotonic()
+    deadline = started + args.duration
+    clients = [
+        Thread(target=run_client, args=(scenario, mix, deadline, remaining, results, args.seed + index))
+        for index in range(args.concurrency)
+    ]
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.monotonic() - started
+
+    # Let the persistence shards finish writing behind the engine
+    app.order_persistence_shards.join()
+    request_round_trips = sum(round_trips for _, _, round_trips, _ in results)
+
+    endpoints = {}
+    for name in mix:
+        rows = [result for result in results if result[0] == name]
+        if not rows:
+            continue
+        endpoints[name] = {
+            'requests': len(rows),
+            'errors': sum(1 for row in rows if row[3]),
+            'throughput_rps': round(len(rows) / elapsed, 1),
+            'latency_ms': latency_summary([row[1] for row in rows]),
+            'round_trips_per_request': round(sum(row[2] for row in rows) / len(rows), 3)
+        }
+
+    return {
+        'config': vars(args),
+        'duration_s': round(elapsed, 3),
+        'requests': len(results),
+        'errors': sum(1 for result in results if result[3]),
+        'throughput_rps': round(len(results) / elapsed, 1),
+        'latency_ms': latency_summary([result[1] for result in results]),
+        'round_trips_per_request': round(request_round_trips / len(results), 3) if results else 0.0,
+        'background_round_trips': db.round_trips - request_round_trips,
+        'round_trips_by_table': dict(sorted(db.round_trips_by_table.items())),
+        'endpoints': endpoints,
+        'orders': len(db.rows('orders')),
+        'transactions': len(db.rows('transactions'))
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load benchmark for the trading API')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--stocks', type=int, default=20)
+    parser.add_argument('--holdings', type=int, default=5, help='stocks each user starts with')
+    parser.add_argument('--concurrency', type=int, default=8, help='concurrent clients')
+    parser.add_argument('--duration', type=float, default=10, help='seconds to run for')
+    parser.add_argument('--requests', type=int, default=0, help='stop after this many requests (0: no limit)')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='endpoint=weight,...')
+    parser.add_argument('--db-latency-ms', type=float, default=0.0, help='simulated latency of each round trip')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='also write the JSON report to this file')
+    args = parser.parse_args()
+
+    report = run_benchmark(args)
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+
+
+if __name__ == '__main__':
+    main()
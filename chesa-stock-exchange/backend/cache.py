@@ -0,0 +1,193 @@
+"""
+Small in-process caches shared by the request handlers.
+"""
+from collections import OrderedDict
+import hashlib
+import json
+from threading import Condition, Lock
+import time
+
+
+class TTLCache:
+    """
+    Bounded LRU cache whose entries expire after ttl seconds.
+    Keeps hit/miss counters so the saving can be reported.
+    """
+
+    def __init__(self, maxsize=1024, ttl=30):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Return the cached value, or None if it is missing or expired"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return None
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def update(self, key, changes):
+        """
+        Write-through for dict values: apply changes to a cached entry in
+        place, keeping its expiry. Does nothing if the key is not cached.
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                entry[0].update(changes)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0
+            }
+
+
+class MarketSnapshot:
+    """
+    Process-wide copy of the stocks table, kept as pre-serialized JSON.
+    Each body comes with an ETag hashed from its bytes, so every process
+    (and every restart) gives the same prices the same tag. Price changes
+    made by this process are applied in place; changes made elsewhere are
+    picked up by a refresh after ttl seconds.
+    """
+
+    def __init__(self, ttl=5):
+        self.ttl = ttl
+        self.rows = []
+        self.body = b'[]'
+        self.etag = etag_for(self.body)
+        self._index = {}
+        self._refreshed_at = None
+        self._lock = Lock()
+
+    @property
+    def needs_refresh(self):
+        return self._refreshed_at is None or time.monotonic() - self._refreshed_at > self.ttl
+
+    def invalidate(self):
+        with self._lock:
+            self._refreshed_at = None
+
+    def _publish(self, rows):
+        body = json.dumps(rows, separators=(',', ':')).encode()
+        if body != self.body:
+            self.rows = rows
+            self.body = body
+            self._index = {row['id']: position for position, row in enumerate(rows)}
+            self.etag = etag_for(body)
+
+    def load(self, rows):
+        """Replace the snapshot with fresh rows from the database"""
+        rows = sorted(
+            (dict(row, current_price=float(row['current_price']), price_change=float(row['price_change']))
+             for row in rows),
+            key=lambda row: row['symbol']
+        )
+        with self._lock:
+            self._publish(rows)
+            self._refreshed_at = time.monotonic()
+
+    def apply_prices(self, updates):
+        """Apply (stock_id, new_price, price_change) updates in place"""
+        with self._lock:
+            rows = list(self.rows)
+            for stock_id, new_price, price_change in updates:
+                position = self._index.get(stock_id)
+                if position is not None:
+                    rows[position] = dict(rows[position], current_price=float(new_price), price_change=float(price_change))
+            self._publish(rows)
+
+    def get(self, stock_id):
+        """Row of one stock, or None if it is not in the snapshot"""
+        with self._lock:
+            position = self._index.get(stock_id)
+            return self.rows[position] if position is not None else None
+
+    def select(self, symbols):
+        """Return (ETag, JSON bytes) for the given symbols only"""
+        symbols = {symbol.upper() for symbol in symbols}
+        with self._lock:
+            rows = [row for row in self.rows if row['symbol'] in symbols]
+        body = json.dumps(rows, separators=(',', ':')).encode()
+        return etag_for(body), body
+
+    def current(self):
+        """Return (ETag, JSON bytes) for the whole market"""
+        with self._lock:
+            return self.etag, self.body
+
+
+def etag_for(body):
+    """ETag of a response body, the same in every process"""
+    return hashlib.blake2b(body, digest_size=16).hexdigest()
+
+
+class MarketState:
+    """
+    Process-wide copy of the market open/closed flag. Writes made by this
+    process and change notifications are applied with set(); the database
+    is only read again once the copy is older than ttl seconds.
+    Threads can wait() for the flag to change.
+    """
+
+    def __init__(self, ttl=1):
+        self.ttl = ttl
+        self.is_active = None
+        self._refreshed_at = None
+        self._changed = Condition()
+
+    @property
+    def needs_refresh(self):
+        return self._refreshed_at is None or time.monotonic() - self._refreshed_at > self.ttl
+
+    def set(self, is_active):
+        with self._changed:
+            changed = is_active != self.is_active
+            self.is_active = is_active
+            self._refreshed_at = time.monotonic()
+            if changed:
+                self._changed.notify_all()
+
+    def wait(self, timeout):
+        """Sleep for up to timeout seconds, waking early if the flag changes"""
+        with self._changed:
+            self._changed.wait(timeout)
@@ -0,0 +1,250 @@
+"""
+Query plan check for the hot tables.
+
+Builds the schema from schema.sql and the index migrations in a scratch
+schema of a local Postgres, seeds it with synthetic data, and EXPLAINs the
+queries the backend runs most. Each plan must use the index meant for it
+and must not fall back to a sequential scan of the table; the script exits
+with status 1 otherwise, so it can run in CI.
+
+Never point this at the Supabase database: it creates an auth.uid() stub
+when one does not exist and drops its scratch schema on every run.
+
+Run with:
+    PLAN_CHECK_DATABASE_URL=postgresql://postgres@localhost/plan_check python check_query_plans.py
+"""
+from dotenv import load_dotenv
+import json
+import os
+import sys
+import time
+import psycopg2
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+
+load_dotenv()
+
+SCRATCH_SCHEMA = 'plan_check'
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+# Migrations applied on top of schema.sql: the columns the checked queries
+# use, then the indexes
+MIGRATIONS = [
+    'migrations/add_error_column.sql',
+    'migrations/add_orders_pagination_indexes.sql',
+    'migrations/add_hot_path_indexes.sql'
+]
+
+# Synthetic data sizes
+SEED_USERS = int(os.getenv('SEED_USERS', '2000'))
+SEED_ADMINS = int(os.getenv('SEED_ADMINS', '5'))
+SEED_STOCKS = int(os.getenv('SEED_STOCKS', '50'))
+SEED_ORDERS = int(os.getenv('SEED_ORDERS', '100000'))
+# Share of orders still pending, as on a typical trading day
+SEED_PENDING_RATIO = float(os.getenv('SEED_PENDING_RATIO', '0.02'))
+
+# Stands in for Supabase's auth schema on a plain Postgres
+AUTH_STUB = """
+    CREATE EXTENSION IF NOT EXISTS "uuid-ossp";
+    CREATE SCHEMA IF NOT EXISTS auth;
+    CREATE TABLE IF NOT EXISTS auth.users (id UUID PRIMARY KEY);
+    DO $$
+    BEGIN
+        IF NOT EXISTS (SELECT 1 FROM pg_roles WHERE rolname = 'authenticated') THEN
+            CREATE ROLE authenticated;
+        END IF;
+        IF to_regprocedure('auth.uid()') IS NULL THEN
+            CREATE FUNCTION auth.uid() RETURNS UUID
+            LANGUAGE sql STABLE
+            AS 'SELECT NULLIF(current_setting(''request.jwt.claim.sub'', true), '''')::UUID';
+        END IF;
+    END $$;
+"""
+
+# Not part of schema.sql; columns as written by settle_order
+TRANSACTIONS_TABLE = """
+    CREATE TABLE IF NOT EXISTS transactions (
+        id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
+        user_id UUID REFERENCES profiles(user_id),
+        stock_id UUID REFERENCES stocks(id),
+        order_id UUID REFERENCES orders(id),
+        type TEXT NOT NULL,
+        quantity INTEGER NOT NULL,
+        price DECIMAL(15, 2) NOT NULL,
+        total_amount DECIMAL(20, 2) NOT NULL,
+        created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+    );
+"""
+
+SEED = """
+    WITH new_users AS (
+        INSERT INTO auth.users (id)
+        SELECT uuid_generate_v4() FROM generate_series(1, %(users)s)
+        RETURNING id
+    )
+    INSERT INTO profiles (user_id, email, role)
+    SELECT id, 'user' || row_number() OVER () || '-' || id || '@example.com',
+           CASE WHEN row_number() OVER () <= %(admins)s THEN 'admin' ELSE 'user' END
+    FROM new_users;
+
+    INSERT INTO stocks (name, symbol, current_price)
+    SELECT 'Stock ' || n, 'S' || n, 10 + random() * 1000
+    FROM generate_series(1, %(stocks)s) n;
+
+    CREATE TEMP TABLE seed_users AS SELECT user_id, row_number() OVER () AS n FROM profiles;
+    CREATE TEMP TABLE seed_stocks AS SELECT id, row_number() OVER () AS n FROM stocks;
+
+    INSERT INTO orders (user_id, stock_id, type, quantity, price, status, created_at)
+    SELECT u.user_id, s.id,
+           CASE WHEN random() < 0.5 THEN 'buy' ELSE 'sell' END,
+           1 + (random() * 100)::INTEGER,
+           1 + random() * 1000,
+           CASE WHEN random() < %(pending)s THEN 'pending'
+                WHEN random() < 0.8 THEN 'completed'
+                ELSE 'cancelled' END,
+           NOW() - random() * INTERVAL '365 days'
+    FROM generate_series(1, %(orders)s) g
+    JOIN seed_users u ON u.n = 1 + g %% (SELECT COUNT(*) FROM seed_users)
+    JOIN seed_stocks s ON s.n = 1 + (g * 7) %% (SELECT COUNT(*) FROM seed_stocks);
+
+    INSERT INTO transactions (user_id, stock_id, order_id, type, quantity, price, total_amount, created_at)
+    SELECT user_id, stock_id, id, type, quantity, price, quantity * price, created_at
+    FROM orders WHERE status = 'completed';
+
+    INSERT INTO user_stocks (user_id, stock_id, quantity)
+    SELECT DISTINCT user_id, stock_id, 10 FROM orders WHERE type = 'buy' AND status = 'completed';
+
+    ANALYZE;
+"""
+
+# (name, query, index the plan must use, table it must not scan sequentially)
+CHECKS = [
+    (
+        'pending orders of a stock (get_pending_orders)',
+        "SELECT * FROM orders WHERE status = 'pending' AND stock_id = %(stock_id)s ORDER BY created_at",
+        'idx_orders_status_stock_created', 'orders'
+    ),
+    (
+        'cancel pending orders on a halt (cancel_pending_orders)',
+        "UPDATE orders SET status = 'cancelled', error = 'Market closed' WHERE status = 'pending'",
+        'idx_orders_status_stock_created', 'orders'
+    ),
+    (
+        'order history page (GET /api/orders)',
+        "SELECT * FROM orders WHERE user_id = %(user_id)s ORDER BY created_at DESC, id DESC LIMIT 51",
+        'idx_orders_user_created', 'orders'
+    ),
+    (
+        'order history filtered by stock (GET /api/orders?stock_id=)',
+        "SELECT * FROM orders WHERE user_id = %(user_id)s AND stock_id = %(stock_id)s "
+        "ORDER BY created_at DESC, id DESC LIMIT 51",
+        'idx_orders_user_created', 'orders'
+    ),
+    (
+        'admin check (is_admin() in the RLS policies)',
+        "SELECT 1 FROM profiles WHERE user_id = %(user_id)s AND role = 'admin'",
+        'profiles_pkey', 'profiles'
+    ),
+    (
+        'holders of a stock',
+        "SELECT user_id, quantity FROM user_stocks WHERE stock_id = %(stock_id)s",
+        'idx_user_stocks_stock', 'user_stocks'
+    ),
+    (
+        'filled quantity of pending orders (load_order_books)',
+        "SELECT order_id, quantity FROM transactions WHERE order_id = ANY(%(order_ids)s::UUID[])",
+        'idx_transactions_order', 'transactions'
+    ),
+]
+
+
+def read_sql(path):
+    with open(os.path.join(BACKEND_DIR, path)) as f:
+        return f.read()
+
+
+def plan_nodes(node):
+    """Yield every node of an EXPLAIN (FORMAT JSON) plan tree"""
+    yield node
+    for child in node.get('Plans', []):
+        yield from plan_nodes(child)
+
+
+def build_database(cur):
+    cur.execute(AUTH_STUB)
+    cur.execute(f'DROP SCHEMA IF EXISTS {SCRATCH_SCHEMA} CASCADE')
+    cur.execute(f'CREATE SCHEMA {SCRATCH_SCHEMA}')
+    cur.execute(f'SET search_path = {SCRATCH_SCHEMA}, public')
+    # Functions pinned to search_path = public cannot see the scratch tables
+    # when their bodies are validated
+    cur.execute('SET check_function_bodies = off')
+    cur.execute(read_sql('schema.sql'))
+    cur.execute(TRANSACTIONS_TABLE)
+    for migration in MIGRATIONS:
+        cur.execute(read_sql(migration))
+
+    started = time.monotonic()
+    cur.execute(SEED, {
+        'users': SEED_USERS,
+        'admins': SEED_ADMINS,
+        'stocks': SEED_STOCKS,
+        'orders': SEED_ORDERS,
+        'pending': SEED_PENDING_RATIO
+    })
+    print(f"Seeded {SEED_ORDERS} orders for {SEED_USERS} users in {time.monotonic() - started:.1f}s")
+
+
+def sample_parameters(cur):
+    cur.execute("SELECT stock_id, user_id FROM orders WHERE status = 'pending' LIMIT 1")
+    stock_id, user_id = cur.fetchone()
+    cur.execute("SELECT array_agg(id) FROM orders WHERE status = 'pending' AND stock_id = %s", (stock_id,))
+    return {'stock_id': stock_id, 'user_id': user_id, 'order_ids': cur.fetchone()[0]}
+
+
+def check_plan(cur, name, query, parameters, index, table):
+    """EXPLAIN one query; returns its report entry"""
+    cur.execute('EXPLAIN (FORMAT JSON) ' + query, parameters)
+    plan = cur.fetchone()[0][0]['Plan']
+    nodes = list(plan_nodes(plan))
+    indexes = sorted({node['Index Name'] for node in nodes if 'Index Name' in node})
+    seq_scans = sorted({node['Relation Name'] for node in nodes if node['Node Type'] == 'Seq Scan'})
+
+    passed = index in indexes and table not in seq_scans
+    return {
+        'check': name,
+        'passed': passed,
+        'expected_index': index,
+        'indexes': indexes,
+        'seq_scans': seq_scans,
+        'total_cost': plan['Total Cost']
+    }
+
+
+def check_query_plans():
+    database_url = os.getenv('PLAN_CHECK_DATABASE_URL')
+    if not database_url:
+        print("PLAN_CHECK_DATABASE_URL environment variable not found")
+        return False
+
+    conn = psycopg2.connect(database_url)
+    conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+    cur = conn.cursor()
+    try:
+        build_database(cur)
+        parameters = sample_parameters(cur)
+        report = [check_plan(cur, name, query, parameters, index, table) for name, query, index, table in CHECKS]
+    finally:
+        cur.execute(f'DROP SCHEMA IF EXISTS {SCRATCH_SCHEMA} CASCADE')
+        cur.close()
+        conn.close()
+
+    print(json.dumps(report, indent=2))
+    failed = [entry['check'] for entry in report if not entry['passed']]
+    if failed:
+        print(f"{len(failed)} query plan(s) regressed: {', '.join(failed)}")
+        return False
+
+    print(f"All {len(report)} query plans use their indexes")
+    return True
+
+
+if __name__ == "__main__":
+    sys.exit(0 if check_query_plans() else 1)
@@ -0,0 +1,206 @@
+"""
+Database round trip instrumentation.
+
+InstrumentedClient wraps a Supabase (or async PostgREST) client and times
+every execute(), attributing it to the table or rpc it targets and to the
+route of the request being served. Queries made outside a request, by the
+engine threads, are attributed to the 'background' route.
+
+Totals per route and table are kept for the Prometheus /api/metrics
+endpoint; the totals of the current request can be read back with end() to
+report them in response headers.
+"""
+from contextvars import ContextVar
+import inspect
+from threading import Lock
+import time
+
+BACKGROUND_ROUTE = 'background'
+
+
+class RequestMetrics:
+    """Round trips made while serving one request"""
+
+    __slots__ = ('route', 'queries', 'seconds', 'tables')
+
+    def __init__(self, route):
+        self.route = route
+        self.queries = 0
+        self.seconds = 0.0
+        self.tables = {}
+
+
+class DbMetrics:
+    """Query counts and time per route and table, plus requests per route"""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._current = ContextVar('db_request_metrics', default=None)
+        self.queries = {}  # (route, table) -> count
+        self.seconds = {}  # (route, table) -> total seconds
+        self.requests = {}  # route -> count
+        self.request_queries = {}  # route -> queries made by all its requests
+        self.max_request_queries = {}  # route -> most queries made by one request
+
+    def begin(self, route):
+        """Start attributing this context's queries to a request of route"""
+        self._current.set(RequestMetrics(route))
+
+    def end(self):
+        """Finish the current request; returns its RequestMetrics, or None"""
+        current = self._current.get()
+        if current is None:
+            return None
+        self._current.set(None)
+        with self._lock:
+            self.requests[current.route] = self.requests.get(current.route, 0) + 1
+            self.request_queries[current.route] = self.request_queries.get(current.route, 0) + current.queries
+            if current.queries > self.max_request_queries.get(current.route, 0):
+                self.max_request_queries[current.route] = current.queries
+        return current
+
+    def record(self, table, seconds):
+        current = self._current.get()
+        route = current.route if current is not None else BACKGROUND_ROUTE
+        key = (route, table)
+        with self._lock:
+            # A request's queries may run on several threads at once
+            if current is not None:
+                current.queries += 1
+                current.seconds += seconds
+                current.tables[table] = current.tables.get(table, 0) + 1
+            self.queries[key] = self.queries.get(key, 0) + 1
+            self.seconds[key] = self.seconds.get(key, 0.0) + seconds
+
+    def prometheus(self, prefix='chesa'):
+        """Totals in the Prometheus text exposition format"""
+        with self._lock:
+            queries = sorted(self.queries.items())
+            seconds = sorted(self.seconds.items())
+            requests = sorted(self.requests.items())
+            request_queries = sorted(self.request_queries.items())
+            max_request_queries = sorted(self.max_request_queries.items())
+
+        lines = [
+            f'# HELP {prefix}_db_queries_total Database round trips by route and table',
+            f'# TYPE {prefix}_db_queries_total counter'
+        ]
+        lines += [f'{prefix}_db_queries_total{labels(route=route, table=table)} {count}' for (route, table), count in queries]
+        lines += [
+            f'# HELP {prefix}_db_query_seconds_total Time spent waiting on the database by route and table',
+            f'# TYPE {prefix}_db_query_seconds_total counter'
+        ]
+        lines += [f'{prefix}_db_query_seconds_total{labels(route=route, table=table)} {total:.6f}' for (route, table), total in seconds]
+        lines += [
+            f'# HELP {prefix}_http_requests_total Requests served by route',
+            f'# TYPE {prefix}_http_requests_total counter'
+        ]
+        lines += [f'{prefix}_http_requests_total{labels(route=route)} {count}' for route, count in requests]
+        lines += [
+            f'# HELP {prefix}_http_request_db_queries_total Database round trips made by the requests of a route',
+            f'# TYPE {prefix}_http_request_db_queries_total counter'
+        ]
+        lines += [f'{prefix}_http_request_db_queries_total{labels(route=route)} {count}' for route, count in request_queries]
+        lines += [
+            f'# HELP {prefix}_http_request_db_queries_max Most database round trips made by one request of a route',
+            f'# TYPE {prefix}_http_request_db_queries_max gauge'
+        ]
+        lines += [f'{prefix}_http_request_db_queries_max{labels(route=route)} {count}' for route, count in max_request_queries]
+        return '\n'.join(lines) + '\n'
+
+
+def labels(**values):
+    """Prometheus label set, with values escaped"""
+    escaped = []
+    for name, value in values.items():
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"')
+        escaped.append(f'{name}="{value}"')
+    return '{' + ','.join(escaped) + '}'
+
+
+class InstrumentedQuery:
+    """Proxy for a query builder that times its execute()"""
+
+    __slots__ = ('_builder', '_table', '_metrics')
+
+    def __init__(self, builder, table, metrics):
+        object.__setattr__(self, '_builder', builder)
+        object.__setattr__(self, '_table', table)
+        object.__setattr__(self, '_metrics', metrics)
+
+    def __getattr__(self, name):
+        attr = getattr(self._builder, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            result = attr(*args, **kwargs)
+            # Builder methods return the next builder; keep wrapping those
+            if hasattr(result, 'execute'):
+                return InstrumentedQuery(result, self._table, self._metrics)
+            return result
+        return call
+
+    def __setattr__(self, name, value):
+        # e.g. query.params = query.params.add(...)
+        setattr(self._builder, name, value)
+
+    def execute(self):
+        started = time.perf_counter()
+        try:
+            result = self._builder.execute()
+        except Exception:
+            self._metrics.record(self._table, time.perf_counter() - started)
+            raise
+        if inspect.isawaitable(result):
+            return self._timed(result, started)
+        self._metrics.record(self._table, time.perf_counter() - started)
+        return result
+
+    async def _timed(self, result, started):
+        try:
+            return await result
+        finally:
+            self._metrics.record(self._table, time.perf_counter() - started)
+
+
+class InstrumentedClient:
+    """Drop-in for the Supabase client whose queries are counted and timed"""
+
+    def __init__(self, client, metrics):
+        self._client = client
+        self._metrics = metrics
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def table(self, name):
+        return InstrumentedQuery(self._client.table(name), name, self._metrics)
+
+    def from_(self, name):
+        return InstrumentedQuery(self._client.from_(name), name, self._metrics)
+
+    def rpc(self, name, params=None):
+        return InstrumentedQuery(self._client.rpc(name, params or {}), f'rpc:{name}', self._metrics)
+
+
+def shard_pool_prometheus(pool, prefix='chesa'):
+    """Queue depth and items processed by each shard of a ShardPool"""
+    shards = pool.metrics(hot=0)
+    lines = [
+        f'# HELP {prefix}_shard_queue_depth Items waiting in a shard',
+        f'# TYPE {prefix}_shard_queue_depth gauge'
+    ]
+    lines += [
+        f"{prefix}_shard_queue_depth{labels(pool=pool.name, shard=shard['shard'])} {shard['queue_depth']}"
+        for shard in shards
+    ]
+    lines += [
+        f'# HELP {prefix}_shard_processed_total Items processed by a shard',
+        f'# TYPE {prefix}_shard_processed_total counter'
+    ]
+    lines += [
+        f"{prefix}_shard_processed_total{labels(pool=pool.name, shard=shard['shard'])} {shard['processed']}"
+        for shard in shards
+    ]
+    return '\n'.join(lines) + '\n'
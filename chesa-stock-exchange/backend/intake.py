@@ -0,0 +1,110 @@
+"""
+Intake of new orders into the matching engine.
+
+IntakeGate keeps new orders away from the order books while they are being
+rebuilt, at start-up or when the market reopens, and after a halt cleared
+them. Orders let in before it closes finish matching first.
+
+MicroBatcher does per-symbol micro-batching: orders for a symbol are
+collected for that symbol's batching window, starting when the first one
+arrives, and then handed to the engine together in arrival order. A window
+of 0 hands every order over as soon as it arrives. Symbols with no incoming
+orders cost nothing.
+"""
+from contextlib import contextmanager
+from heapq import heappop, heappush
+from threading import Condition
+import time
+
+
+class IntakeClosed(Exception):
+    """The gate did not open in time for an order"""
+
+
+class IntakeGate:
+    def __init__(self):
+        self._open = False
+        self._active = 0  # orders let in and still matching
+        self._condition = Condition()
+
+    @property
+    def is_open(self):
+        return self._open
+
+    def open(self):
+        with self._condition:
+            self._open = True
+            self._condition.notify_all()
+
+    def close(self):
+        """Stop letting orders in, then wait for the ones already in"""
+        with self._condition:
+            self._open = False
+            self._condition.wait_for(lambda: self._active == 0)
+
+    @contextmanager
+    def admit(self, timeout=None):
+        """
+        Hold the gate for the body of the with statement, waiting up to
+        timeout seconds for it to open. Raises IntakeClosed if it did not.
+        """
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._open, timeout):
+                raise IntakeClosed()
+            self._active += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._active -= 1
+                if not self._active:
+                    self._condition.notify_all()
+
+
+class MicroBatcher:
+    def __init__(self, flush, window_for=lambda key: 0.0):
+        """
+        flush(key, items) is called from the run() thread with each batch
+        window_for(key) returns the batching window in seconds for a key
+        """
+        self.flush = flush
+        self.window_for = window_for
+        self._pending = {}    # key -> items waiting for their window
+        self._deadlines = []  # heap of (deadline, key)
+        self._condition = Condition()
+
+    def add(self, key, item):
+        with self._condition:
+            batch = self._pending.get(key)
+            if batch is not None:
+                batch.append(item)
+                return
+            self._pending[key] = [item]
+            heappush(self._deadlines, (time.monotonic() + self.window_for(key), key))
+            self._condition.notify()
+
+    def depth(self):
+        """Number of items waiting, per key"""
+        with self._condition:
+            return {key: len(items) for key, items in self._pending.items()}
+
+    def run(self):
+        """Thread loop: flush each key's batch once its window has passed"""
+        while True:
+            with self._condition:
+                while not self._deadlines:
+                    self._condition.wait()
+
+                deadline, key = self._deadlines[0]
+                delay = deadline - time.monotonic()
+                if delay > 0:
+                    self._condition.wait(delay)
+                    continue
+
+                heappop(self._deadlines)
+                items = self._pending.pop(key)
+
+            try:
+                self.flush(key, items)
+            except Exception as e:
+                print(f"Error flushing batch of {len(items)} for {key}: {str(e)}")
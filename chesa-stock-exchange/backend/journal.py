@@ -0,0 +1,212 @@
+"""
+Append-only, memory-mapped journal for the matching engine.
+
+Each record is a JSON object stored as its length, its CRC32 and its body.
+append() only copies a record into the mapping, so it is cheap enough to
+call with a book lock held. commit() makes everything appended so far
+durable with one msync; threads that commit while a flush is running wait
+for it and then share the next one (group commit), so a burst of orders
+costs a few flushes instead of one each.
+
+On open the journal is scanned up to the first empty, torn or corrupt
+record, which marks the end: a crash mid-append loses at most records
+that were never committed.
+"""
+import json
+import mmap
+import os
+import struct
+from threading import Condition
+import zlib
+
+# Body length and CRC32 of the body
+HEADER = struct.Struct('<II')
+
+# The file grows in steps of this many bytes
+SEGMENT_SIZE = 64 * 1024 * 1024
+
+
+class Journal:
+    def __init__(self, path, segment_size=SEGMENT_SIZE):
+        self.path = path
+        self.segment_size = segment_size
+        self._cond = Condition()
+        self._flushing = False
+        # Records whose events are not all in the database yet: seq -> how
+        # many are left, None until expect() counts them
+        self._unsettled = {}
+        self._open()
+
+    def _open(self):
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        size = os.fstat(self._fd).st_size
+        if size == 0:
+            size = self.segment_size
+            os.ftruncate(self._fd, size)
+        self._map = mmap.mmap(self._fd, size)
+
+        self._end = 0
+        self.seq = 0
+        for record, end in self._scan():
+            self._end = end
+            self.seq = record['seq'] + 1
+        self._flushed = self._end
+
+    def _scan(self):
+        """Yield (record, offset after it) for every intact record"""
+        offset = 0
+        size = len(self._map)
+        while offset + HEADER.size <= size:
+            length, checksum = HEADER.unpack_from(self._map, offset)
+            start = offset + HEADER.size
+            if length == 0 or start + length > size:
+                return
+            body = self._map[start:start + length]
+            if zlib.crc32(body) != checksum:
+                print(f"Order journal {self.path}: corrupt record at offset {offset}, ignoring the rest")
+                return
+            offset = start + length
+            yield json.loads(body), offset
+
+    def records(self):
+        """Every record in the journal, oldest first"""
+        with self._cond:
+            return [record for record, _ in self._scan()]
+
+    def append(self, record, events=False):
+        """
+        Add a record, stamped with the next sequence number, without waiting
+        for it to be durable. Returns the sequence number.
+        With events=True the record counts as outstanding from now on, until
+        the events expect() counts for it are acknowledged or discarded.
+        """
+        with self._cond:
+            record['seq'] = self.seq
+            if events:
+                self._unsettled[self.seq] = None
+            body = json.dumps(record, separators=(',', ':')).encode()
+            needed = HEADER.size + len(body)
+            if self._end + needed > len(self._map):
+                self._grow(needed)
+
+            HEADER.pack_into(self._map, self._end, len(body), zlib.crc32(body))
+            self._map[self._end + HEADER.size:self._end + needed] = body
+            self._end += needed
+            self.seq += 1
+            return record['seq']
+
+    def _grow(self, needed):
+        """Extend the file and remap it; called with the lock held"""
+        while self._flushing:
+            self._cond.wait()
+        self._map.flush()
+        self._map.close()
+        size = os.fstat(self._fd).st_size + max(self.segment_size, needed)
+        os.ftruncate(self._fd, size)
+        self._map = mmap.mmap(self._fd, size)
+
+    def commit(self):
+        """Block until every record appended so far is on disk"""
+        with self._cond:
+            target = self._end
+            while self._flushed < target:
+                if self._flushing:
+                    self._cond.wait()
+                    continue
+
+                # Lead a flush of everything appended until now
+                self._flushing = True
+                start = self._flushed - self._flushed % mmap.ALLOCATIONGRANULARITY
+                end = self._end
+                self._cond.release()
+                try:
+                    self._map.flush(start, end - start)
+                finally:
+                    self._cond.acquire()
+                    self._flushing = False
+                    self._cond.notify_all()
+                self._flushed = max(self._flushed, end)
+
+    @property
+    def size(self):
+        """Bytes of records in the journal"""
+        with self._cond:
+            return self._end
+
+    @property
+    def outstanding(self):
+        """Number of records whose events are not all in the database"""
+        with self._cond:
+            return len(self._unsettled)
+
+    def expect(self, seq, count):
+        """Count the events of record seq handed to the database"""
+        with self._cond:
+            if count:
+                self._unsettled[seq] = count
+            else:
+                self._unsettled.pop(seq, None)
+
+    def acknowledge(self, event_ids):
+        """Record that events, identified by (record seq, index), are in the database"""
+        self.append({'kind': 'persisted', 'events': event_ids})
+        self._settle(event_ids)
+
+    def discard(self, event_ids):
+        """
+        Record that events were given up on after failing to be written, so
+        they stop holding back compaction and are not replayed
+        """
+        self.append({'kind': 'discarded', 'events': event_ids})
+        self._settle(event_ids)
+
+    def _settle(self, event_ids):
+        with self._cond:
+            for seq, _ in event_ids:
+                left = self._unsettled.get(seq)
+                if left is None:
+                    continue
+                if left > 1:
+                    self._unsettled[seq] = left - 1
+                else:
+                    del self._unsettled[seq]
+
+    def compact(self, records):
+        """
+        Replace the journal with records, e.g. a snapshot of the resting
+        orders once every journaled event is in the database. The new file
+        is written aside and renamed over the old one, so a crash leaves
+        one or the other.
+        """
+        with self._cond:
+            while self._flushing:
+                self._cond.wait()
+
+            temporary = self.path + '.compact'
+            with open(temporary, 'wb') as f:
+                seq = self.seq
+                for record in records:
+                    record['seq'] = seq
+                    body = json.dumps(record, separators=(',', ':')).encode()
+                    f.write(HEADER.pack(len(body), zlib.crc32(body)))
+                    f.write(body)
+                    seq += 1
+                f.truncate(max(f.tell() + HEADER.size, self.segment_size))
+                f.flush()
+                os.fsync(f.fileno())
+
+            self._map.close()
+            os.close(self._fd)
+            os.replace(temporary, self.path)
+            directory = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+            try:
+                os.fsync(directory)
+            finally:
+                os.close(directory)
+            self._open()
+
+    def close(self):
+        self.commit()
+        with self._cond:
+            self._map.close()
+            os.close(self._fd)
@@ -0,0 +1,223 @@
+"""
+Incrementally maintained leaderboard.
+
+Keeps every user's cash, holdings and total value in memory together with a
+ranking sorted by total value. Fills touch one user and price changes touch
+the holders of one stock (found through a stock -> holders index), so the
+ranking never has to be rebuilt from scratch. Reading the top k entries is a
+slice of the sorted ranking.
+
+Balances, prices and values are kept in integer cents, so applying fills
+one after another does not drift; top() converts back to amounts.
+"""
+from bisect import bisect_left, insort
+from threading import Lock
+import time
+
+from money import from_cents, to_cents
+
+
+class Leaderboard:
+    def __init__(self, load_timeout=60):
+        self._lock = Lock()
+        self.emails = {}
+        self.balances = {}
+        self.holdings = {}   # user_id -> {stock_id: quantity}
+        self.holders = {}    # stock_id -> set of user_ids
+        self.prices = {}     # stock_id -> current price in cents
+        self.values = {}     # user_id -> total value in cents
+        self.ranking = []    # sorted (-total_value, user_id)
+        self.loaded_at = None
+        # Changes made while a load reads the database, None when there is
+        # no load; given up after load_timeout seconds without one
+        self._loading = None
+        self._loading_since = None
+        self.load_timeout = load_timeout
+        # user_id -> [settlements sent to the database and not applied yet,
+        # when the last one was sent]; also given up after load_timeout
+        self._settling = {}
+        # Users whose state load() had to guess, see load()
+        self._unsure = set()
+
+    def begin_load(self):
+        """Call before reading the profiles and prices passed to load()"""
+        with self._lock:
+            self._loading = []
+            self._loading_since = time.monotonic()
+
+    def settling(self, user_ids):
+        """Call before sending settlements for user_ids to the database"""
+        with self._lock:
+            now = time.monotonic()
+            for user_id in user_ids:
+                entry = self._settling.setdefault(user_id, [0, now])
+                entry[0] += 1
+                entry[1] = now
+
+    def settled(self, user_ids):
+        """Call once those settlements were applied with apply_fill, or failed"""
+        with self._lock:
+            for user_id in user_ids:
+                entry = self._settling.get(user_id)
+                if entry is None:
+                    continue
+                entry[0] -= 1
+                if entry[0] <= 0:
+                    del self._settling[user_id]
+
+    def _record(self, change):
+        if self._loading is None:
+            return
+        if time.monotonic() - self._loading_since > self.load_timeout:
+            self._loading = None
+            return
+        self._loading.append(change)
+
+    def load(self, profiles, prices):
+        """
+        Replace the whole state from profile rows (with embedded user_stocks)
+        and a stock_id -> price mapping
+        The rows may predate changes made since begin_load(), which are
+        carried over: prices and new users are applied again, and users who
+        traded or have settlements in flight keep the state the fills were
+        applied to. Without one to keep, e.g. on the first load, their fills
+        are replayed on their rows, which may already have some of them; such
+        users are taken from their rows again by a load they are idle for.
+        """
+        with self._lock:
+            changes = self._loading or []
+            self._loading = None
+            now = time.monotonic()
+            for user_id, (_, since) in list(self._settling.items()):
+                if now - since > self.load_timeout:
+                    del self._settling[user_id]
+
+            traded = set(self._settling)
+            traded.update(change[1] for change in changes if change[0] == 'fill')
+            kept = {
+                user_id: (self.balances[user_id], self.holdings[user_id])
+                for user_id in traded
+                if user_id in self.balances and user_id not in self._unsure
+            }
+
+            self.emails = {}
+            self.balances = {}
+            self.holdings = {}
+            self.prices = {stock_id: to_cents(price) for stock_id, price in prices.items()}
+
+            for profile in profiles:
+                user_id = profile['user_id']
+                self.emails[user_id] = profile['email']
+                self.balances[user_id] = to_cents(profile['balance'])
+                user_holdings = self.holdings[user_id] = {}
+                for holding in profile.get('user_stocks') or []:
+                    stock_id = holding['stock_id']
+                    user_holdings[stock_id] = user_holdings.get(stock_id, 0) + holding['quantity']
+
+            for kind, *change in changes:
+                if kind == 'price':
+                    stock_id, price_cents = change
+                    self.prices[stock_id] = price_cents
+                elif kind == 'user':
+                    user_id, email, balance_cents = change
+                    if user_id not in self.emails:
+                        self.emails[user_id] = email
+                        self.balances[user_id] = balance_cents
+                        self.holdings[user_id] = {}
+                elif kind == 'fill':
+                    user_id, stock_id, quantity, cash_cents = change
+                    if user_id not in kept and user_id in self.balances:
+                        self.balances[user_id] += cash_cents
+                        self._trade(self.holdings[user_id], stock_id, quantity)
+            for user_id, (balance, user_holdings) in kept.items():
+                if user_id in self.emails:
+                    self.balances[user_id] = balance
+                    self.holdings[user_id] = user_holdings
+            self._unsure = traded - set(kept)
+
+            self.holders = {}
+            for user_id, user_holdings in self.holdings.items():
+                for stock_id in user_holdings:
+                    self.holders.setdefault(stock_id, set()).add(user_id)
+            self.values = {user_id: self._value(user_id) for user_id in self.emails}
+            self.ranking = sorted((-value, user_id) for user_id, value in self.values.items())
+            self.loaded_at = time.monotonic()
+
+    @property
+    def loaded(self):
+        return self.loaded_at is not None
+
+    def _value(self, user_id):
+        total = self.balances.get(user_id, 0)
+        for stock_id, quantity in self.holdings.get(user_id, {}).items():
+            total += quantity * self.prices.get(stock_id, 0)
+        return total
+
+    def _rerank(self, user_id):
+        old_value = self.values.get(user_id)
+        if old_value is not None:
+            index = bisect_left(self.ranking, (-old_value, user_id))
+            if index < len(self.ranking) and self.ranking[index] == (-old_value, user_id):
+                self.ranking.pop(index)
+
+        new_value = self._value(user_id)
+        self.values[user_id] = new_value
+        insort(self.ranking, (-new_value, user_id))
+
+    def add_user(self, user_id, email, balance):
+        with self._lock:
+            self._record(('user', user_id, email, to_cents(balance)))
+            if not self.loaded or user_id in self.emails:
+                return
+            self.emails[user_id] = email
+            self.balances[user_id] = to_cents(balance)
+            self.holdings[user_id] = {}
+            self._rerank(user_id)
+
+    def apply_fill(self, user_id, stock_id, quantity, cash_cents):
+        """
+        Apply a settled trade to one user: quantity is the change in shares
+        (negative for a sell) and cash_cents the change in balance, in cents
+        """
+        with self._lock:
+            self._record(('fill', user_id, stock_id, quantity, cash_cents))
+            if not self.loaded or user_id not in self.emails:
+                return
+
+            self.balances[user_id] += cash_cents
+            if self._trade(self.holdings[user_id], stock_id, quantity) > 0:
+                self.holders.setdefault(stock_id, set()).add(user_id)
+            else:
+                self.holders.get(stock_id, set()).discard(user_id)
+            self._rerank(user_id)
+
+    @staticmethod
+    def _trade(user_holdings, stock_id, quantity):
+        """Change a user's quantity of a stock, returns the new quantity"""
+        new_quantity = user_holdings.get(stock_id, 0) + quantity
+        if new_quantity > 0:
+            user_holdings[stock_id] = new_quantity
+        else:
+            user_holdings.pop(stock_id, None)
+        return new_quantity
+
+    def set_price(self, stock_id, price):
+        """Revalue every holder of a stock after its price changed"""
+        with self._lock:
+            self._record(('price', stock_id, to_cents(price)))
+            if not self.loaded:
+                return
+            self.prices[stock_id] = to_cents(price)
+            for user_id in self.holders.get(stock_id, ()):
+                self._rerank(user_id)
+
+    def top(self, limit, offset=0):
+        """Return one page of the ranking, best first"""
+        with self._lock:
+            return [
+                {'user_id': user_id, 'email': self.emails[user_id], 'total_value': from_cents(-negative_value)}
+                for negative_value, user_id in self.ranking[offset:offset + limit]
+            ]
+
+    def __len__(self):
+        return len(self.ranking)
@@ -0,0 +1,147 @@
+"""
+RLS policy measurement.
+
+Seeds a scratch schema the same way check_query_plans.py does (100k orders
+by default), then times reads made as the authenticated role, for an admin
+and for a regular user, under three versions of the profiles and orders
+policies:
+    legacy  - the original policies, with admin subqueries on profiles
+              (reads that touch profiles fail with infinite recursion)
+    per_row - is_admin() and auth.uid() called directly, once per row
+    optimized - migrations/optimize_rls_policies.sql
+Prints the best execution time of each read as JSON, with the rows it
+returned so the versions can be checked to agree.
+
+Same warning as check_query_plans.py: only run it against a disposable
+local Postgres.
+
+Run with:
+    PLAN_CHECK_DATABASE_URL=postgresql://postgres@localhost/plan_check python measure_rls.py
+"""
+from dotenv import load_dotenv
+import json
+import os
+import sys
+import psycopg2
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+
+from check_query_plans import SCRATCH_SCHEMA, build_database, read_sql
+
+load_dotenv()
+
+# Runs of each read; the fastest is reported
+RLS_RUNS = int(os.getenv('RLS_RUNS', '5'))
+
+# Every policy the versions below define, so each version starts clean
+DROP_POLICIES = """
+    DROP POLICY IF EXISTS "Users can view own profile" ON profiles;
+    DROP POLICY IF EXISTS "Users can update own profile" ON profiles;
+    DROP POLICY IF EXISTS "Admins can do all" ON profiles;
+    DROP POLICY IF EXISTS "Users can view own orders" ON orders;
+    DROP POLICY IF EXISTS "Users can insert own orders" ON orders;
+    DROP POLICY IF EXISTS "Users can update own orders" ON orders;
+    DROP POLICY IF EXISTS "Admins can manage all orders" ON orders;
+"""
+
+LEGACY_POLICIES = DROP_POLICIES + """
+    CREATE POLICY "Users can view own profile" ON profiles
+        FOR SELECT USING (auth.uid() = user_id);
+    CREATE POLICY "Admins can do all" ON profiles
+        FOR ALL USING (auth.uid() IN (SELECT user_id FROM profiles WHERE role = 'admin'));
+    CREATE POLICY "Users can view own orders" ON orders
+        FOR SELECT USING (auth.uid() = user_id);
+    CREATE POLICY "Admins can manage all orders" ON orders
+        FOR ALL USING (EXISTS (SELECT 1 FROM profiles WHERE user_id = auth.uid() AND role = 'admin'));
+"""
+
+PER_ROW_POLICIES = DROP_POLICIES + """
+    CREATE POLICY "Users can view own profile" ON profiles
+        FOR SELECT USING (auth.uid() = user_id);
+    CREATE POLICY "Admins can do all" ON profiles
+        FOR ALL USING (is_admin());
+    CREATE POLICY "Users can view own orders" ON orders
+        FOR SELECT USING (auth.uid() = user_id);
+    CREATE POLICY "Admins can manage all orders" ON orders
+        FOR ALL USING (is_admin());
+"""
+
+# (name, query, run as admin)
+READS = [
+    ('admin reads all orders', 'SELECT * FROM orders', True),
+    ('admin reads all profiles', 'SELECT * FROM profiles', True),
+    ('user reads own orders', 'SELECT * FROM orders', False),
+    ('user reads own profile', 'SELECT * FROM profiles', False),
+]
+
+
+def apply_policies(cur, sql):
+    cur.execute(sql)
+    # is_admin() looks in public; the scratch tables live in their own schema
+    cur.execute(f'ALTER FUNCTION is_admin() SET search_path = {SCRATCH_SCHEMA}, public')
+
+
+def time_read(cur, user_id, query):
+    """Best execution time of query run as user_id through RLS"""
+    cur.execute('BEGIN')
+    try:
+        cur.execute('SET LOCAL ROLE authenticated')
+        cur.execute("SELECT set_config('request.jwt.claim.sub', %s, true)", (str(user_id),))
+        best = None
+        for _ in range(RLS_RUNS):
+            cur.execute('EXPLAIN (ANALYZE, FORMAT JSON) ' + query)
+            result = cur.fetchone()[0][0]
+            if best is None or result['Execution Time'] < best['ms']:
+                best = {'ms': round(result['Execution Time'], 2), 'rows': result['Plan']['Actual Rows']}
+        return best
+    except psycopg2.Error as e:
+        return {'error': str(e).strip()}
+    finally:
+        cur.execute('ROLLBACK')
+
+
+def measure_rls():
+    database_url = os.getenv('PLAN_CHECK_DATABASE_URL')
+    if not database_url:
+        print("PLAN_CHECK_DATABASE_URL environment variable not found")
+        return False
+
+    conn = psycopg2.connect(database_url)
+    conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+    cur = conn.cursor()
+    try:
+        build_database(cur)
+        cur.execute(f'GRANT USAGE ON SCHEMA {SCRATCH_SCHEMA}, auth TO authenticated')
+        cur.execute(f'GRANT SELECT ON ALL TABLES IN SCHEMA {SCRATCH_SCHEMA} TO authenticated')
+        cur.execute("SELECT user_id FROM profiles WHERE role = 'admin' LIMIT 1")
+        admin_id = cur.fetchone()[0]
+        cur.execute("SELECT user_id FROM profiles WHERE role = 'user' LIMIT 1")
+        user_id = cur.fetchone()[0]
+
+        report = {}
+        for version, sql in [
+            ('legacy', LEGACY_POLICIES),
+            ('per_row', PER_ROW_POLICIES),
+            ('optimized', DROP_POLICIES + read_sql('migrations/optimize_rls_policies.sql'))
+        ]:
+            apply_policies(cur, sql)
+            report[version] = {
+                name: time_read(cur, admin_id if as_admin else user_id, query)
+                for name, query, as_admin in READS
+            }
+    finally:
+        cur.execute(f'DROP SCHEMA IF EXISTS {SCRATCH_SCHEMA} CASCADE')
+        cur.close()
+        conn.close()
+
+    # Speedup of the optimized policies over calling the functions per row
+    report['speedup'] = {
+        name: round(report['per_row'][name]['ms'] / report['optimized'][name]['ms'], 1)
+        for name, _, _ in READS
+        if 'ms' in report['per_row'][name] and report['optimized'][name].get('ms')
+    }
+    print(json.dumps(report, indent=2))
+    return True
+
+
+if __name__ == "__main__":
+    sys.exit(0 if measure_rls() else 1)
@@ -15,6 +15,28 @@ BEGIN
 END;
 $$;
 
+-- Function to cancel every pending order in one statement, e.g. when the
+-- market is halted. reason_param is written to each order's error column.
+-- Returns the number of orders cancelled.
+CREATE OR REPLACE FUNCTION cancel_pending_orders(reason_param TEXT)
+RETURNS INTEGER
+SECURITY DEFINER
+SET search_path = public
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    cancelled INTEGER;
+BEGIN
+    UPDATE orders
+    SET status = 'cancelled',
+        error = reason_param
+    WHERE status = 'pending';
+
+    GET DIAGNOSTICS cancelled = ROW_COUNT;
+    RETURN cancelled;
+END;
+$$;
+
 -- Function to update stock price
 CREATE OR REPLACE FUNCTION update_stock_price(
     stock_id_param UUID,
@@ -33,3 +55,218 @@ BEGIN
     WHERE id = stock_id_param;
 END;
 $$;
+
+-- Function to settle one fill of an order atomically
+-- Checks the balance (buy) or holding (sell), moves cash and shares,
+-- completes the order when complete_param is true and records the
+-- transaction. Any failure cancels the order with the reason in error.
+-- A fill that was rejected is given back to the counterparty's order and
+-- may be matched again, so the order only completes once its settled
+-- transactions add up to its quantity; 'completed' in the result says
+-- whether it did.
+CREATE OR REPLACE FUNCTION settle_order(
+    order_id_param UUID,
+    price_param DECIMAL,
+    quantity_param INTEGER DEFAULT NULL,
+    complete_param BOOLEAN DEFAULT true
+)
+RETURNS JSONB
+SECURITY DEFINER
+SET search_path = public
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    o orders%ROWTYPE;
+    fill_quantity INTEGER;
+    total DECIMAL;
+    current_balance DECIMAL;
+    new_balance DECIMAL;
+    held INTEGER;
+    settled INTEGER;
+    completed BOOLEAN;
+BEGIN
+    SELECT * INTO o FROM orders WHERE id = order_id_param FOR UPDATE;
+    IF NOT FOUND THEN
+        RETURN jsonb_build_object('order_id', order_id_param, 'success', false, 'error', 'Order not found');
+    END IF;
+
+    IF o.status <> 'pending' THEN
+        RETURN jsonb_build_object('order_id', order_id_param, 'success', false, 'error', 'Order is not pending');
+    END IF;
+
+    fill_quantity := COALESCE(quantity_param, o.quantity);
+    total := price_param * fill_quantity;
+
+    SELECT balance INTO current_balance FROM profiles WHERE user_id = o.user_id FOR UPDATE;
+    IF NOT FOUND THEN
+        UPDATE orders SET status = 'cancelled', error = 'User not found' WHERE id = o.id;
+        RETURN jsonb_build_object('order_id', o.id, 'success', false, 'error', 'User not found');
+    END IF;
+
+    IF o.type = 'buy' THEN
+        IF current_balance < total THEN
+            UPDATE orders SET status = 'cancelled', error = 'Insufficient balance' WHERE id = o.id;
+            RETURN jsonb_build_object('order_id', o.id, 'success', false, 'error', 'Insufficient balance');
+        END IF;
+
+        new_balance := current_balance - total;
+
+        INSERT INTO user_stocks (user_id, stock_id, quantity)
+        VALUES (o.user_id, o.stock_id, fill_quantity)
+        ON CONFLICT (user_id, stock_id)
+        DO UPDATE SET quantity = user_stocks.quantity + EXCLUDED.quantity;
+    ELSE
+        SELECT quantity INTO held FROM user_stocks
+        WHERE user_id = o.user_id AND stock_id = o.stock_id
+        FOR UPDATE;
+
+        IF held IS NULL OR held < fill_quantity THEN
+            UPDATE orders SET status = 'cancelled', error = 'Insufficient stocks' WHERE id = o.id;
+            RETURN jsonb_build_object('order_id', o.id, 'success', false, 'error', 'Insufficient stocks');
+        END IF;
+
+        new_balance := current_balance + total;
+
+        IF held = fill_quantity THEN
+            DELETE FROM user_stocks WHERE user_id = o.user_id AND stock_id = o.stock_id;
+        ELSE
+            UPDATE user_stocks SET quantity = held - fill_quantity
+            WHERE user_id = o.user_id AND stock_id = o.stock_id;
+        END IF;
+    END IF;
+
+    UPDATE profiles SET balance = new_balance WHERE user_id = o.user_id;
+
+    SELECT COALESCE(SUM(quantity), 0) INTO settled FROM transactions WHERE order_id = o.id;
+    completed := complete_param AND settled + fill_quantity >= o.quantity;
+
+    IF completed THEN
+        UPDATE orders
+        SET status = 'completed',
+            price = price_param,
+            executed_price = price_param,
+            executed_at = NOW()
+        WHERE id = o.id;
+    END IF;
+
+    INSERT INTO transactions (user_id, stock_id, type, quantity, price, total_amount, order_id, created_at)
+    VALUES (o.user_id, o.stock_id, o.type, fill_quantity, price_param, total, o.id, NOW());
+
+    RETURN jsonb_build_object(
+        'order_id', o.id,
+        'success', true,
+        'user_id', o.user_id,
+        'stock_id', o.stock_id,
+        'type', o.type,
+        'quantity', fill_quantity,
+        'price', price_param,
+        'total_amount', total,
+        'new_balance', new_balance,
+        'completed', completed
+    );
+END;
+$$;
+
+-- Function to settle a batch of fills in one call
+-- fills_param is a JSON array of {buy_order_id, sell_order_id, price,
+-- quantity, buy_complete, sell_complete}, one entry per fill. Fills are
+-- applied in array order. Both sides of a fill settle in one
+-- subtransaction: if either side is rejected, neither is applied and only
+-- the rejected orders are cancelled, with the reason in their error
+-- column. One rejected fill does not undo the others. Returns one result
+-- per fill, in the same order: {success: true, buy, sell} with the
+-- settle_order result of each side, or {success: false, error, rejected}
+-- with the ids of the rejected orders.
+-- Batches for different stocks are settled concurrently and may lock the
+-- same profiles; a deadlock fails the whole call rather than cancelling
+-- the fill, and the caller settles the batch one fill at a time instead.
+CREATE OR REPLACE FUNCTION settle_orders(fills_param JSONB)
+RETURNS JSONB
+SECURITY DEFINER
+SET search_path = public
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    fill JSONB;
+    fill_price DECIMAL;
+    fill_quantity INTEGER;
+    side_order_id UUID;
+    buy_result JSONB;
+    sell_result JSONB;
+    failure TEXT;
+    rejected JSONB;
+    results JSONB := '[]'::JSONB;
+BEGIN
+    FOR fill IN SELECT value FROM jsonb_array_elements(fills_param) LOOP
+        fill_price := (fill->>'price')::DECIMAL;
+        fill_quantity := (fill->>'quantity')::INTEGER;
+        buy_result := NULL;
+        sell_result := NULL;
+        failure := NULL;
+
+        BEGIN
+            side_order_id := (fill->>'buy_order_id')::UUID;
+            buy_result := settle_order(side_order_id, fill_price, fill_quantity, COALESCE((fill->>'buy_complete')::BOOLEAN, true));
+            side_order_id := (fill->>'sell_order_id')::UUID;
+            sell_result := settle_order(side_order_id, fill_price, fill_quantity, COALESCE((fill->>'sell_complete')::BOOLEAN, true));
+
+            IF NOT (buy_result->>'success')::BOOLEAN OR NOT (sell_result->>'success')::BOOLEAN THEN
+                -- Undo the side that did settle
+                RAISE EXCEPTION 'fill rejected' USING ERRCODE = 'CH001';
+            END IF;
+        EXCEPTION
+            WHEN deadlock_detected OR lock_not_available THEN
+                RAISE;
+            WHEN SQLSTATE 'CH001' THEN
+                NULL;
+            WHEN OTHERS THEN
+                failure := SQLERRM;
+        END;
+
+        IF failure IS NULL AND (buy_result->>'success')::BOOLEAN AND (sell_result->>'success')::BOOLEAN THEN
+            results := results || jsonb_build_array(jsonb_build_object('success', true, 'buy', buy_result, 'sell', sell_result));
+            CONTINUE;
+        END IF;
+
+        -- The subtransaction was rolled back; cancel the orders that were rejected
+        rejected := '[]'::JSONB;
+        IF failure IS NOT NULL THEN
+            UPDATE orders SET status = 'cancelled', error = failure
+            WHERE id = side_order_id AND status = 'pending';
+            rejected := jsonb_build_array(side_order_id);
+        ELSE
+            IF NOT (buy_result->>'success')::BOOLEAN THEN
+                UPDATE orders SET status = 'cancelled', error = buy_result->>'error'
+                WHERE id = (fill->>'buy_order_id')::UUID AND status = 'pending';
+                rejected := rejected || jsonb_build_array(fill->'buy_order_id');
+            END IF;
+            IF NOT (sell_result->>'success')::BOOLEAN THEN
+                UPDATE orders SET status = 'cancelled', error = sell_result->>'error'
+                WHERE id = (fill->>'sell_order_id')::UUID AND status = 'pending';
+                rejected := rejected || jsonb_build_array(fill->'sell_order_id');
+            END IF;
+            failure := COALESCE(
+                CASE WHEN NOT (buy_result->>'success')::BOOLEAN THEN buy_result->>'error' END,
+                sell_result->>'error'
+            );
+        END IF;
+
+        results := results || jsonb_build_array(jsonb_build_object('success', false, 'error', failure, 'rejected', rejected));
+    END LOOP;
+
+    RETURN results;
+END;
+$$;
+
+-- These bypass RLS and write any user's orders, balances and holdings, so
+-- only the service role (the engines) may call them
+REVOKE EXECUTE ON FUNCTION get_pending_orders(UUID) FROM PUBLIC, anon, authenticated;
+REVOKE EXECUTE ON FUNCTION cancel_pending_orders(TEXT) FROM PUBLIC, anon, authenticated;
+REVOKE EXECUTE ON FUNCTION update_stock_price(UUID, TEXT, TEXT) FROM PUBLIC, anon, authenticated;
+REVOKE EXECUTE ON FUNCTION settle_order(UUID, DECIMAL, INTEGER, BOOLEAN) FROM PUBLIC, anon, authenticated;
+REVOKE EXECUTE ON FUNCTION settle_orders(JSONB) FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION get_pending_orders(UUID) TO service_role;
+GRANT EXECUTE ON FUNCTION cancel_pending_orders(TEXT) TO service_role;
+GRANT EXECUTE ON FUNCTION update_stock_price(UUID, TEXT, TEXT) TO service_role;
+GRANT EXECUTE ON FUNCTION settle_order(UUID, DECIMAL, INTEGER, BOOLEAN) TO service_role;
+GRANT EXECUTE ON FUNCTION settle_orders(JSONB) TO service_role;
@@ -0,0 +1,28 @@
+-- get_pending_quantities() fed the price updates from the orders table; they
+-- now read the resting quantities from the matching engine's order books
+DROP FUNCTION IF EXISTS get_pending_quantities();
+
+-- Function to update many stock prices in one statement
+CREATE OR REPLACE FUNCTION update_stock_prices(
+    stock_ids_param UUID[],
+    new_prices_param DECIMAL[],
+    price_changes_param DECIMAL[]
+)
+RETURNS void
+SECURITY DEFINER
+SET search_path = public
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    UPDATE stocks s
+    SET current_price = u.new_price,
+        price_change = u.price_change
+    FROM unnest(stock_ids_param, new_prices_param, price_changes_param)
+        AS u(stock_id, new_price, price_change)
+    WHERE s.id = u.stock_id;
+END;
+$$;
+
+-- Service role (the engines) only, as in add_admin_functions.sql
+REVOKE EXECUTE ON FUNCTION update_stock_prices(UUID[], DECIMAL[], DECIMAL[]) FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION update_stock_prices(UUID[], DECIMAL[], DECIMAL[]) TO service_role;
@@ -0,0 +1,19 @@
+-- Indexes for the hot queries that schema.sql only had primary keys for.
+-- check_query_plans.py verifies that the planner uses them.
+
+-- Pending orders of a stock, oldest first (get_pending_orders, loading the
+-- order books, cancel_pending_orders on a halt) are served by
+-- idx_orders_status_stock_created from add_orders_pagination_indexes.sql,
+-- and is_admin()'s lookup by the profiles primary key; check_query_plans.py
+-- showed these partial indexes only duplicated them
+DROP INDEX IF EXISTS idx_orders_pending_stock_created;
+DROP INDEX IF EXISTS idx_profiles_admin;
+
+-- Holders of a stock (leaderboard and portfolio valuation on price changes);
+-- lookups by user are served by the UNIQUE (user_id, stock_id) index
+CREATE INDEX IF NOT EXISTS idx_user_stocks_stock
+    ON user_stocks (stock_id);
+
+-- Quantity already filled per order, read when loading the order books
+CREATE INDEX IF NOT EXISTS idx_transactions_order
+    ON transactions (order_id);
@@ -0,0 +1,21 @@
+-- Notify every backend process when the market is opened or closed
+-- Each process keeps the market state in memory and LISTENs on the
+-- market_state channel to update it, so no process has to read the
+-- market_state table on every order.
+CREATE OR REPLACE FUNCTION notify_market_state()
+RETURNS TRIGGER
+SECURITY DEFINER
+SET search_path = public
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    PERFORM pg_notify('market_state', json_build_object('is_active', NEW.is_active)::TEXT);
+    RETURN NEW;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS market_state_notify ON market_state;
+CREATE TRIGGER market_state_notify
+    AFTER INSERT OR UPDATE ON market_state
+    FOR EACH ROW
+    EXECUTE FUNCTION notify_market_state();
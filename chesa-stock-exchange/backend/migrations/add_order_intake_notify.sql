@@ -0,0 +1,22 @@
+-- Notify the engine worker of every new pending order
+-- The payload is the order row itself, so the worker does not need to
+-- query for it. The worker LISTENs on the order_intake channel.
+CREATE OR REPLACE FUNCTION notify_order_intake()
+RETURNS TRIGGER
+SECURITY DEFINER
+SET search_path = public
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    IF NEW.status = 'pending' THEN
+        PERFORM pg_notify('order_intake', row_to_json(NEW)::TEXT);
+    END IF;
+    RETURN NEW;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS orders_intake_notify ON orders;
+CREATE TRIGGER orders_intake_notify
+    AFTER INSERT ON orders
+    FOR EACH ROW
+    EXECUTE FUNCTION notify_order_intake();
@@ -0,0 +1,4 @@
+-- Indexes for keyset pagination of a user's orders (GET /api/orders pages
+-- by created_at, id, newest first) and for pending orders by stock
+CREATE INDEX IF NOT EXISTS idx_orders_user_created ON orders (user_id, created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_orders_status_stock_created ON orders (status, stock_id, created_at);
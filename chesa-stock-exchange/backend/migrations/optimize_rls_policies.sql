@@ -0,0 +1,105 @@
+-- Rework the RLS policies around a cached admin check
+-- The old policies called auth.uid() for every row they filtered and ran an
+-- admin subquery on profiles from each policy, which also recursed through
+-- the profiles policies. Now auth.uid() and is_admin() are wrapped in
+-- scalar subqueries, which Postgres evaluates once per statement (an
+-- InitPlan). measure_rls.py compares the old and new policies.
+
+CREATE OR REPLACE FUNCTION is_admin()
+RETURNS BOOLEAN
+LANGUAGE sql
+STABLE
+SECURITY DEFINER
+SET search_path = public
+AS $$
+    SELECT EXISTS (
+        SELECT 1 FROM profiles
+        WHERE user_id = (SELECT auth.uid()) AND role = 'admin'
+    );
+$$;
+
+-- Profiles
+DROP POLICY IF EXISTS "Users can view own profile" ON profiles;
+CREATE POLICY "Users can view own profile" ON profiles
+    FOR SELECT
+    USING ((SELECT auth.uid()) = user_id);
+
+DROP POLICY IF EXISTS "Users can update own profile" ON profiles;
+CREATE POLICY "Users can update own profile" ON profiles
+    FOR UPDATE
+    USING ((SELECT auth.uid()) = user_id);
+
+DROP POLICY IF EXISTS "Admins can do all" ON profiles;
+CREATE POLICY "Admins can do all" ON profiles
+    FOR ALL
+    USING ((SELECT is_admin()));
+
+-- Stocks
+DROP POLICY IF EXISTS "Only admins can insert stocks" ON stocks;
+CREATE POLICY "Only admins can insert stocks"
+    ON stocks FOR INSERT
+    WITH CHECK ((SELECT is_admin()));
+
+DROP POLICY IF EXISTS "Only admins can update stocks" ON stocks;
+CREATE POLICY "Only admins can update stocks"
+    ON stocks FOR UPDATE
+    USING ((SELECT is_admin()));
+
+-- Orders
+DROP POLICY IF EXISTS "Users can view own orders" ON orders;
+CREATE POLICY "Users can view own orders"
+    ON orders FOR SELECT
+    USING ((SELECT auth.uid()) = user_id);
+
+DROP POLICY IF EXISTS "Users can insert own orders" ON orders;
+CREATE POLICY "Users can insert own orders"
+    ON orders FOR INSERT
+    WITH CHECK ((SELECT auth.uid()) = user_id);
+
+DROP POLICY IF EXISTS "Users can update own orders" ON orders;
+CREATE POLICY "Users can update own orders"
+    ON orders FOR UPDATE
+    USING ((SELECT auth.uid()) = user_id);
+
+DROP POLICY IF EXISTS "Admins can manage all orders" ON orders;
+CREATE POLICY "Admins can manage all orders"
+    ON orders FOR ALL
+    USING ((SELECT is_admin()));
+
+-- User stocks
+DROP POLICY IF EXISTS "Users can view own stocks" ON user_stocks;
+CREATE POLICY "Users can view own stocks"
+    ON user_stocks FOR SELECT
+    USING ((SELECT auth.uid()) = user_id);
+
+DROP POLICY IF EXISTS "Users can insert own stocks" ON user_stocks;
+CREATE POLICY "Users can insert own stocks"
+    ON user_stocks FOR INSERT
+    WITH CHECK ((SELECT auth.uid()) = user_id);
+
+DROP POLICY IF EXISTS "Users can update own stocks" ON user_stocks;
+CREATE POLICY "Users can update own stocks"
+    ON user_stocks FOR UPDATE
+    USING ((SELECT auth.uid()) = user_id);
+
+DROP POLICY IF EXISTS "Users can delete own stocks" ON user_stocks;
+CREATE POLICY "Users can delete own stocks"
+    ON user_stocks FOR DELETE
+    USING ((SELECT auth.uid()) = user_id);
+
+DROP POLICY IF EXISTS "Admins can manage all stocks" ON user_stocks;
+CREATE POLICY "Admins can manage all stocks"
+    ON user_stocks FOR ALL
+    USING ((SELECT is_admin()));
+
+-- News
+DROP POLICY IF EXISTS "Only admins can insert news" ON news;
+CREATE POLICY "Only admins can insert news"
+    ON news FOR INSERT
+    WITH CHECK ((SELECT is_admin()));
+
+-- Market state
+DROP POLICY IF EXISTS "Only admins can update market state" ON market_state;
+CREATE POLICY "Only admins can update market state"
+    ON market_state FOR UPDATE
+    USING ((SELECT is_admin()));
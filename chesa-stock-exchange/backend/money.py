@@ -0,0 +1,30 @@
+"""
+Money as integer cents.
+
+The engine and the in-memory valuations keep prices and balances as int
+cents, so adding up fills never drifts the way float balances do. Values
+are converted from the database's DECIMAL(.., 2) strings (or floats from
+JSON) on the way in and back to floats on the way out, nowhere else.
+"""
+from decimal import Decimal, ROUND_HALF_UP
+
+ONE = Decimal(1)
+
+
+def to_cents(amount):
+    """Cents in an amount given as a str, float, Decimal or int, rounded half up like numeric(.., 2)"""
+    if isinstance(amount, int):
+        return amount * 100
+    if isinstance(amount, (float, str)):
+        # Amounts with at most 2 decimals, i.e. nearly all of them, land
+        # within float error of a whole number of cents
+        scaled = float(amount) * 100
+        cents = round(scaled)
+        if abs(scaled - cents) < 1e-6:
+            return cents
+    return int((Decimal(str(amount)) * 100).quantize(ONE, rounding=ROUND_HALF_UP))
+
+
+def from_cents(cents):
+    """Float amount for JSON responses and database parameters"""
+    return cents / 100
@@ -0,0 +1,89 @@
+"""
+Postgres LISTEN/NOTIFY helpers for passing events between processes.
+
+Uses a direct database connection (DATABASE_URL, as apply_migration.py
+does) rather than the Supabase REST client, since PostgREST cannot hold a
+session open to LISTEN on.
+"""
+from threading import Lock, Thread
+import json
+import select
+import time
+
+import psycopg2
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+
+# NOTIFY payloads must stay under 8000 bytes
+MAX_PAYLOAD_BYTES = 7900
+
+
+def connect(database_url):
+    conn = psycopg2.connect(database_url)
+    conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+    return conn
+
+
+class Notifier:
+    """Sends JSON notifications on one channel, reconnecting when needed"""
+
+    def __init__(self, database_url, channel):
+        self.database_url = database_url
+        self.channel = channel
+        self._conn = None
+        self._lock = Lock()
+
+    def _payloads(self, kind, data):
+        """Encode an event, splitting list data until each part fits in a payload"""
+        payload = json.dumps({'kind': kind, 'data': data}, default=str)
+        if len(payload.encode()) <= MAX_PAYLOAD_BYTES or not isinstance(data, list) or len(data) < 2:
+            return [payload]
+        middle = len(data) // 2
+        return self._payloads(kind, data[:middle]) + self._payloads(kind, data[middle:])
+
+    def send(self, kind, data):
+        try:
+            with self._lock:
+                if self._conn is None or self._conn.closed:
+                    self._conn = connect(self.database_url)
+                with self._conn.cursor() as cur:
+                    for payload in self._payloads(kind, data):
+                        cur.execute('SELECT pg_notify(%s, %s)', (self.channel, payload))
+        except Exception as e:
+            print(f"Error sending {kind} notification: {str(e)}")
+            self._conn = None
+
+
+class Listener(Thread):
+    """
+    Background thread that LISTENs on some channels and calls
+    handlers[channel](payload) for every notification received.
+    Reconnects after connection errors.
+    """
+
+    def __init__(self, database_url, handlers, reconnect_delay=5):
+        super().__init__(daemon=True)
+        self.database_url = database_url
+        self.handlers = handlers
+        self.reconnect_delay = reconnect_delay
+
+    def run(self):
+        while True:
+            try:
+                conn = connect(self.database_url)
+                with conn.cursor() as cur:
+                    for channel in self.handlers:
+                        cur.execute(f'LISTEN "{channel}"')
+
+                while True:
+                    if select.select([conn], [], [], 30) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        try:
+                            self.handlers[notify.channel](notify.payload)
+                        except Exception as e:
+                            print(f"Error handling {notify.channel} notification: {str(e)}")
+            except Exception as e:
+                print(f"Notification listener error, reconnecting: {str(e)}")
+                time.sleep(self.reconnect_delay)
@@ -0,0 +1,406 @@
+"""
+In-memory limit order book and matching engine.
+
+Each stock has its own book with bid and ask price levels. Orders within a
+level are kept in arrival order, so matching follows price-time priority:
+the best price trades first and, at the same price, the oldest order trades
+first. Fills always execute at the resting order's price.
+
+Prices are kept as integer cents (see money.py) and the order, fill and
+level records use __slots__; the price properties convert back to floats
+for the code outside the engine.
+"""
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+from threading import Lock
+import time
+
+from money import from_cents, to_cents
+
+BUY = 'buy'
+SELL = 'sell'
+
+
+class BookOrder:
+    """An order resting in (or being matched against) a book"""
+
+    __slots__ = (
+        'id', 'user_id', 'stock_id', 'side', 'quantity', 'remaining',
+        'price_cents', 'created_at', 'cancelled'
+    )
+
+    def __init__(self, order_id, user_id, stock_id, side, quantity, price, created_at=None, remaining=None):
+        self.id = order_id
+        self.user_id = user_id
+        self.stock_id = stock_id
+        self.side = side
+        self.quantity = int(quantity)
+        # Less than quantity for an order reloaded after partial fills
+        self.remaining = int(quantity if remaining is None else remaining)
+        self.price_cents = to_cents(price)
+        self.created_at = created_at
+        self.cancelled = False
+
+    @property
+    def price(self):
+        return from_cents(self.price_cents)
+
+    @property
+    def is_filled(self):
+        return self.remaining == 0
+
+
+class Fill:
+    """A single execution between a buy order and a sell order"""
+
+    __slots__ = (
+        'stock_id', 'buy_order', 'sell_order', 'quantity', 'price_cents',
+        'buy_completed', 'sell_completed', 'buy_filled', 'sell_filled', 'timestamp'
+    )
+
+    def __init__(self, stock_id, buy_order, sell_order, quantity, price_cents):
+        self.stock_id = stock_id
+        self.buy_order = buy_order
+        self.sell_order = sell_order
+        self.quantity = quantity
+        self.price_cents = price_cents
+        # Snapshot completion now, the orders keep changing after the fill
+        self.buy_completed = buy_order.remaining == 0
+        self.sell_completed = sell_order.remaining == 0
+        # Quantity of each order filled so far, this fill included
+        self.buy_filled = buy_order.quantity - buy_order.remaining
+        self.sell_filled = sell_order.quantity - sell_order.remaining
+        self.timestamp = time.time()
+
+    @property
+    def price(self):
+        return from_cents(self.price_cents)
+
+    @property
+    def notional_cents(self):
+        return self.price_cents * self.quantity
+
+
+class PriceLevel:
+    """FIFO queue of orders sharing one price, in cents"""
+
+    __slots__ = ('price', 'orders', 'quantity')
+
+    def __init__(self, price):
+        self.price = price
+        self.orders = deque()
+        self.quantity = 0
+
+    def append(self, order):
+        self.orders.append(order)
+        self.quantity += order.remaining
+
+    def insert(self, order):
+        """Queue an order ahead of the ones that arrived after it, by created_at"""
+        position = len(self.orders)
+        if order.created_at is not None:
+            for index, other in enumerate(self.orders):
+                if other.created_at is not None and other.created_at > order.created_at:
+                    position = index
+                    break
+        self.orders.insert(position, order)
+        self.quantity += order.remaining
+
+    def __len__(self):
+        return len(self.orders)
+
+
+class OrderBook:
+    """Bid/ask book for a single stock"""
+
+    def __init__(self, stock_id):
+        self.stock_id = stock_id
+        # price in cents -> PriceLevel, plus an ascending list of active prices per side
+        self.bids = {}
+        self.asks = {}
+        self.bid_prices = []
+        self.ask_prices = []
+        self.orders = {}
+        self.last_price_cents = None
+
+    @property
+    def last_price(self):
+        return from_cents(self.last_price_cents) if self.last_price_cents is not None else None
+
+    def best_bid(self):
+        return from_cents(self.bid_prices[-1]) if self.bid_prices else None
+
+    def best_ask(self):
+        return from_cents(self.ask_prices[0]) if self.ask_prices else None
+
+    def _levels(self, side):
+        if side == BUY:
+            return self.bids, self.bid_prices
+        return self.asks, self.ask_prices
+
+    def _remove_level(self, side, price):
+        levels, prices = self._levels(side)
+        del levels[price]
+        prices.pop(bisect_left(prices, price))
+
+    def _rest(self, order, in_time=False):
+        levels, prices = self._levels(order.side)
+        level = levels.get(order.price_cents)
+        if level is None:
+            level = levels[order.price_cents] = PriceLevel(order.price_cents)
+            prices.insert(bisect_left(prices, order.price_cents), order.price_cents)
+        if in_time:
+            level.insert(order)
+        else:
+            level.append(order)
+        self.orders[order.id] = order
+
+    def add(self, order):
+        """
+        Match an incoming order against the opposite side of the book and
+        rest whatever is left. Returns the list of fills produced.
+        """
+        fills = self._match(order)
+        if order.remaining > 0:
+            self._rest(order)
+        return fills
+
+    def reinstate(self, order, quantity):
+        """
+        Give an order back quantity of a fill that did not settle. A resting
+        order just grows; one that was filled is matched again, in case the
+        book moved across its price since, and rests at its place in time
+        priority. Returns the list of fills produced.
+        """
+        if order.cancelled:
+            return []
+
+        order.remaining += quantity
+        if order.id in self.orders:
+            levels, _ = self._levels(order.side)
+            levels[order.price_cents].quantity += quantity
+            return []
+
+        fills = self._match(order)
+        if order.remaining > 0:
+            self._rest(order, in_time=True)
+        return fills
+
+    def _match(self, order):
+        """Match an order against the opposite side of the book, returns the fills"""
+        fills = []
+        opposite = SELL if order.side == BUY else BUY
+        levels, prices = self._levels(opposite)
+        limit = order.price_cents
+
+        while order.remaining > 0 and prices:
+            best = prices[0] if opposite == SELL else prices[-1]
+            if (order.side == BUY and best > limit) or (order.side == SELL and best < limit):
+                break
+
+            level = levels[best]
+            while order.remaining > 0 and level.orders:
+                resting = level.orders[0]
+                if resting.cancelled or resting.remaining == 0:
+                    level.orders.popleft()
+                    continue
+
+                quantity = min(order.remaining, resting.remaining)
+                order.remaining -= quantity
+                resting.remaining -= quantity
+                level.quantity -= quantity
+
+                if order.side == BUY:
+                    fill = Fill(self.stock_id, order, resting, quantity, level.price)
+                else:
+                    fill = Fill(self.stock_id, resting, order, quantity, level.price)
+                fills.append(fill)
+                self.last_price_cents = level.price
+
+                if resting.remaining == 0:
+                    level.orders.popleft()
+                    self.orders.pop(resting.id, None)
+
+            if not level.orders:
+                self._remove_level(opposite, best)
+
+        return fills
+
+    def cancel(self, order_id):
+        """
+        Cancel a resting order. The order is removed lazily from its level
+        queue the next time matching reaches it.
+        """
+        order = self.orders.pop(order_id, None)
+        if order is None:
+            return None
+
+        order.cancelled = True
+        levels, _ = self._levels(order.side)
+        level = levels.get(order.price_cents)
+        if level is not None:
+            level.quantity -= order.remaining
+            if level.quantity <= 0:
+                self._remove_level(order.side, order.price_cents)
+        return order
+
+    def clear(self):
+        """Cancel every resting order and empty the book"""
+        for order in self.orders.values():
+            order.cancelled = True
+        self.bids = {}
+        self.asks = {}
+        self.bid_prices = []
+        self.ask_prices = []
+        self.orders = {}
+
+    def resting(self):
+        """Resting orders, each price level oldest first"""
+        return [
+            order
+            for levels in (self.bids, self.asks)
+            for level in levels.values()
+            for order in level.orders
+            if not order.cancelled and order.remaining > 0
+        ]
+
+    def depth(self, levels=10):
+        """Aggregated quantity for the best price levels on each side"""
+        return {
+            'bids': [{'price': from_cents(price), 'quantity': self.bids[price].quantity}
+                     for price in reversed(self.bid_prices[-levels:])],
+            'asks': [{'price': from_cents(price), 'quantity': self.asks[price].quantity}
+                     for price in self.ask_prices[:levels]]
+        }
+
+    def __len__(self):
+        return len(self.orders)
+
+
+class MatchingEngine:
+    """
+    Holds one order book per stock and serializes matching per book.
+    Remembers the ids of the most recent orders it accepted so an order
+    seen twice (e.g. by overlapping database polls) is only matched once.
+    """
+
+    def __init__(self, remember=100000):
+        self.books = {}
+        self.locks = {}
+        self._books_lock = Lock()
+        self._seen_ids = set()
+        self._seen_order = deque()
+        self._remember = remember
+
+    def _book(self, stock_id):
+        book = self.books.get(stock_id)
+        if book is None:
+            with self._books_lock:
+                book = self.books.get(stock_id)
+                if book is None:
+                    self.locks[stock_id] = Lock()
+                    book = self.books[stock_id] = OrderBook(stock_id)
+        return book
+
+    def _accept(self, order_id):
+        with self._books_lock:
+            if order_id in self._seen_ids:
+                return False
+            self._seen_ids.add(order_id)
+            self._seen_order.append(order_id)
+            if len(self._seen_order) > self._remember:
+                self._seen_ids.discard(self._seen_order.popleft())
+            return True
+
+    def submit(self, order, record=None):
+        """
+        Match an order against its stock's book and return the fills
+        Returns None if this order was already submitted
+        record, if given, is called with the book locked before matching, so
+        a journal sees each book's orders in the order they were matched
+        """
+        if not self._accept(order.id):
+            return None
+        book = self._book(order.stock_id)
+        with self.locks[order.stock_id]:
+            if record is not None:
+                record()
+            return book.add(order)
+
+    def reinstate(self, order, quantity, record=None):
+        """
+        Give a booked order back quantity of a fill that did not settle, see
+        OrderBook.reinstate; record is called as for submit
+        """
+        book = self._book(order.stock_id)
+        with self.locks[order.stock_id]:
+            if record is not None:
+                record()
+            return book.reinstate(order, quantity)
+
+    def cancel(self, stock_id, order_id, record=None):
+        """Cancel a resting order; record is called as for submit"""
+        book = self.books.get(stock_id)
+        if book is None:
+            return None
+        with self.locks[stock_id]:
+            if record is not None:
+                record()
+            return book.cancel(order_id)
+
+    def depth(self, stock_id, levels=10):
+        book = self._book(stock_id)
+        with self.locks[stock_id]:
+            return book.depth(levels)
+
+    def pending_quantities(self):
+        """
+        Resting buy and sell quantity per stock, for stocks with any resting
+        orders. Returns {stock_id: (buy_quantity, sell_quantity)}
+        """
+        quantities = {}
+        for stock_id, book in list(self.books.items()):
+            with self.locks[stock_id]:
+                if not book.orders:
+                    continue
+                quantities[stock_id] = (
+                    sum(level.quantity for level in book.bids.values()),
+                    sum(level.quantity for level in book.asks.values())
+                )
+        return quantities
+
+    def resting_orders(self):
+        """Every resting order, each book's price levels oldest first"""
+        orders = []
+        for stock_id, book in list(self.books.items()):
+            with self.locks[stock_id]:
+                orders.extend(book.resting())
+        return orders
+
+    @contextmanager
+    def frozen(self):
+        """
+        Hold every book still for the body of the with statement, which gets
+        the resting orders as resting_orders() would, e.g. to snapshot them
+        in step with a journal written under the book locks
+        """
+        with self._books_lock:
+            locks = [self.locks[stock_id] for stock_id in list(self.books)]
+            for lock in locks:
+                lock.acquire()
+            try:
+                yield [order for book in self.books.values() for order in book.resting()]
+            finally:
+                for lock in locks:
+                    lock.release()
+
+    def clear(self):
+        """
+        Drop every resting order, e.g. when the market is halted. Each book
+        is emptied under its own lock, so a submit or cancel holding it
+        finishes first.
+        """
+        for stock_id, book in list(self.books.items()):
+            with self.locks[stock_id]:
+                book.clear()
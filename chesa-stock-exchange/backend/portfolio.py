@@ -0,0 +1,205 @@
+"""
+Materialized portfolio valuations.
+
+Keeps, for the users who recently looked at their portfolio, their cash,
+holdings and total value (cash + sum of quantity x price) in memory, in
+integer cents. A fill adjusts one user's entry; a price tick revalues the
+holders of that stock through a stock -> holders index. Reading a
+portfolio is then O(holdings) with no database round trip.
+
+Users are loaded from the database on first read and dropped after ttl
+seconds (or when the cache is full), which also bounds how long an update
+made outside the engine, e.g. an admin adding stock, can go unnoticed.
+"""
+from collections import OrderedDict
+from threading import Lock
+import time
+
+from money import from_cents, to_cents
+
+
+class Portfolio:
+    __slots__ = ('balance', 'holdings', 'value', 'expires_at')
+
+    def __init__(self, balance, holdings, value, expires_at):
+        self.balance = balance      # cents
+        self.holdings = holdings    # stock_id -> quantity
+        self.value = value          # cents, balance included
+        self.expires_at = expires_at
+
+
+class Portfolios:
+    def __init__(self, maxsize=10000, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = Lock()
+        self._portfolios = OrderedDict()  # user_id -> Portfolio
+        self._holders = {}   # stock_id -> set of user_ids
+        self._prices = {}    # stock_id -> price in cents
+        self._stocks = {}    # stock_id -> {'name', 'symbol'}
+        # Users being loaded -> whether they changed since the load started
+        self._loading = {}
+        self.hits = 0
+        self.misses = 0
+
+    def begin_load(self, user_id):
+        """Call before reading a user's profile and holdings from the database"""
+        with self._lock:
+            self._loading[user_id] = False
+
+    def load(self, user_id, balance, holdings):
+        """
+        Materialize a user from their balance and user_stocks rows joined
+        with stocks(*). Skipped when a fill for the user arrived while the
+        rows were being read, as they may not include it; the next read
+        loads again.
+        """
+        with self._lock:
+            if self._loading.pop(user_id, True):
+                return
+
+            self._drop(user_id)
+            quantities = {}
+            for holding in holdings:
+                stock = holding['stocks']
+                stock_id = stock['id']
+                quantities[stock_id] = quantities.get(stock_id, 0) + holding['quantity']
+                self._stocks[stock_id] = {'name': stock['name'], 'symbol': stock['symbol']}
+                # Other holders are valued at the price we have; otherwise
+                # the row is as good as any tick we saw
+                if not self._holders.get(stock_id):
+                    self._prices[stock_id] = to_cents(stock['current_price'])
+                self._holders.setdefault(stock_id, set()).add(user_id)
+
+            balance = to_cents(balance)
+            value = balance + sum(quantity * self._prices[stock_id] for stock_id, quantity in quantities.items())
+            self._portfolios[user_id] = Portfolio(balance, quantities, value, time.monotonic() + self.ttl)
+            while len(self._portfolios) > self.maxsize:
+                self._drop(next(iter(self._portfolios)))
+
+    def _drop(self, user_id):
+        portfolio = self._portfolios.pop(user_id, None)
+        if portfolio is None:
+            return
+        for stock_id in portfolio.holdings:
+            holders = self._holders.get(stock_id)
+            if holders is not None:
+                holders.discard(user_id)
+                if not holders:
+                    del self._holders[stock_id]
+
+    def _get(self, user_id):
+        portfolio = self._portfolios.get(user_id)
+        if portfolio is None or portfolio.expires_at <= time.monotonic():
+            self._drop(user_id)
+            self.misses += 1
+            return None
+        self._portfolios.move_to_end(user_id)
+        self.hits += 1
+        return portfolio
+
+    def summary(self, user_id):
+        """{'balance', 'total_portfolio_value'}, or None if the user is not loaded"""
+        with self._lock:
+            portfolio = self._get(user_id)
+            if portfolio is None:
+                return None
+            return self._summary(portfolio)
+
+    def holdings(self, user_id):
+        """The user's holdings formatted for the API, or None if the user is not loaded"""
+        with self._lock:
+            portfolio = self._get(user_id)
+            if portfolio is None:
+                return None
+            return self._holdings(portfolio)
+
+    def view(self, user_id):
+        """
+        (summary, holdings) read together, so the total matches the
+        holdings, or None if the user is not loaded
+        """
+        with self._lock:
+            portfolio = self._get(user_id)
+            if portfolio is None:
+                return None
+            return self._summary(portfolio), self._holdings(portfolio)
+
+    def _summary(self, portfolio):
+        return {
+            'balance': from_cents(portfolio.balance),
+            'total_portfolio_value': from_cents(portfolio.value)
+        }
+
+    def _holdings(self, portfolio):
+        return [
+            {
+                'stock_id': stock_id,
+                'stock_name': self._stocks[stock_id]['name'],
+                'stock_symbol': self._stocks[stock_id]['symbol'],
+                'quantity': quantity,
+                'current_price': from_cents(self._prices[stock_id]),
+                'total_value': from_cents(quantity * self._prices[stock_id])
+            }
+            for stock_id, quantity in portfolio.holdings.items()
+        ]
+
+    def apply_fill(self, user_id, stock_id, quantity, cash_cents):
+        """
+        Apply a settled trade: quantity is the change in shares (negative
+        for a sell) and cash_cents the change in balance, in cents
+        """
+        with self._lock:
+            if user_id in self._loading:
+                self._loading[user_id] = True
+            portfolio = self._portfolios.get(user_id)
+            if portfolio is None:
+                return
+
+            if stock_id not in self._stocks:
+                # Bought a stock we know nothing about; reload on next read
+                self._drop(user_id)
+                return
+
+            portfolio.balance += cash_cents
+            new_quantity = portfolio.holdings.get(stock_id, 0) + quantity
+            if new_quantity > 0:
+                portfolio.holdings[stock_id] = new_quantity
+                self._holders.setdefault(stock_id, set()).add(user_id)
+            else:
+                portfolio.holdings.pop(stock_id, None)
+                holders = self._holders.get(stock_id)
+                if holders is not None:
+                    holders.discard(user_id)
+            portfolio.value += cash_cents + quantity * self._prices[stock_id]
+
+    def set_price(self, stock_id, price):
+        """Revalue every loaded holder of a stock after its price changed"""
+        with self._lock:
+            new_price = to_cents(price)
+            old_price = self._prices.get(stock_id)
+            self._prices[stock_id] = new_price
+            if old_price is None or old_price == new_price:
+                return
+            for user_id in self._holders.get(stock_id, ()):
+                portfolio = self._portfolios[user_id]
+                portfolio.value += portfolio.holdings[stock_id] * (new_price - old_price)
+
+    def invalidate(self, user_id):
+        """Forget a user whose holdings changed outside the engine"""
+        with self._lock:
+            if user_id in self._loading:
+                self._loading[user_id] = True
+            self._drop(user_id)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._portfolios),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0
+            }
@@ -0,0 +1,33 @@
+"""
+Vectorized price updates based on pending demand and supply.
+
+All stocks are priced at once with NumPy arrays, so a price tick costs the
+same handful of operations whether there are five symbols or five thousand.
+"""
+import numpy as np
+
+# Maximum price move per tick, as a fraction of the current price
+MAX_PRICE_CHANGE = 0.05
+MIN_PRICE = 1.0
+
+
+def calculate_price_changes(demand, supply):
+    """
+    Calculate the price change of every stock from its pending buy
+    quantity (demand) and pending sell quantity (supply)
+    Returns an array of fractional changes clamped to +/-5%, zero where
+    there is no supply
+    """
+    demand = np.asarray(demand, dtype=np.float64)
+    supply = np.asarray(supply, dtype=np.float64)
+
+    ratio = np.divide(demand, supply, out=np.ones_like(demand), where=supply > 0)
+    changes = np.clip((ratio - 1) * 2, -MAX_PRICE_CHANGE, MAX_PRICE_CHANGE)
+    changes[supply == 0] = 0
+    return changes
+
+
+def apply_price_changes(prices, changes):
+    """Apply fractional changes to prices, rounded to cents and floored at 1"""
+    prices = np.asarray(prices, dtype=np.float64)
+    return np.maximum(np.round(prices * (1 + changes), 2), MIN_PRICE)
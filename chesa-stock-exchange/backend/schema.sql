@@ -8,6 +8,24 @@ CREATE TABLE profiles (
     created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
 );
 
+-- Whether the requesting user is an admin, for RLS policies
+-- Policies call it as (SELECT is_admin()) and compare user_id with
+-- (SELECT auth.uid()), so both are evaluated once per statement rather than
+-- once per row. SECURITY DEFINER lets it read profiles without going
+-- through the profiles policies, which would recurse.
+CREATE OR REPLACE FUNCTION is_admin()
+RETURNS BOOLEAN
+LANGUAGE sql
+STABLE
+SECURITY DEFINER
+SET search_path = public
+AS $$
+    SELECT EXISTS (
+        SELECT 1 FROM profiles
+        WHERE user_id = (SELECT auth.uid()) AND role = 'admin'
+    );
+$$;
+
 -- Enable RLS on profiles
 ALTER TABLE profiles ENABLE ROW LEVEL SECURITY;
 
@@ -19,19 +37,15 @@ CREATE POLICY "Enable insert for registration" ON profiles
 
 CREATE POLICY "Users can view own profile" ON profiles
     FOR SELECT
-    USING (auth.uid() = user_id);
+    USING ((SELECT auth.uid()) = user_id);
 
 CREATE POLICY "Users can update own profile" ON profiles
     FOR UPDATE
-    USING (auth.uid() = user_id);
+    USING ((SELECT auth.uid()) = user_id);
 
 CREATE POLICY "Admins can do all" ON profiles
     FOR ALL
-    USING (
-        auth.uid() IN (
-            SELECT user_id FROM profiles WHERE role = 'admin'
-        )
-    );
+    USING ((SELECT is_admin()));
 
 -- Create stocks table
 CREATE TABLE stocks (
@@ -55,6 +69,10 @@ CREATE TABLE orders (
     created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
 );
 
+-- Order history pages (GET /api/orders) and pending orders per stock
+CREATE INDEX idx_orders_user_created ON orders (user_id, created_at DESC, id DESC);
+CREATE INDEX idx_orders_status_stock_created ON orders (status, stock_id, created_at);
+
 -- Create user_stocks table
 CREATE TABLE user_stocks (
     id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
@@ -65,6 +83,9 @@ CREATE TABLE user_stocks (
     UNIQUE(user_id, stock_id)
 );
 
+-- Holders of a stock
+CREATE INDEX idx_user_stocks_stock ON user_stocks (stock_id);
+
 -- Create news table
 CREATE TABLE news (
     id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
@@ -124,58 +145,45 @@ CREATE POLICY "Stocks are viewable by everyone"
 
 CREATE POLICY "Only admins can insert stocks"
     ON stocks FOR INSERT
-    WITH CHECK (EXISTS (
-        SELECT 1 FROM profiles
-        WHERE user_id = auth.uid()
-        AND role = 'admin'
-    ));
+    WITH CHECK ((SELECT is_admin()));
 
 CREATE POLICY "Only admins can update stocks"
     ON stocks FOR UPDATE
-    USING (EXISTS (
-        SELECT 1 FROM profiles
-        WHERE user_id = auth.uid()
-        AND role = 'admin'
-    ));
+    USING ((SELECT is_admin()));
 
 -- Orders policies
 CREATE POLICY "Users can view own orders"
     ON orders FOR SELECT
-    USING (auth.uid() = user_id);
+    USING ((SELECT auth.uid()) = user_id);
 
 CREATE POLICY "Users can insert own orders"
     ON orders FOR INSERT
-    WITH CHECK (auth.uid() = user_id);
+    WITH CHECK ((SELECT auth.uid()) = user_id);
 
 CREATE POLICY "Users can update own orders"
     ON orders FOR UPDATE
-    USING (auth.uid() = user_id);
+    USING ((SELECT auth.uid()) = user_id);
 
 -- User stocks policies
 CREATE POLICY "Users can view own stocks"
     ON user_stocks FOR SELECT
-    USING (auth.uid() = user_id);
+    USING ((SELECT auth.uid()) = user_id);
 
 CREATE POLICY "Users can insert own stocks"
     ON user_stocks FOR INSERT
-    WITH CHECK (auth.uid() = user_id);
+    WITH CHECK ((SELECT auth.uid()) = user_id);
 
 CREATE POLICY "Users can update own stocks"
     ON user_stocks FOR UPDATE
-    USING (auth.uid() = user_id);
+    USING ((SELECT auth.uid()) = user_id);
 
 CREATE POLICY "Users can delete own stocks"
     ON user_stocks FOR DELETE
-    USING (auth.uid() = user_id);
+    USING ((SELECT auth.uid()) = user_id);
 
 CREATE POLICY "Admins can manage all stocks"
     ON user_stocks FOR ALL
-    USING (
-        EXISTS (
-            SELECT 1 FROM profiles
-            WHERE user_id = auth.uid() AND role = 'admin'
-        )
-    );
+    USING ((SELECT is_admin()));
 
 -- News policies
 CREATE POLICY "News is viewable by everyone"
@@ -184,11 +192,7 @@ CREATE POLICY "News is viewable by everyone"
 
 CREATE POLICY "Only admins can insert news"
     ON news FOR INSERT
-    WITH CHECK (EXISTS (
-        SELECT 1 FROM profiles
-        WHERE user_id = auth.uid()
-        AND role = 'admin'
-    ));
+    WITH CHECK ((SELECT is_admin()));
 
 -- Market state policies
 CREATE POLICY "Market state is viewable by everyone"
@@ -197,8 +201,4 @@ CREATE POLICY "Market state is viewable by everyone"
 
 CREATE POLICY "Only admins can update market state"
     ON market_state FOR UPDATE
-    USING (EXISTS (
-        SELECT 1 FROM profiles
-        WHERE user_id = auth.uid()
-        AND role = 'admin'
-    ));
+    USING ((SELECT is_admin()));
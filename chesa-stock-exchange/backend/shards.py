@@ -0,0 +1,131 @@
+"""
+Worker pool sharded by stock_id.
+
+Every stock is assigned to exactly one shard, and each shard is one thread
+working through its own queue in order. Work for one stock therefore keeps
+its price-time order, while different stocks are processed in parallel.
+Each shard keeps queue depth and latency figures, per shard and per stock,
+so hot symbols stand out.
+"""
+from queue import Empty, Queue
+from threading import Lock, Thread
+import time
+import zlib
+
+# Weight of the newest sample in the moving average latency
+LATENCY_SMOOTHING = 0.1
+
+
+def parse_shard_map(value):
+    """
+    Parse 'AAPL=0,TSLA=1' (symbols or stock ids) into {key: shard}, with
+    the keys uppercased like ORDER_BATCH_WINDOWS in worker.py
+    """
+    return {
+        key.strip().upper(): int(shard)
+        for key, shard in (item.split('=') for item in (value or '').split(',') if '=' in item)
+    }
+
+
+class Shard:
+    def __init__(self, index):
+        self.index = index
+        self.queue = Queue()
+        self.processed = 0
+        self.avg_latency = 0.0
+        self.max_latency = 0.0
+        self.stock_depth = {}       # stock_id -> items queued or in progress
+        self.stock_processed = {}   # stock_id -> items done
+        self.lock = Lock()
+
+
+class ShardPool:
+    def __init__(self, workers, handler, batch_size=500, assignment=None, name='shard'):
+        """
+        handler(items) is called on a shard's thread with up to batch_size
+        queued items, in the order they were submitted
+        assignment(stock_id) may return a shard index to override hashing.
+        A stock keeps the shard it was first given, so its work never
+        runs on two shards at once.
+        """
+        self.handler = handler
+        self.batch_size = batch_size
+        self.assignment = assignment
+        self.name = name
+        self.shards = [Shard(index) for index in range(max(int(workers), 1))]
+        self._assigned = {}
+
+    def shard_for(self, stock_id):
+        shard = self._assigned.get(stock_id)
+        if shard is None:
+            index = self.assignment(stock_id) if self.assignment is not None else None
+            if index is None:
+                index = zlib.crc32(str(stock_id).encode())
+            shard = self._assigned.setdefault(stock_id, self.shards[index % len(self.shards)])
+        return shard
+
+    def submit(self, stock_id, item):
+        shard = self.shard_for(stock_id)
+        with shard.lock:
+            shard.stock_depth[stock_id] = shard.stock_depth.get(stock_id, 0) + 1
+        shard.queue.put((stock_id, item, time.monotonic()))
+
+    def start(self):
+        for shard in self.shards:
+            Thread(target=self._run, args=(shard,), name=f'{self.name}-{shard.index}', daemon=True).start()
+
+    def _run(self, shard):
+        while True:
+            entries = [shard.queue.get()]
+            while len(entries) < self.batch_size:
+                try:
+                    entries.append(shard.queue.get_nowait())
+                except Empty:
+                    break
+
+            try:
+                self.handler([item for _, item, _ in entries])
+            except Exception as e:
+                print(f"Error in {self.name} {shard.index}: {str(e)}")
+
+            now = time.monotonic()
+            with shard.lock:
+                for stock_id, _, queued_at in entries:
+                    latency = now - queued_at
+                    shard.avg_latency += LATENCY_SMOOTHING * (latency - shard.avg_latency)
+                    shard.max_latency = max(shard.max_latency, latency)
+                    shard.processed += 1
+                    shard.stock_processed[stock_id] = shard.stock_processed.get(stock_id, 0) + 1
+                    shard.stock_depth[stock_id] -= 1
+                    if not shard.stock_depth[stock_id]:
+                        del shard.stock_depth[stock_id]
+            for _ in entries:
+                shard.queue.task_done()
+
+    def join(self):
+        """Block until every submitted item has been handled"""
+        for shard in self.shards:
+            shard.queue.join()
+
+    def metrics(self, hot=5):
+        """Depth and latency per shard, with its busiest stocks"""
+        result = []
+        for shard in self.shards:
+            with shard.lock:
+                result.append({
+                    'shard': shard.index,
+                    'queue_depth': shard.queue.qsize(),
+                    'processed': shard.processed,
+                    'avg_latency_ms': round(shard.avg_latency * 1000, 3),
+                    'max_latency_ms': round(shard.max_latency * 1000, 3),
+                    'stocks': len(shard.stock_processed),
+                    'hot_stocks': [
+                        {'stock_id': stock_id, 'queued': shard.stock_depth.get(stock_id, 0), 'processed': processed}
+                        for stock_id, processed in sorted(
+                            shard.stock_processed.items(),
+                            key=lambda item: (shard.stock_depth.get(item[0], 0), item[1]),
+                            reverse=True
+                        )[:hot]
+                    ]
+                })
+        return result
@@ -0,0 +1,126 @@
+"""
+Fan-out hub for the Server-Sent Events market-data stream.
+
+Every published event is serialized to SSE bytes once and appended to a
+shared ring buffer. Subscribers hold only a cursor into that buffer and the
+set of channels they want, so an event costs the same to publish whether one
+client or thousands are listening. Idle subscribers wait on one shared
+condition instead of polling: a threading.Condition for WSGI streams, and
+one asyncio.Event per event loop for ASGI streams.
+"""
+from collections import deque
+from threading import Condition
+import asyncio
+import json
+
+# Seconds between keep-alive comments on an idle stream
+HEARTBEAT_INTERVAL = 15
+
+
+class Hub:
+    def __init__(self, backlog=1024):
+        self._events = deque(maxlen=backlog)   # (sequence, channel, payload bytes)
+        self._sequence = 0
+        self._condition = Condition()
+        self._loop_events = {}   # event loop -> asyncio.Event set on the next publish
+        self.subscribers = 0
+
+    def publish(self, channel, event, data):
+        """Serialize an event once and wake every waiting subscriber"""
+        payload = f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n".encode()
+        with self._condition:
+            self._sequence += 1
+            self._events.append((self._sequence, channel, payload))
+            self._condition.notify_all()
+            for loop in list(self._loop_events):
+                try:
+                    loop.call_soon_threadsafe(self._wake_loop, loop)
+                except RuntimeError:
+                    # The loop was closed, its subscribers are gone
+                    del self._loop_events[loop]
+
+    def _wake_loop(self, loop):
+        """Runs on the loop: wake its async subscribers and start a new generation"""
+        with self._condition:
+            event = self._loop_events.pop(loop, None)
+        if event is not None:
+            event.set()
+
+    def _since(self, cursor, channels):
+        """Return (new cursor, payloads after cursor, missed) for the given channels"""
+        payloads = []
+        for sequence, channel, payload in reversed(self._events):
+            if sequence <= cursor:
+                break
+            if channel in channels:
+                payloads.append(payload)
+        payloads.reverse()
+
+        missed = bool(self._events) and cursor + 1 < self._events[0][0]
+        return self._sequence, payloads, missed
+
+    def subscribe(self, channels, heartbeat=HEARTBEAT_INTERVAL):
+        """
+        Generator of SSE payloads for the given channels, starting with the
+        next published event. Yields a keep-alive comment when idle and a
+        'resync' event if the subscriber fell behind the ring buffer.
+        """
+        channels = set(channels)
+        with self._condition:
+            cursor = self._sequence
+            self.subscribers += 1
+
+        try:
+            while True:
+                with self._condition:
+                    if self._sequence == cursor:
+                        self._condition.wait(heartbeat)
+                    idle = self._sequence == cursor
+                    cursor, payloads, missed = self._since(cursor, channels)
+
+                if missed:
+                    yield b"event: resync\ndata: {}\n\n"
+                if payloads:
+                    yield b"".join(payloads)
+                elif idle:
+                    yield b": keep-alive\n\n"
+        finally:
+            with self._condition:
+                self.subscribers -= 1
+
+    async def subscribe_async(self, channels, heartbeat=HEARTBEAT_INTERVAL):
+        """Async generator version of subscribe for ASGI servers"""
+        loop = asyncio.get_running_loop()
+        channels = set(channels)
+        with self._condition:
+            cursor = self._sequence
+            self.subscribers += 1
+
+        try:
+            while True:
+                with self._condition:
+                    event = None
+                    if self._sequence == cursor:
+                        event = self._loop_events.get(loop)
+                        if event is None:
+                            event = self._loop_events[loop] = asyncio.Event()
+
+                if event is not None:
+                    try:
+                        await asyncio.wait_for(event.wait(), heartbeat)
+                    except asyncio.TimeoutError:
+                        pass
+
+                with self._condition:
+                    idle = self._sequence == cursor
+                    cursor, payloads, missed = self._since(cursor, channels)
+
+                if missed:
+                    yield b"event: resync\ndata: {}\n\n"
+                if payloads:
+                    yield b"".join(payloads)
+                elif idle:
+                    yield b": keep-alive\n\n"
+        finally:
+            with self._condition:
+                self.subscribers -= 1
@@ -0,0 +1,194 @@
+"""
+Dedicated engine worker.
+
+Runs the price and matching engines outside the web processes. Start any
+number of copies: each one waits for a Postgres advisory lock, and only the
+instance holding it runs the engines. The others stay on standby and take
+over when the leader's database session ends.
+
+The web processes must run with ENGINE_MODE=worker. They insert new orders
+as pending; a trigger (migrations/add_order_intake_notify.sql) announces
+each one on the order_intake channel, and this worker matches it after the
+symbol's micro-batching window and settles the fills. Matching and
+settlement run on ENGINE_SHARDS shards keyed by stock_id, so busy symbols
+do not hold up the others. Engine events are sent back to the web
+processes over NOTIFY.
+
+DATABASE_URL must be a direct (session) connection, not a transaction-mode
+pooler, since the advisory lock belongs to the session.
+
+Run with:
+    python worker.py
+"""
+import os
+
+# Importing app must not start the engines before we are the leader
+os.environ['ENGINE_MODE'] = 'engine'
+
+from datetime import datetime, timedelta
+from threading import Thread
+import json
+import time
+
+import app
+from intake import MicroBatcher
+from notifications import Listener, Notifier, connect
+from shards import ShardPool
+
+DATABASE_URL = os.getenv('DATABASE_URL')
+# Advisory lock key shared by every worker of this deployment
+ENGINE_LOCK_KEY = int(os.getenv('ENGINE_LOCK_KEY', '20240101'))
+LEADER_RETRY_SECONDS = float(os.getenv('LEADER_RETRY_SECONDS', '5'))
+# Safety net for orders whose notification was missed, e.g. while the
+# listener was reconnecting
+ORDER_RECONCILE_SECONDS = float(os.getenv('ORDER_RECONCILE_SECONDS', '30'))
+# How far back each reconcile poll looks, to cover clock skew between web processes
+ORDER_POLL_OVERLAP_SECONDS = float(os.getenv('ORDER_POLL_OVERLAP_SECONDS', '10'))
+# Micro-batching window for incoming orders, in milliseconds: a default and
+# optional per-symbol overrides, e.g. ORDER_BATCH_WINDOWS=AAPL=50,TSLA=200
+ORDER_BATCH_WINDOW_MS = float(os.getenv('ORDER_BATCH_WINDOW_MS', '0'))
+ORDER_BATCH_WINDOWS = {
+    symbol.strip().upper(): float(window)
+    for symbol, window in (
+        item.split('=') for item in os.getenv('ORDER_BATCH_WINDOWS', '').split(',') if '=' in item
+    )
+}
+ORDER_INTAKE_CHANNEL = 'order_intake'
+# How often shard queue depth and latency are logged
+SHARD_METRICS_SECONDS = float(os.getenv('SHARD_METRICS_SECONDS', '60'))
+
+
+def acquire_leadership():
+    """
+    Block until this process holds the engine advisory lock
+    Returns the connection holding it, which must stay open
+    """
+    while True:
+        try:
+            conn = connect(DATABASE_URL)
+            with conn.cursor() as cur:
+                cur.execute('SELECT pg_try_advisory_lock(%s)', (ENGINE_LOCK_KEY,))
+                if cur.fetchone()[0]:
+                    return conn
+            conn.close()
+        except Exception as e:
+            print(f"Error trying to acquire engine leadership: {str(e)}")
+        time.sleep(LEADER_RETRY_SECONDS)
+
+
+def watch_leadership(conn):
+    """
+    Exit the process as soon as the lock connection is lost, since another
+    worker may already have taken over
+    """
+    while True:
+        time.sleep(LEADER_RETRY_SECONDS)
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT 1')
+        except Exception as e:
+            print(f"Lost engine leadership: {str(e)}")
+            os._exit(1)
+
+
+def batch_window(stock_id):
+    """Micro-batching window in seconds for a stock"""
+    stock = app.market_snapshot.get(stock_id)
+    window = ORDER_BATCH_WINDOWS.get(stock['symbol'], ORDER_BATCH_WINDOW_MS) if stock else ORDER_BATCH_WINDOW_MS
+    return window / 1000
+
+
+def match_batch(stock_id, orders):
+    """Feed a batch of new order rows for one stock into its book, oldest first"""
+    stock = app.market_snapshot.get(stock_id)
+    try:
+        with app.intake_gate.admit(app.INTAKE_WAIT_SECONDS):
+            for order in sorted(orders, key=lambda order: order['created_at']):
+                current_price = stock['current_price'] if stock else float(order['price'])
+                # Orders already in the books are skipped by the engine
+                app.submit_order(order, current_price, insert=False)
+    except app.IntakeClosed:
+        # Still pending in the database: loaded with the books when they
+        # open, or cancelled by the halt that closed them
+        print(f"Order books closed, left {len(orders)} orders for {stock_id} pending")
+
+
+def match_batches(batches):
+    """Shard handler: match the (stock_id, orders) batches queued on one shard"""
+    for stock_id, orders in batches:
+        match_batch(stock_id, orders)
+
+
+# Same shard layout as the persistence shards, so a stock's matching and
+# settlement each stay on one thread
+matching_shards = ShardPool(app.ENGINE_SHARDS, match_batches, assignment=app.engine_shard_for, name='matching')
+order_batcher = MicroBatcher(
+    lambda stock_id, orders: matching_shards.submit(stock_id, (stock_id, orders)),
+    batch_window
+)
+
+
+def on_order_intake(payload):
+    """A web process inserted a pending order"""
+    order = json.loads(payload)
+    order_batcher.add(order['stock_id'], order)
+
+
+def reconcile_new_orders():
+    """
+    Background thread function that periodically re-reads recent pending
+    orders, in case a notification was lost
+    """
+    while True:
+        time.sleep(ORDER_RECONCILE_SECONDS)
+        started = datetime.now()
+        try:
+            # As the service role: row level security would hide other users' orders
+            orders = app.service_supabase.table('orders') \
+                .select('*') \
+                .eq('status', app.ORDER_STATUS_PENDING) \
+                .gte('created_at', (started - timedelta(seconds=ORDER_RECONCILE_SECONDS + ORDER_POLL_OVERLAP_SECONDS)).isoformat()) \
+                .order('created_at') \
+                .execute()
+
+            for order in orders.data:
+                order_batcher.add(order['stock_id'], order)
+        except Exception as e:
+            print(f"Error reconciling new orders: {str(e)}")
+
+
+def main():
+    if not DATABASE_URL:
+        raise Exception("DATABASE_URL environment variable not found")
+
+    print("Waiting for engine leadership...")
+    conn = acquire_leadership()
+    print("Acquired engine leadership, starting engines")
+
+    Thread(target=watch_leadership, args=(conn,), daemon=True).start()
+
+    # Prices and symbols for new orders; kept current by our own price events
+    stocks = app.supabase.table('stocks').select('*').execute()
+    app.market_snapshot.load(stocks.data)
+
+    app.engine_event_notifier = Notifier(DATABASE_URL, app.ENGINE_EVENTS_CHANNEL)
+    app.start_engines()
+    matching_shards.start()
+    Thread(target=order_batcher.run, daemon=True).start()
+    Listener(DATABASE_URL, {
+        ORDER_INTAKE_CHANNEL: on_order_intake,
+        app.MARKET_STATE_CHANNEL: app.on_market_state_change
+    }).start()
+    Thread(target=reconcile_new_orders, daemon=True).start()
+
+    while True:
+        time.sleep(SHARD_METRICS_SECONDS)
+        print(json.dumps({
+            'matching_shards': matching_shards.metrics(),
+            'persistence_shards': app.order_persistence_shards.metrics(),
+            'batcher_depth': order_batcher.depth()
+        }))
+
+
+if __name__ == '__main__':
+    main()
@@ -44,6 +44,25 @@ const Market = () => {
 
   useEffect(() => {
     fetchStocks();
+
+    // Live price updates pushed by the backend
+    const token = localStorage.getItem('token');
+    const source = new EventSource(`http://localhost:5000/api/stream?channels=prices&token=${token}`);
+    source.addEventListener('prices', (event) => {
+      const updates: { stock_id: string; current_price: number; price_change: number }[] =
+        JSON.parse((event as MessageEvent).data);
+      setStocks((current) =>
+        current.map((stock) => {
+          const update = updates.find((u) => u.stock_id === stock.id);
+          return update
+            ? { ...stock, current_price: update.current_price, price_change: update.price_change }
+            : stock;
+        })
+      );
+    });
+    source.addEventListener('resync', () => fetchStocks());
+
+    return () => source.close();
   }, []);
 
   const fetchStocks = async () => {
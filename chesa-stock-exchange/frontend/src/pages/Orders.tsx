@@ -12,6 +12,7 @@ import {
   TableContainer,
   TableHead,
   TableRow,
+  Button,
 } from '@mui/material';
 import axios from 'axios';
 import { getApiUrl } from '../config/api';
@@ -22,10 +23,23 @@ interface Order {
   type: 'buy' | 'sell';
   quantity: number;
   price: number;
-  status: 'pending' | 'completed' | 'cancelled';
+  status: OrderStatus;
   created_at: string;
 }
 
+type OrderStatus = 'pending' | 'completed' | 'cancelled';
+
+const STATUSES: OrderStatus[] = ['pending', 'completed', 'cancelled'];
+
+interface OrderPage {
+  orders: Order[];
+  // X-Next-Cursor of the last page loaded, null once there are no more
+  cursor: string | null;
+  loaded: boolean;
+}
+
+const emptyPage: OrderPage = { orders: [], cursor: null, loaded: false };
+
 interface TabPanelProps {
   children?: React.ReactNode;
   index: number;
@@ -50,21 +64,42 @@ function TabPanel(props: TabPanelProps) {
 
 const Orders = () => {
   const [value, setValue] = useState(0);
-  const [orders, setOrders] = useState<Order[]>([]);
+  const [pages, setPages] = useState<Record<OrderStatus, OrderPage>>({
+    pending: emptyPage,
+    completed: emptyPage,
+    cancelled: emptyPage,
+  });
+  const [loading, setLoading] = useState(false);
 
+  // Each tab asks the server for its status, on first view
   useEffect(() => {
-    fetchOrders();
-  }, []);
+    const status = STATUSES[value];
+    if (!pages[status].loaded) {
+      fetchOrders(status, null);
+    }
+  }, [value]);
 
-  const fetchOrders = async () => {
+  const fetchOrders = async (status: OrderStatus, cursor: string | null) => {
+    setLoading(true);
     try {
       const token = localStorage.getItem('token');
       const response = await axios.get(getApiUrl('api/orders'), {
         headers: { Authorization: `Bearer ${token}` },
+        params: cursor ? { status, cursor } : { status },
       });
-      setOrders(response.data);
+      const nextCursor = response.headers['x-next-cursor'] || null;
+      setPages(current => ({
+        ...current,
+        [status]: {
+          orders: cursor ? [...current[status].orders, ...response.data] : response.data,
+          cursor: nextCursor,
+          loaded: true,
+        },
+      }));
     } catch (error) {
       console.error('Error fetching orders:', error);
+    } finally {
+      setLoading(false);
     }
   };
 
@@ -72,9 +107,22 @@ const Orders = () => {
     setValue(newValue);
   };
 
-  const filterOrdersByStatus = (status: 'pending' | 'completed' | 'cancelled') => {
-    return orders.filter(order => order.status === status);
-  };
+  const renderOrders = (status: OrderStatus) => (
+    <>
+      {renderOrdersTable(pages[status].orders)}
+      {pages[status].cursor && (
+        <Box sx={{ display: 'flex', justifyContent: 'center', mt: 2 }}>
+          <Button
+            variant="outlined"
+            disabled={loading}
+            onClick={() => fetchOrders(status, pages[status].cursor)}
+          >
+            Load more
+          </Button>
+        </Box>
+      )}
+    </>
+  );
 
   const renderOrdersTable = (filteredOrders: Order[]) => (
     <TableContainer component={Paper}>
@@ -126,13 +174,13 @@ const Orders = () => {
         </Tabs>
 
         <TabPanel value={value} index={0}>
-          {renderOrdersTable(filterOrdersByStatus('pending'))}
+          {renderOrders('pending')}
         </TabPanel>
         <TabPanel value={value} index={1}>
-          {renderOrdersTable(filterOrdersByStatus('completed'))}
+          {renderOrders('completed')}
         </TabPanel>
         <TabPanel value={value} index={2}>
-          {renderOrdersTable(filterOrdersByStatus('cancelled'))}
+          {renderOrders('cancelled')}
         </TabPanel>
       </Paper>
     </Container>
@@ -13,6 +13,7 @@ import {
   Grid,
 } from '@mui/material';
 import axios from 'axios';
+import { getApiUrl } from '../config/api';
 
 interface StockHolding {
   stock_id: string;
@@ -38,13 +39,12 @@ const Portfolio = () => {
 
   const fetchPortfolio = async () => {
     try {
-      const [holdingsResponse, profileResponse] = await Promise.all([
-        axios.get('http://localhost:5000/api/portfolio/holdings'),
-        axios.get('http://localhost:5000/api/portfolio/profile'),
-      ]);
+      const response = await axios.get(getApiUrl('api/portfolio'), {
+        params: { fields: 'profile,holdings' },
+      });
 
-      setHoldings(holdingsResponse.data);
-      setProfile(profileResponse.data);
+      setHoldings(response.data.holdings);
+      setProfile(response.data.profile);
     } catch (error) {
       console.error('Error fetching portfolio:', error);
     }